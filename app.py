@@ -48,6 +48,62 @@ class PerforceSync(sgtk.platform.Application):
                                      self.sync_changes_daemon, 
                                      params)
         
+        # run resident sync worker:
+        params = {"short_name": "sync_perforce_worker", 
+                  "title": "Run Perforce Sync Worker",
+                  "description": "Run a resident worker that handles sync_perforce requests"}
+        self.engine.register_command(params["title"], 
+                                     self.sync_changes_worker, 
+                                     params)
+        
+        # run worker to retry failed work:
+        params = {"short_name": "sync_perforce_retry_daemon", 
+                  "title": "Run Perforce Sync Retry Worker",
+                  "description": "Run worker to retry changes and files that failed to sync"}
+        self.engine.register_command(params["title"], 
+                                     self.retry_failed_work_daemon, 
+                                     params)
+        
+        # manage the queue of failed work:
+        params = {"short_name": "sync_perforce_queue", 
+                  "title": "Manage Perforce Sync Retry Queue",
+                  "description": "List and replay work that failed to sync"}
+        self.engine.register_command(params["title"], 
+                                     self.manage_work_queue, 
+                                     params)
+        
+        # backfill the depot path on existing publishes:
+        params = {"short_name": "sync_perforce_backfill_depot_paths", 
+                  "title": "Backfill Published File Depot Paths",
+                  "description": "Set the depot path field on published files registered before it existed"}
+        self.engine.register_command(params["title"], 
+                                     self.backfill_depot_paths, 
+                                     params)
+        
+        # backfill historical changes from a checkpoint or journal:
+        params = {"short_name": "sync_perforce_backfill", 
+                  "title": "Backfill Perforce Changes From Journal",
+                  "description": "Sync historical changes from a Perforce checkpoint or journal file"}
+        self.engine.register_command(params["title"], 
+                                     self.backfill_changes, 
+                                     params)
+        
+        # extract changes from Perforce to the spool:
+        params = {"short_name": "sync_perforce_spool", 
+                  "title": "Spool Perforce Changes",
+                  "description": "Read Perforce change(s) into a local spool to be written to Shotgun later"}
+        self.engine.register_command(params["title"], 
+                                     self.spool_changes, 
+                                     params)
+        
+        # write spooled changes to Shotgun:
+        params = {"short_name": "sync_perforce_apply_spool", 
+                  "title": "Apply Spooled Perforce Changes",
+                  "description": "Write the Perforce changes in the local spool to Shotgun"}
+        self.engine.register_command(params["title"], 
+                                     self.apply_spooled_changes, 
+                                     params)
+        
     def destroy_app(self):
         """
         Called when app is destroyed
@@ -82,15 +138,18 @@ class PerforceSync(sgtk.platform.Application):
         parser.add_option("-e", "--end", help="End change to sync (optional)", type="int")
         parser.add_option("-u", "--username", help="Username to use to log-in to Perforce (optional)", type="str")
         parser.add_option("-p", "--password", help="Password to use to log-in to Perforce (optional)", type="str")
+        parser.add_option("--in-process", help="Don't use a running sync worker (optional)", action="store_true")
         
         start_change = end_change = None
         p4_user = p4_pass = None
+        in_process = False
         try:
             options, _ = parser.parse_args(list(args))
             start_change = options.start
             end_change = options.end
             p4_user = options.username
             p4_pass = options.password
+            in_process = options.in_process
         except TankError, e:
             self.log_error("Failed to parse command arguments - %s" % e)
             return
@@ -108,8 +167,23 @@ class PerforceSync(sgtk.platform.Application):
             
         end_change = max(start_change, end_change) if end_change is not None else start_change
         
-        # sync changes:
         tk_shell_perforcesync = self.import_module("tk_shell_perforcesync")
+        
+        # if a sync worker is running then forward the request to it:
+        if not in_process:
+            client = tk_shell_perforcesync.SyncWorkerClient(tk_shell_perforcesync.get_worker_socket_path(self))
+            try:
+                response = client.sync_changes(start_change, end_change)
+            except tk_shell_perforcesync.SyncWorkerUnavailable:
+                self.log_debug("No sync worker running - syncing changes in-process")
+            except Exception, e:
+                self.log_warning("Failed to send request to sync worker (%s) - syncing changes in-process" % e)
+            else:
+                if response.get("status") != "ok":
+                    self.log_error("Sync worker failed to sync changes: %s" % response.get("message"))
+                return
+        
+        # sync changes:
         sync_handler = tk_shell_perforcesync.ShotgunSync(self, p4_user, p4_pass)
         sync_handler.sync_changes(start_change, end_change)
         
@@ -142,7 +216,186 @@ class PerforceSync(sgtk.platform.Application):
         tk_shell_perforcesync = self.import_module("tk_shell_perforcesync")
         daemon = tk_shell_perforcesync.ShotgunSyncDaemon(self, start_change, p4_user, p4_pass)
         daemon.run()
-    
-    
-
-        
\ No newline at end of file
+        
+    def sync_changes_worker(self, *args):
+        """
+        Run a resident sync worker that keeps a warm sync handler open and serves
+        'sync_perforce' requests sent to it over a local socket
+        
+        :param args:    Arguments passed through the shell command line
+        """
+        parser = PerforceSync.SyncOptionParser()
+        parser.add_option("-u", "--username", help="Username to use to log-in to Perforce (optional)", type="str")
+        parser.add_option("-p", "--password", help="Password to use to log-in to Perforce (optional)", type="str")
+        
+        p4_user = p4_pass = None
+        try:
+            options, _ = parser.parse_args(list(args))
+            p4_user = options.username
+            p4_pass = options.password
+        except TankError, e:
+            self.log_error("Failed to parse command arguments - %s" % e)
+            return
+        
+        tk_shell_perforcesync = self.import_module("tk_shell_perforcesync")
+        worker = tk_shell_perforcesync.SyncWorker(self, p4_user, p4_pass)
+        try:
+            worker.run()
+        except TankError, e:
+            self.log_error("Failed to run sync worker - %s" % e)
+            
+    def retry_failed_work_daemon(self, *args):
+        """
+        Run the worker that retries failed work continuously
+        
+        :param args:    Arguments passed through the shell command line
+        """
+        parser = PerforceSync.SyncOptionParser()
+        parser.add_option("-u", "--username", help="Username to use to log-in to Perforce (optional)", type="str")
+        parser.add_option("-p", "--password", help="Password to use to log-in to Perforce (optional)", type="str")
+        
+        p4_user = p4_pass = None
+        try:
+            options, _ = parser.parse_args(list(args))
+            p4_user = options.username
+            p4_pass = options.password
+        except TankError, e:
+            self.log_error("Failed to parse command arguments - %s" % e)
+            return
+        
+        tk_shell_perforcesync = self.import_module("tk_shell_perforcesync")
+        try:
+            worker = tk_shell_perforcesync.RetryWorker(self, p4_user, p4_pass)
+        except TankError, e:
+            self.log_error("Failed to run retry worker - %s" % e)
+            return
+        worker.run()
+        
+    def manage_work_queue(self, *args):
+        """
+        List the work in the retry queue and replay dead work items
+        
+        :param args:    Arguments passed through the shell command line
+        """
+        parser = PerforceSync.SyncOptionParser()
+        parser.add_option("-d", "--dead", help="List dead work items", action="store_true")
+        parser.add_option("-r", "--replay", help="Id of a dead work item to replay (can be repeated)", 
+                          type="int", action="append")
+        parser.add_option("--replay-all", help="Replay all dead work items", action="store_true")
+        
+        try:
+            options, _ = parser.parse_args(list(args))
+        except TankError, e:
+            self.log_error("Failed to parse command arguments - %s" % e)
+            return
+        
+        tk_shell_perforcesync = self.import_module("tk_shell_perforcesync")
+        work_queue = tk_shell_perforcesync.WorkQueue(self, 
+                                                     self.get_setting("retry_max_attempts"),
+                                                     self.get_setting("retry_base_delay"),
+                                                     self.get_setting("retry_max_delay"))
+        
+        if options.replay or options.replay_all:
+            count = work_queue.replay(None if options.replay_all else options.replay)
+            self.log_info("Replaying %d dead work item(s)" % count)
+            return
+        
+        state = tk_shell_perforcesync.WorkQueue.STATE_DEAD if options.dead else None
+        items = work_queue.items(state)
+        self.log_info("%d work item(s) in the retry queue:" % len(items))
+        for item in items:
+            target = ("%s#%d" % (item["depot_path"], item["revision"]) 
+                      if item["kind"] == tk_shell_perforcesync.WorkQueue.KIND_FILE else "change")
+            self.log_info(" [%d] %s - change %d, %s, %s, %d attempt(s): %s" 
+                          % (item["id"], item["state"], item["change"], item["stage"], target, 
+                             item["attempts"], item["last_error"]))
+            
+    def backfill_depot_paths(self, *args):
+        """
+        Set the depot path field on all published files in the current project that
+        were registered before the field existed
+        
+        :param args:    Arguments passed through the shell command line
+        """
+        tk_shell_perforcesync = self.import_module("tk_shell_perforcesync")
+        sync_handler = tk_shell_perforcesync.ShotgunSync(self)
+        try:
+            count = sync_handler.backfill_publish_depot_paths()
+        except TankError, e:
+            self.log_error("Failed to backfill depot paths - %s" % e)
+            return
+        self.log_info("Set the depot path on %d published file(s)" % count)
+        
+    def backfill_changes(self, *args):
+        """
+        Sync historical changes with Shotgun from a Perforce checkpoint and/or journal files
+        rather than from the Perforce server
+        
+        :param args:    Arguments passed through the shell command line
+        """
+        parser = PerforceSync.SyncOptionParser()
+        parser.add_option("-c", "--checkpoint", help="Checkpoint file to read (optional)", type="str")
+        parser.add_option("-j", "--journal", help="Journal file to read after the checkpoint (can be repeated)", 
+                          type="str", action="append")
+        parser.add_option("--project-root", help="Depot root of the project to backfill (optional)", type="str")
+        parser.add_option("-s", "--start", help="Start change to sync (optional)", type="int")
+        parser.add_option("-e", "--end", help="End change to sync (optional)", type="int")
+        
+        try:
+            options, _ = parser.parse_args(list(args))
+        except TankError, e:
+            self.log_error("Failed to parse command arguments - %s" % e)
+            return
+        
+        journal_paths = ([options.checkpoint] if options.checkpoint else []) + (options.journal or [])
+        if not journal_paths:
+            self.log_error("A checkpoint or journal file must be specified!")
+            return
+        
+        tk_shell_perforcesync = self.import_module("tk_shell_perforcesync")
+        sync_handler = tk_shell_perforcesync.ShotgunSync(self)
+        try:
+            sync_handler.backfill_changes_from_journal(journal_paths, options.project_root, 
+                                                       options.start, options.end)
+        except TankError, e:
+            self.log_error("Failed to backfill changes - %s" % e)
+            
+    def spool_changes(self, *args):
+        """
+        Read Perforce changes into the local spool without writing anything to Shotgun
+        
+        :param args:    Arguments passed through the shell command line
+        """
+        parser = PerforceSync.SyncOptionParser()
+        parser.add_option("-s", "--start", help="Start change to extract (optional)", type="int")
+        parser.add_option("-e", "--end", help="End change to extract (optional)", type="int")
+        parser.add_option("-u", "--username", help="Username to use to log-in to Perforce (optional)", type="str")
+        parser.add_option("-p", "--password", help="Password to use to log-in to Perforce (optional)", type="str")
+        
+        try:
+            options, _ = parser.parse_args(list(args))
+        except TankError, e:
+            self.log_error("Failed to parse command arguments - %s" % e)
+            return
+        
+        tk_shell_perforcesync = self.import_module("tk_shell_perforcesync")
+        spool = tk_shell_perforcesync.ChangeSpool(self, self.get_setting("spool_location") or None)
+        sync_handler = tk_shell_perforcesync.ShotgunSync(self, options.username, options.password)
+        try:
+            count = sync_handler.spool_changes(spool, options.start, options.end)
+        except TankError, e:
+            self.log_error("Failed to spool changes - %s" % e)
+            return
+        self.log_info("Added %d change(s) to the spool" % count)
+        
+    def apply_spooled_changes(self, *args):
+        """
+        Write the changes in the local spool to Shotgun
+        
+        :param args:    Arguments passed through the shell command line
+        """
+        tk_shell_perforcesync = self.import_module("tk_shell_perforcesync")
+        spool = tk_shell_perforcesync.ChangeSpool(self, self.get_setting("spool_location") or None)
+        sync_handler = tk_shell_perforcesync.ShotgunSync(self)
+        count = sync_handler.apply_spool(spool, self.get_setting("spool_apply_batch_size"))
+        self.log_info("Applied %d spooled change(s)" % count)
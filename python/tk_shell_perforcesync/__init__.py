@@ -9,4 +9,9 @@
 # not expressly granted therein are reserved by Shotgun Software Inc.
 
 from .shotgun_sync_daemon import ShotgunSyncDaemon
-from .shotgun_sync import ShotgunSync
\ No newline at end of file
+from .shotgun_sync import ShotgunSync
+from .sync_worker import SyncWorker, get_worker_socket_path
+from .sync_worker_client import SyncWorkerClient, SyncWorkerUnavailable
+from .work_queue import WorkQueue
+from .retry_worker import RetryWorker
+from .change_spool import ChangeSpool
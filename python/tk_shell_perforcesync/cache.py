@@ -0,0 +1,160 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Bounded, instrumented in-memory cache used for all caches held by the sync so that
+memory use stays flat in long running processes
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+class LruCache(object):
+    """
+    Least-recently-used cache with a maximum size and optional expiry.  A value of None
+    is treated as a negative result (e.g. 'this path isn't in a project') and can be
+    given a shorter time-to-live than positive results so that it's retried sooner.
+    """
+
+    def __init__(self, name, max_size, ttl=0, negative_ttl=0):
+        """
+        Construction
+
+        :param name:            Name of the cache, used when reporting statistics
+        :param max_size:        Maximum number of entries to keep in the cache
+        :param ttl:             Time in seconds that positive entries remain valid for,
+                                0 means they never expire
+        :param negative_ttl:    Time in seconds that negative (None) entries remain valid
+                                for, 0 means they never expire
+        """
+        self.__name = name
+        self.__max_size = max(1, max_size)
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+
+        self.__entries = OrderedDict()
+        self.__lock = threading.RLock()
+
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__expirations = 0
+
+    @property
+    def name(self):
+        """
+        The name of this cache
+        """
+        return self.__name
+
+    def lookup(self, key):
+        """
+        Look up an entry in the cache.
+
+        :param key:     The key to look up
+        :returns:       Tuple (found, value) where found is True if the key was in the cache
+                        and hadn't expired.  Value may be None for negative entries.
+        """
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None:
+                self.__misses += 1
+                return (False, None)
+
+            value, expires_at = entry
+            if expires_at and expires_at < time.time():
+                self.__expirations += 1
+                self.__misses += 1
+                return (False, None)
+
+            # re-insert to mark as the most recently used entry:
+            self.__entries[key] = entry
+            self.__hits += 1
+            return (True, value)
+
+    def get(self, key, default=None):
+        """
+        Return the value for the key, or default if it isn't in the cache.
+
+        :param key:     The key to look up
+        :param default: Value to return if the key isn't found or the entry is negative
+        """
+        found, value = self.lookup(key)
+        return value if found and value is not None else default
+
+    def set(self, key, value):
+        """
+        Add or replace an entry in the cache, evicting the least recently used entries
+        if the cache is full.
+
+        :param key:     The key to add
+        :param value:   The value to add, None to record a negative result
+        """
+        ttl = self.__negative_ttl if value is None else self.__ttl
+        expires_at = (time.time() + ttl) if ttl else 0
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (value, expires_at)
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+                self.__evictions += 1
+
+    def invalidate(self, key):
+        """
+        Remove an entry from the cache.
+
+        :param key:     The key to remove
+        """
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+    def keys(self):
+        """
+        Return all keys currently in the cache, including any that have expired but
+        not yet been removed.
+        """
+        with self.__lock:
+            return self.__entries.keys()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def stats(self):
+        """
+        Return statistics for this cache.
+
+        :returns dict:  Dictionary containing size, hits, misses, evictions and expirations
+        """
+        with self.__lock:
+            return {"size":len(self.__entries),
+                    "hits":self.__hits,
+                    "misses":self.__misses,
+                    "evictions":self.__evictions,
+                    "expirations":self.__expirations}
+
+    def format_stats(self):
+        """
+        Return the statistics for this cache formatted for logging.
+        """
+        stats = self.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = (100.0 * stats["hits"] / lookups) if lookups else 0.0
+        return ("%s: %d entries, %d hits, %d misses (%.1f%% hit rate), %d evictions, %d expirations"
+                % (self.__name, stats["size"], stats["hits"], stats["misses"], hit_rate,
+                   stats["evictions"], stats["expirations"]))
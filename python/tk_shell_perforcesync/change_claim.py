@@ -0,0 +1,193 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Atomic claiming of Perforce changes so that each change is processed by exactly one daemon
+"""
+
+import os
+import socket
+import threading
+
+import sgtk
+
+p4_fw = sgtk.platform.get_framework("tk-framework-perforce")
+from P4 import P4Exception
+
+from .util import is_process_running
+
+class ChangeClaim(object):
+    """
+    Claim Perforce changes using an atomic compare-and-set of a single claims counter for the
+    project.  The counter holds the changes that are currently claimed together with their
+    owner (host.pid), e.g. '37=render01.1234,38=render02.567', and the daemon whose 
+    compare-and-set adds a change is the only one that owns it - every other daemon will 
+    find it already listed and skip it.  Recording the owner means that a restarted daemon
+    can tell the changes its previous process claimed apart from those claimed by other 
+    daemons that are still running.
+
+    Claims are only needed until the project counter has moved past the change.  They are
+    removed by the next compare-and-set after release() has been called, so releasing them
+    needs at most one more round trip to the Perforce server.
+    """
+
+    # number of times to try updating the claims counter if other daemons keep changing it:
+    MAX_WRITE_ATTEMPTS = 5
+
+    def __init__(self, app, counter_base_name):
+        """
+        Construction
+
+        :param app:                 The app bundle that constructed this object
+        :param counter_base_name:   The base name used for the claims counter, e.g. the
+                                    project counter name
+        """
+        self.__app = app
+        self.__counter_name = "%s_claims" % counter_base_name
+        self.__host = socket.gethostname()
+        self.__owner = "%s.%d" % (self.__host, os.getpid())
+        # claims are made from the change worker threads as well:
+        self.__lock = threading.Lock()
+        # the last value read from or written to the claims counter:
+        self.__value = None
+        # claims for changes up to this one are no longer needed:
+        self.__released_change = 0
+
+    @property
+    def counter_name(self):
+        """
+        The name of the Perforce counter used to claim changes
+        """
+        return self.__counter_name
+
+    def claim(self, p4, change_id):
+        """
+        Attempt to claim the specified change.  This is a single round trip to the Perforce
+        server unless another daemon has changed the claims counter since it was last read.
+
+        :param p4:          The Perforce connection to use
+        :param change_id:   The id of the change to claim
+        :returns bool:      True if this process now owns the change, otherwise False
+        """
+        with self.__lock:
+            for _ in range(ChangeClaim.MAX_WRITE_ATTEMPTS):
+                if self.__value is None and not self.__read(p4):
+                    return False
+                claims = self.__parse(self.__value)
+                if change_id in claims:
+                    self.__app.log_debug("Change %d has already been claimed by '%s'" % (change_id, claims[change_id]))
+                    return False
+                if change_id <= self.__released_change:
+                    self.__app.log_debug("Change %d has already been processed" % change_id)
+                    return False
+                claims[change_id] = self.__owner
+                if self.__write(p4, claims):
+                    return True
+            self.__app.log_error("Failed to claim change %d using Perforce counter '%s' after %d attempts"
+                                 % (change_id, self.__counter_name, ChangeClaim.MAX_WRITE_ATTEMPTS))
+            return False
+
+    def is_own_claim(self, p4, change_id):
+        """
+        Determine if a change that has already been claimed was claimed by this process or
+        by a process on this machine that is no longer running, e.g. this daemon before it 
+        was restarted.  The claims counter is read again to check this.
+
+        :param p4:          The Perforce connection to use
+        :param change_id:   The id of the change to check
+        :returns bool:      True if the claim was made by this process or a process on this
+                            machine that has stopped
+        """
+        with self.__lock:
+            if not self.__read(p4):
+                return False
+            owner = self.__parse(self.__value).get(change_id)
+        if not owner:
+            return False
+        if owner == self.__owner:
+            return True
+        host, _, pid = owner.rpartition(".")
+        return host == self.__host and pid.isdigit() and not is_process_running(int(pid))
+
+    def release(self, p4, up_to_change):
+        """
+        Remove the claims for all changes up to and including the specified change, including
+        any left by other daemons.  This should only be called with a change that the project
+        counter has been written past as changes before the counter are never processed
+        again.  The claims counter is only written if the last value read contains claims
+        that can be removed.
+
+        :param p4:              The Perforce connection to use
+        :param up_to_change:    The change to release claims up to, typically the value of the
+                                project counter
+        :returns int:           The number of claims removed
+        """
+        if not up_to_change:
+            return 0
+        with self.__lock:
+            self.__released_change = max(self.__released_change, up_to_change)
+            for _ in range(ChangeClaim.MAX_WRITE_ATTEMPTS):
+                if self.__value is None:
+                    return 0
+                claims = self.__parse(self.__value)
+                num_released = len([c for c in claims if c <= self.__released_change])
+                if not num_released:
+                    return 0
+                if self.__write(p4, claims):
+                    self.__app.log_debug("Released %d claim(s) for changes up to %d" % (num_released, up_to_change))
+                    return num_released
+                if self.__value is None and not self.__read(p4):
+                    return 0
+            return 0
+
+    def __read(self, p4):
+        """
+        Read the claims counter, returning True if it was read successfully.
+        """
+        try:
+            # returns: [{'counter': 'tk_perforcesync_project_65_claims', 'value': '37=render01.1234'}]
+            p4_res = p4.run_counter(self.__counter_name)
+            self.__value = p4_res[0]["value"] if p4_res else "0"
+            return True
+        except P4Exception, e:
+            self.__app.log_error("Failed to read Perforce claims counter '%s' - %s"
+                                 % (self.__counter_name, (p4.errors[0] if p4.errors else e)))
+        except Exception, e:
+            self.__app.log_error("Failed to read Perforce claims counter '%s' - %s" % (self.__counter_name, e))
+        self.__value = None
+        return False
+
+    def __write(self, p4, claims):
+        """
+        Write the claims to the counter, removing any that have been released, if it hasn't
+        been changed since it was last read.  If it has then the counter is read again and 
+        False is returned.
+        """
+        value = ",".join("%d=%s" % (change_id, owner) for change_id, owner in sorted(claims.iteritems())
+                         if change_id > self.__released_change) or "0"
+        try:
+            # the compare-and-set is atomic on the server and fails if the counter has changed:
+            p4.run_counter("--from=%s" % self.__value, "--to=%s" % value, self.__counter_name)
+        except Exception:
+            self.__read(p4)
+            return False
+        self.__value = value
+        return True
+
+    def __parse(self, value):
+        """
+        Parse the value of the claims counter into a dictionary of {change id:owner}.
+        """
+        claims = {}
+        for claim in (value or "").split(","):
+            change_str, _, owner = claim.partition("=")
+            if change_str.isdigit() and owner:
+                claims[int(change_str)] = owner
+        return claims
@@ -0,0 +1,384 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Time-limited leases on disjoint ranges of changes so that multiple daemons running for the
+same project can share the work instead of racing each other for every change
+"""
+
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+import sgtk
+from sgtk import TankError
+
+p4_fw = sgtk.platform.get_framework("tk-framework-perforce")
+from P4 import P4Exception
+
+from .util import ensure_folder_exists
+
+class P4CounterLeaseBackend(object):
+    """
+    Lease storage using Perforce counters.  Works across any number of machines.
+    """
+
+    def increment(self, p4, name):
+        """
+        Atomically increment a counter and return the new value.
+        """
+        p4_res = self.__run(p4, "-i", name)
+        return int(p4_res[0]["value"]) if p4_res else 0
+
+    def get(self, p4, name):
+        """
+        Return the value of a counter, "0" if it isn't set.
+        """
+        p4_res = self.__run(p4, name)
+        return p4_res[0]["value"] if p4_res else "0"
+
+    def compare_and_set(self, p4, name, old_value, new_value):
+        """
+        Atomically set the value of a counter if it currently has the expected value.  A
+        counter that isn't set has the value "0".
+
+        :returns bool:  True if the counter was set, False if it had a different value
+        """
+        try:
+            p4.run_counter("--from=%s" % old_value, "--to=%s" % new_value, name)
+            return True
+        except P4Exception, e:
+            error = p4.errors[0] if p4.errors else e
+        # the update is rejected if the value doesn't match so check that this is why it failed:
+        if self.get(p4, name) != str(old_value):
+            return False
+        raise TankError("Failed to run 'p4 counter --from=%s --to=%s %s': %s" % (old_value, new_value, name, error))
+
+    def delete(self, p4, name):
+        """
+        Delete a counter.
+        """
+        self.__run(p4, "-d", name)
+
+    def list(self, p4, prefix):
+        """
+        Return a dictionary of {name:value} for all counters starting with prefix.
+        """
+        try:
+            p4_res = p4.run_counters("-e", "%s*" % prefix)
+        except P4Exception, e:
+            raise TankError("Failed to list Perforce counters '%s*': %s" % (prefix, p4.errors[0] if p4.errors else e))
+        return dict([(r["counter"], r["value"]) for r in p4_res if "counter" in r])
+
+    def __run(self, p4, *args):
+        try:
+            return p4.run_counter(*args)
+        except P4Exception, e:
+            raise TankError("Failed to run 'p4 counter %s': %s" % (" ".join(args), p4.errors[0] if p4.errors else e))
+
+class LocalLeaseBackend(object):
+    """
+    Lease storage using a local SQLite database.  This only works when all daemons run on
+    the same machine but doesn't need any Perforce server round trips.
+    """
+
+    def __init__(self, location):
+        """
+        Construction
+
+        :param location:    The shared directory to store the database in
+        """
+        ensure_folder_exists(location)
+        self.__path = os.path.join(location, "change_leases.db")
+        self.__local = threading.local()
+
+    def increment(self, p4, name):
+        connection = self.__connection()
+        with connection:
+            # start a write transaction straight away so that the read and write are atomic:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+            value = (int(row[0]) if row else 0) + 1
+            connection.execute("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)", (name, str(value)))
+        return value
+
+    def get(self, p4, name):
+        row = self.__connection().execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else "0"
+
+    def compare_and_set(self, p4, name, old_value, new_value):
+        connection = self.__connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+            if (row[0] if row else "0") != str(old_value):
+                return False
+            connection.execute("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)", 
+                               (name, str(new_value)))
+        return True
+
+    def delete(self, p4, name):
+        connection = self.__connection()
+        with connection:
+            connection.execute("DELETE FROM counters WHERE name = ?", (name,))
+
+    def list(self, p4, prefix):
+        rows = self.__connection().execute("SELECT name, value FROM counters WHERE substr(name, 1, ?) = ?",
+                                           (len(prefix), prefix)).fetchall()
+        return dict(rows)
+
+    def __connection(self):
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            # use manual transactions so that BEGIN IMMEDIATE can be used:
+            connection = sqlite3.connect(self.__path, timeout=30, isolation_level=None)
+            connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.__local.connection = connection
+        return connection
+
+class ChangeLease(object):
+    """
+    A lease held by this process on a range of changes
+    """
+
+    def __init__(self, range_index, start_change, end_change, generation, progress, taken_over=False):
+        """
+        Construction
+
+        :param range_index:     The index of the leased range
+        :param start_change:    The first change in the range
+        :param end_change:      The last change in the range
+        :param generation:      The ownership generation of the range held by this lease
+        :param progress:        The last change in the range that has been processed
+        :param taken_over:      True if the lease was taken over from a daemon that died
+        """
+        self.range_index = range_index
+        self.start_change = start_change
+        self.end_change = end_change
+        self.generation = generation
+        self.progress = progress
+        self.taken_over = taken_over
+        self.last_heartbeat = 0
+        # the stored state of the range as last written by this process:
+        self.state = "0"
+
+class ChangeLeaseManager(object):
+    """
+    Hand out leases on fixed size ranges of change numbers.
+
+    New ranges are allocated in order by atomically incrementing a shared 'next range' 
+    value so daemons never contend for the same range.  The state of each leased range is 
+    stored as 'generation:owner:heartbeat:progress' where progress is the last change in 
+    the range that was processed.  The state is only ever changed with a compare-and-set
+    from the value this process last read or wrote, so a daemon owns a range for as long 
+    as its updates succeed.  A range whose owner stopped sending heartbeats is taken over 
+    by replacing its state with the next generation.
+
+    Once every change in a range has been processed its state is set to 'done' and the 
+    project counter is moved to the end of all completed ranges that follow it so that
+    the counter always means the same thing as when daemons claim changes individually.
+    """
+
+    # state of a range once all of its changes have been processed:
+    DONE_STATE = "done"
+
+    # number of times to retry moving the project counter if another daemon moves it first:
+    MAX_COUNTER_ATTEMPTS = 5
+
+    def __init__(self, app, name_prefix, backend, range_size, ttl):
+        """
+        Construction
+
+        :param app:             The app bundle that constructed this object
+        :param name_prefix:     Prefix used for all counters used to store the leases - this
+                                is also the name of the project counter
+        :param backend:         The storage backend, e.g. P4CounterLeaseBackend
+        :param range_size:      The number of changes in each range
+        :param ttl:             Time in seconds after which a lease without a heartbeat
+                                can be taken over by another daemon
+        """
+        self.__app = app
+        self.__counter_name = name_prefix
+        self.__prefix = "%s_lease_" % name_prefix
+        self.__backend = backend
+        self.__range_size = max(1, range_size)
+        self.__ttl = ttl
+        self.__owner = "%s.%d" % (socket.gethostname(), os.getpid())
+        # the project counter is always a Perforce counter, whichever backend is used:
+        self.__project_counter = P4CounterLeaseBackend()
+
+    def acquire(self, p4, head_change, min_change):
+        """
+        Acquire a lease, preferring to take over an expired lease before allocating a
+        new range.
+
+        :param p4:              The Perforce connection to use
+        :param head_change:     The most recently submitted change
+        :param min_change:      Changes before this will never be processed
+        :returns ChangeLease:   The acquired lease or None if there is nothing to lease
+        """
+        lease = self.__take_over_expired_lease(p4)
+        if lease:
+            return lease
+
+        next_name = "%snext" % self.__prefix
+        next_range = int(self.__backend.get(p4, next_name))
+        if next_range == 0:
+            # first daemon to run for this project so start from the minimum change:
+            first_range = min_change // self.__range_size
+            if self.__backend.compare_and_set(p4, next_name, "0", first_range):
+                next_range = first_range
+                # changes before the first range will never be processed so make sure 
+                # completed ranges can be added to the counter from the start:
+                self.__advance_project_counter(p4, first_range * self.__range_size - 1)
+            else:
+                # another daemon got there first:
+                next_range = int(self.__backend.get(p4, next_name))
+
+        # give up if there is nothing to lease yet:
+        if next_range * self.__range_size > head_change:
+            return None
+
+        # allocate the next range - the increment guarantees this daemon is the only one
+        # to be handed it:
+        range_index = self.__backend.increment(p4, next_name) - 1
+        start_change = range_index * self.__range_size
+        end_change = start_change + self.__range_size - 1
+        lease = ChangeLease(range_index, start_change, end_change, 1, max(start_change, min_change) - 1)
+        if not self.heartbeat(p4, lease):
+            return None
+        self.__app.log_debug("Acquired lease on changes %d - %d" % (start_change, end_change))
+        return lease
+
+    def heartbeat(self, p4, lease, force=True):
+        """
+        Renew a lease and record its progress.
+
+        :param p4:          The Perforce connection to use
+        :param lease:       The lease to renew
+        :param force:       If False then the heartbeat is only sent if a third of the ttl
+                            has passed since the last one
+        :returns bool:      False if the lease has been taken over by another daemon
+        """
+        now = time.time()
+        if not force and now - lease.last_heartbeat < self.__ttl / 3.0:
+            return True
+
+        state = "%d:%s:%d:%d" % (lease.generation, self.__owner, now, lease.progress)
+        if not self.__backend.compare_and_set(p4, self.__state_name(lease.range_index), lease.state, state):
+            self.__app.log_warning("Lease on changes %d - %d has been taken over by another daemon!"
+                                   % (lease.start_change, lease.end_change))
+            return False
+        lease.state = state
+        lease.last_heartbeat = now
+        return True
+
+    def complete(self, p4, lease):
+        """
+        Mark a lease as complete once every change in the range has been processed and move 
+        the project counter past all completed ranges that it has reached.
+
+        :param p4:      The Perforce connection to use
+        :param lease:   The lease to complete
+        :returns int:   The new value of the project counter or None if it wasn't moved
+        """
+        if not self.__backend.compare_and_set(p4, self.__state_name(lease.range_index), lease.state, 
+                                              ChangeLeaseManager.DONE_STATE):
+            self.__app.log_warning("Lease on changes %d - %d was taken over by another daemon before it "
+                                   "was completed!" % (lease.start_change, lease.end_change))
+            return None
+        lease.state = ChangeLeaseManager.DONE_STATE
+        self.__app.log_debug("Completed lease on changes %d - %d" % (lease.start_change, lease.end_change))
+        return self.__advance_past_completed_ranges(p4)
+
+    def __advance_past_completed_ranges(self, p4):
+        """
+        Move the project counter to the end of the contiguous run of completed ranges that 
+        starts with the range containing the change after the counter, removing the state 
+        of all completed ranges the counter has moved past.  The 'next range' value is 
+        already past these ranges so they can never be handed out again.
+
+        :returns int:   The new value of the project counter or None if it wasn't moved
+        """
+        for _ in range(ChangeLeaseManager.MAX_COUNTER_ATTEMPTS):
+            counter = int(self.__project_counter.get(p4, self.__counter_name))
+            states = self.__backend.list(p4, self.__prefix)
+            
+            range_index = (counter + 1) // self.__range_size
+            new_counter = None
+            while states.get(self.__state_name(range_index)) == ChangeLeaseManager.DONE_STATE:
+                new_counter = (range_index + 1) * self.__range_size - 1
+                range_index += 1
+            
+            if new_counter is not None:
+                if not self.__project_counter.compare_and_set(p4, self.__counter_name, counter, new_counter):
+                    # another daemon moved the counter first so try again from its new value:
+                    continue
+                self.__app.log_debug("Updated the Perforce counter '%s' to %d" % (self.__counter_name, new_counter))
+                counter = new_counter
+            
+            # clean up the state of all completed ranges the counter has moved past:
+            for name, value in states.iteritems():
+                range_str = name[len(self.__prefix):]
+                if (value == ChangeLeaseManager.DONE_STATE and range_str.isdigit()
+                    and (int(range_str) + 1) * self.__range_size - 1 <= counter):
+                    self.__backend.delete(p4, name)
+            return new_counter
+        
+        self.__app.log_warning("Failed to update the Perforce counter '%s' as it keeps being changed by "
+                               "other daemons" % self.__counter_name)
+        return None
+
+    def __advance_project_counter(self, p4, value):
+        """
+        Move the project counter forward to the specified value, never moving it backwards.
+        """
+        for _ in range(ChangeLeaseManager.MAX_COUNTER_ATTEMPTS):
+            counter = int(self.__project_counter.get(p4, self.__counter_name))
+            if counter >= value:
+                return
+            if self.__project_counter.compare_and_set(p4, self.__counter_name, counter, value):
+                return
+
+    def __take_over_expired_lease(self, p4):
+        """
+        Look for a lease whose owner has stopped sending heartbeats and take it over.
+        """
+        now = time.time()
+        for name, value in self.__backend.list(p4, self.__prefix).iteritems():
+            range_str = name[len(self.__prefix):]
+            if not range_str.isdigit():
+                # not a lease state counter
+                continue
+            try:
+                generation, owner, heartbeat, progress = value.split(":")
+                generation, heartbeat, progress = int(generation), float(heartbeat), int(progress)
+            except ValueError:
+                # e.g. a completed range
+                continue
+            if now - heartbeat < self.__ttl:
+                continue
+
+            range_index = int(range_str)
+            start_change = range_index * self.__range_size
+            lease = ChangeLease(range_index, start_change, start_change + self.__range_size - 1,
+                                generation + 1, progress, taken_over=True)
+            # replacing the state we read means nothing else can have taken it over first:
+            lease.state = value
+            if not self.heartbeat(p4, lease):
+                continue
+            self.__app.log_info("Took over expired lease on changes %d - %d from '%s'"
+                                % (lease.start_change, lease.end_change, owner))
+            return lease
+
+    def __state_name(self, range_index):
+        return "%s%d" % (self.__prefix, range_index)
@@ -0,0 +1,234 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Lookahead buffer of described changes used by the daemon to find the next submitted change
+"""
+
+import threading
+
+import sgtk
+
+p4_fw = sgtk.platform.get_framework("tk-framework-perforce")
+
+from .p4_records import P4Change
+
+class ChangeLookahead(object):
+    """
+    Buffer of changes that have already been described so that each change is only ever
+    described once, however many calls it takes to work through them.
+
+    The buffer covers a contiguous window of change ids starting at the change that was
+    last asked for.  Change ids in the window that aren't submitted changes (e.g. pending
+    or shelved changes) are remembered as well so they aren't described again - Perforce
+    renumbers a pending change when it's submitted if there are later changes so a change
+    id that isn't submitted below the most recent submitted change will never become
+    submitted.
+
+    Whilst the caller is busy with a change, the next block of changes can be described in
+    a background thread using a separate Perforce connection.
+
+    If the next change asked for is outside the window (e.g. because the counter was moved
+    on by another daemon) then the buffer is discarded.
+    """
+
+    def __init__(self, app, p4_user, p4_pass, block_size, prefetch, is_change_known_to_be_foreign):
+        """
+        Construction
+
+        :param app:             The app bundle that constructed this object
+        :param p4_user:         The Perforce user the prefetch connection should use
+        :param p4_pass:         The Perforce password the prefetch connection should use
+        :param block_size:      The number of change ids to describe at a time
+        :param prefetch:        True if the next block should be described in the background
+        :param is_change_known_to_be_foreign:   Function with the signature f(p4, change_id) that
+                                returns True for changes that don't need to be described
+        """
+        self.__app = app
+        self.__p4_user = p4_user
+        self.__p4_pass = p4_pass
+        self.__block_size = max(1, block_size)
+        self.__prefetch = prefetch
+        self.__is_change_known_to_be_foreign = is_change_known_to_be_foreign
+
+        # the window covers the change ids [window start, window end) - only submitted
+        # changes are stored:
+        self.__window_start = 0
+        self.__window_end = 0
+        self.__changes = {}
+        self.__head_change = 0
+
+        # the running prefetch, as (thread, result) where result is filled in by the thread:
+        self.__prefetch_job = None
+        self.__prefetch_p4 = None
+
+    def find_next(self, p4, start_change, max_change=None):
+        """
+        Find the next submitted change with a change id >= start_change.  Perforce errors are
+        raised to the caller.
+
+        :param p4:              The Perforce connection to use
+        :param start_change:    Minimum change to look for new changes from
+        :param max_change:      Optional maximum change to look for new changes up to
+        :returns P4Change:      The change if found or None if there is no change
+        """
+        if start_change < self.__window_start or start_change > self.__window_end:
+            self.__app.log_debug("Discarding described changes %d - %d as change %d was requested"
+                                 % (self.__window_start, self.__window_end - 1, start_change))
+            self.__reset(start_change)
+        else:
+            for change_id in [c for c in self.__changes if c < start_change]:
+                del self.__changes[change_id]
+            self.__window_start = start_change
+
+        queried_head = False
+        while True:
+            change = self.__find_buffered(max_change)
+            if change:
+                self.__start_prefetch(p4, max_change)
+                return change
+
+            # use anything that has been described in the background first:
+            if self.__collect_prefetch():
+                continue
+
+            # only look for new changes once we've caught up with the most recent change:
+            end_change = self.__head_change
+            if max_change is not None:
+                end_change = min(end_change, max_change)
+            if self.__window_end > end_change:
+                if queried_head:
+                    return None
+                # returns: [{'status': 'submitted', 'changeType': 'public', 'change': '36', ...}]
+                p4_res = p4.run_changes("-m", "1", "-s", "submitted")
+                self.__head_change = int(p4_res[0]["change"]) if p4_res else 0
+                queried_head = True
+                continue
+
+            block_end = min(self.__window_end + self.__block_size - 1, end_change)
+            self.__merge(self.__window_end, block_end, self.__describe(p4, self.__window_end, block_end))
+
+    def close(self):
+        """
+        Wait for any running prefetch to finish and disconnect the prefetch connection.  
+        Changes described by the prefetch are discarded.
+        """
+        if self.__prefetch_job:
+            self.__prefetch_job[0].join()
+            self.__prefetch_job = None
+        if self.__prefetch_p4:
+            try:
+                if self.__prefetch_p4.connected():
+                    self.__prefetch_p4.disconnect()
+            except Exception, e:
+                self.__app.log_warning("Failed to disconnect the change prefetch connection: %s" % e)
+            self.__prefetch_p4 = None
+
+    def __find_buffered(self, max_change):
+        """
+        Return the first buffered submitted change up to max_change, or None.
+        """
+        change_ids = [c for c in self.__changes if max_change is None or c <= max_change]
+        return self.__changes[min(change_ids)] if change_ids else None
+
+    def __reset(self, start_change):
+        """
+        Discard all buffered changes and start a new window at the specified change.
+        """
+        self.__collect_prefetch()
+        self.__changes = {}
+        self.__window_start = start_change
+        self.__window_end = start_change
+
+    def __merge(self, block_start, block_end, changes):
+        """
+        Add the changes described for a block that starts at the end of the window.
+        """
+        if block_start != self.__window_end:
+            # the window has moved since the block was requested:
+            return
+        for change in changes:
+            if block_start <= change.change <= block_end:
+                self.__changes[change.change] = change
+        self.__window_end = block_end + 1
+
+    def __describe(self, p4, block_start, block_end):
+        """
+        Describe the change ids in a block.
+
+        :returns list:  List of P4Change instances for the submitted changes in the block
+        """
+        # skip any changes that another daemon has already found aren't in this
+        # project without describing them:
+        block_changes = [change_num for change_num in range(block_start, block_end + 1)
+                         if not self.__is_change_known_to_be_foreign(p4, change_num)]
+        if not block_changes:
+            return []
+
+        p4_res = p4.run_describe(block_changes)
+        return [P4Change.from_describe(r) for r in p4_res
+                if "change" in r and r.get("status") == "submitted"]
+
+    def __start_prefetch(self, p4, max_change):
+        """
+        Start describing the next block of changes in the background if there are only a few
+        changes left in the buffer.
+        """
+        if not self.__prefetch or self.__prefetch_job or len(self.__changes) > 1:
+            return
+        end_change = self.__head_change
+        if max_change is not None:
+            end_change = min(end_change, max_change)
+        if self.__window_end > end_change:
+            return
+
+        block_start = self.__window_end
+        block_end = min(block_start + self.__block_size - 1, end_change)
+        # the membership index is only used from the main thread so check it here:
+        block_changes = [change_num for change_num in range(block_start, block_end + 1)
+                         if not self.__is_change_known_to_be_foreign(p4, change_num)]
+
+        result = {"block":(block_start, block_end), "changes":None}
+        thread = threading.Thread(target=self.__run_prefetch, args=(block_changes, result),
+                                  name="change_prefetch")
+        thread.daemon = True
+        thread.start()
+        self.__prefetch_job = (thread, result)
+
+    def __run_prefetch(self, block_changes, result):
+        """
+        Describe changes using the prefetch connection - runs in a background thread.
+        """
+        try:
+            if not self.__prefetch_p4 or not self.__prefetch_p4.connected():
+                self.__prefetch_p4 = p4_fw.connection.connect(False, self.__p4_user, self.__p4_pass, "")
+            p4_res = self.__prefetch_p4.run_describe(block_changes) if block_changes else []
+            result["changes"] = [P4Change.from_describe(r) for r in p4_res
+                                 if "change" in r and r.get("status") == "submitted"]
+        except Exception, e:
+            # the block will be described again in the main thread:
+            self.__app.log_warning("Failed to prefetch changes %d - %d: %s" % (result["block"] + (e,)))
+
+    def __collect_prefetch(self):
+        """
+        Wait for the running prefetch to finish and add its changes to the buffer.
+
+        :returns bool:  True if the window was extended
+        """
+        if not self.__prefetch_job:
+            return False
+        thread, result = self.__prefetch_job
+        thread.join()
+        self.__prefetch_job = None
+        if result["changes"] is None:
+            return False
+        window_end = self.__window_end
+        self.__merge(result["block"][0], result["block"][1], result["changes"])
+        return self.__window_end != window_end
@@ -0,0 +1,217 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Append-only spool of changes that have been read from Perforce and are waiting to be
+written to Shotgun
+"""
+
+import os
+import json
+import time
+from datetime import datetime
+
+from .util import get_cache_location, ensure_folder_exists
+
+def _encode_value(value):
+    """
+    Encode values that json can't represent natively.
+    """
+    if isinstance(value, datetime):
+        return {"__datetime__":time.mktime(value.timetuple()) + value.microsecond / 1e6}
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError("%r can't be written to the change spool" % (value,))
+
+def _decode_object(obj):
+    """
+    Decode values encoded by _encode_value.
+    """
+    if "__datetime__" in obj and len(obj) == 1:
+        return datetime.fromtimestamp(obj["__datetime__"])
+    return obj
+
+class ChangeSpool(object):
+    """
+    Spool of change records stored as newline delimited json.  Records are only ever
+    appended by the extract stage and are read in order by the apply stage, so the two
+    stages can run at the same time in separate processes.
+
+    The spool is split into numbered segment files.  The extract stage only appends to the
+    latest segment and starts a new one once it gets too big, and the apply stage deletes
+    each older segment once all of its records have been applied.  Each stage keeps its
+    own state file so that either can be restarted on its own.
+
+    Records may be applied more than once if the apply stage is interrupted, so applying a
+    record must be idempotent.
+    """
+
+    SEGMENT_FILE_PATTERN = "changes_%08d.ndjson"
+    EXTRACT_STATE_FILE_NAME = "extract_state.json"
+    APPLY_STATE_FILE_NAME = "apply_state.json"
+
+    # size in bytes after which the extract stage starts a new segment:
+    MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, app, location=None):
+        """
+        Construction
+
+        :param app:         The app bundle that constructed this object
+        :param location:    The directory to store the spool in.  Defaults to a directory in
+                            the app's cache location
+        """
+        self.__app = app
+        if location:
+            self.__location = os.path.expanduser(os.path.expandvars(location))
+        else:
+            self.__location = os.path.join(get_cache_location(self.__app), "change_spool")
+        ensure_folder_exists(self.__location)
+        self.__extract_state_path = os.path.join(self.__location, ChangeSpool.EXTRACT_STATE_FILE_NAME)
+        self.__apply_state_path = os.path.join(self.__location, ChangeSpool.APPLY_STATE_FILE_NAME)
+
+    @property
+    def location(self):
+        """
+        The directory the spool is stored in
+        """
+        return self.__location
+
+    @property
+    def last_extracted_change(self):
+        """
+        The id of the last change that was extracted or 0 if nothing has been extracted
+        """
+        return self.__read_state(self.__extract_state_path).get("last_extracted_change", 0)
+
+    def append(self, record):
+        """
+        Append a change record to the spool.  The record is flushed to disk before this
+        returns.
+
+        :param record:  The json serializable change record
+        """
+        line = json.dumps(record, default=_encode_value, separators=(",", ":"))
+        segment = self.__get_segments()[-1:] or [1]
+        path = self.__segment_path(segment[0])
+        if os.path.exists(path) and os.path.getsize(path) >= ChangeSpool.MAX_SEGMENT_SIZE:
+            path = self.__segment_path(segment[0] + 1)
+        with open(path, "ab+") as f:
+            # make sure a partial record left by an interrupted write isn't joined to this one:
+            f.seek(0, os.SEEK_END)
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != "\n":
+                    line = "\n" + line
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def mark_extracted(self, change_id):
+        """
+        Record that all changes up to and including the specified change have been extracted.
+        """
+        change_id = max(change_id, self.last_extracted_change)
+        self.__write_state(self.__extract_state_path, {"last_extracted_change":change_id})
+
+    def read_pending(self, max_records):
+        """
+        Read the next records that haven't been applied yet.  A partially written record at
+        the end of the spool (e.g. if the extract stage was killed) is ignored.
+
+        :param max_records: The maximum number of records to read
+        :returns list:      List of (position after the record, record) tuples where the
+                            position can be passed to mark_applied
+        """
+        state = self.__read_state(self.__apply_state_path)
+        segments = [s for s in self.__get_segments() if s >= state.get("segment", 0)]
+        offset = state.get("offset", 0) if segments and segments[0] == state.get("segment") else 0
+
+        records = []
+        for segment in segments:
+            with open(self.__segment_path(segment), "rb") as f:
+                f.seek(offset)
+                while len(records) < max_records:
+                    line = f.readline()
+                    if not line.endswith("\n"):
+                        break
+                    offset += len(line)
+                    try:
+                        records.append(((segment, offset), json.loads(line, object_hook=_decode_object)))
+                    except ValueError, e:
+                        self.__app.log_error("Skipping invalid record at offset %d in change spool segment %d: %s"
+                                             % (offset - len(line), segment, e))
+            if len(records) >= max_records:
+                break
+            offset = 0
+        return records
+
+    def mark_applied(self, position):
+        """
+        Record that all records up to the specified position have been applied and delete
+        any segments that are no longer needed.
+
+        :param position:    The position returned by read_pending for the last record applied
+        """
+        segment, offset = position
+        self.__write_state(self.__apply_state_path, {"segment":segment, "offset":offset})
+        for old_segment in self.__get_segments():
+            if old_segment >= segment:
+                break
+            try:
+                os.remove(self.__segment_path(old_segment))
+            except OSError, e:
+                self.__app.log_warning("Failed to remove applied change spool segment %d: %s" % (old_segment, e))
+
+    def __get_segments(self):
+        """
+        Return the numbers of all segments in the spool in order.
+        """
+        segments = []
+        for name in os.listdir(self.__location):
+            prefix, _, suffix = ChangeSpool.SEGMENT_FILE_PATTERN.partition("%08d")
+            if name.startswith(prefix) and name.endswith(suffix):
+                number = name[len(prefix):-len(suffix)]
+                if number.isdigit():
+                    segments.append(int(number))
+        return sorted(segments)
+
+    def __segment_path(self, segment):
+        """
+        Return the path of the specified segment.
+        """
+        return os.path.join(self.__location, ChangeSpool.SEGMENT_FILE_PATTERN % segment)
+
+    def __read_state(self, path):
+        """
+        Read a state file, returning an empty state if there isn't one yet.
+        """
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "rb") as f:
+                return json.load(f)
+        except (IOError, ValueError), e:
+            self.__app.log_warning("Failed to read change spool state '%s': %s" % (path, e))
+            return {}
+
+    def __write_state(self, path, state):
+        """
+        Write a state file, replacing the previous state in a single step.
+        """
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "wb") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.name == "nt" and os.path.exists(path):
+            # rename can't replace an existing file on Windows:
+            os.remove(path)
+        os.rename(tmp_path, path)
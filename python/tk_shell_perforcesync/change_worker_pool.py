@@ -0,0 +1,237 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Pool of worker threads that process changes concurrently, together with the controller
+that decides how many workers should be running
+"""
+
+import time
+import Queue
+import threading
+from collections import deque
+
+import sgtk
+
+p4_fw = sgtk.platform.get_framework("tk-framework-perforce")
+
+class ConcurrencyController(object):
+    """
+    Decide how many change workers should be running from the lag (the number of changes
+    waiting to be synced), the recent per-change latency and the recent error rate.
+
+    - The number of workers is reduced whenever the error rate is too high as this usually
+      means that Perforce or Shotgun is overloaded.
+    - It's increased while there is a backlog of changes to process, unless adding the
+      last worker made changes much slower.
+    - It's reduced once the backlog has drained.
+    """
+
+    # maximum fraction of recent changes that can fail before workers are removed:
+    MAX_ERROR_RATE = 0.2
+
+    # workers are added whilst there are more than this many waiting changes per worker:
+    LAG_PER_WORKER = 2
+
+    # latency increase that means adding the last worker didn't help:
+    LATENCY_INCREASE_LIMIT = 1.5
+
+    # number of recent changes used to calculate the latency and error rate:
+    SAMPLE_SIZE = 50
+
+    def __init__(self, app, min_workers, max_workers):
+        """
+        Construction
+
+        :param app:             The app bundle that constructed this object
+        :param min_workers:     The minimum number of workers
+        :param max_workers:     The maximum number of workers
+        """
+        self.__app = app
+        self.__min_workers = max(1, min_workers)
+        self.__max_workers = max(self.__min_workers, max_workers)
+
+        self.__samples = deque(maxlen=ConcurrencyController.SAMPLE_SIZE)
+        self.__latency_before_scale_up = None
+        self.__last_shotgun_errors = 0
+
+    @property
+    def min_workers(self):
+        """
+        The minimum number of workers
+        """
+        return self.__min_workers
+
+    def record(self, latency, error):
+        """
+        Record the result of processing a change.
+
+        :param latency: The time in seconds it took to process the change
+        :param error:   True if processing the change failed
+        """
+        self.__samples.append((latency, bool(error)))
+
+    def decide(self, num_workers, lag, shotgun_errors):
+        """
+        Decide how many workers should be running.
+
+        :param num_workers:     The number of workers currently running
+        :param lag:             The number of changes waiting to be synced
+        :param shotgun_errors:  The total number of failed Shotgun requests so far
+        :returns int:           The number of workers that should be running
+        """
+        new_shotgun_errors = shotgun_errors - self.__last_shotgun_errors
+        self.__last_shotgun_errors = shotgun_errors
+
+        num_samples = len(self.__samples)
+        latency = (sum(l for l, _ in self.__samples) / num_samples) if num_samples else 0.0
+        num_errors = len([e for _, e in self.__samples if e])
+        error_rate = float(num_errors + new_shotgun_errors) / max(1, num_samples)
+
+        target = num_workers
+        reason = None
+        if error_rate > ConcurrencyController.MAX_ERROR_RATE:
+            target = num_workers - 1
+            reason = "error rate is too high"
+        elif lag > num_workers * ConcurrencyController.LAG_PER_WORKER:
+            if (self.__latency_before_scale_up
+                and latency > self.__latency_before_scale_up * ConcurrencyController.LATENCY_INCREASE_LIMIT):
+                target = num_workers - 1
+                reason = "latency increased after adding a worker"
+            else:
+                target = num_workers + 1
+                reason = "changes are waiting to be synced"
+        elif lag <= num_workers:
+            target = num_workers - 1
+            reason = "backlog has drained"
+
+        target = max(self.__min_workers, min(self.__max_workers, target))
+        if target != num_workers:
+            self.__app.log_info("%s change workers from %d to %d - %s (lag: %d changes, latency: %.2fs, "
+                                "error rate: %.0f%%)" % ("Increasing" if target > num_workers else "Reducing",
+                                                         num_workers, target, reason, lag, latency,
+                                                         error_rate * 100))
+            self.__latency_before_scale_up = latency if target > num_workers else None
+            # start measuring again with the new number of workers:
+            self.__samples.clear()
+        else:
+            self.__app.log_debug("Keeping %d change workers (lag: %d changes, latency: %.2fs, error rate: %.0f%%)"
+                                 % (num_workers, lag, latency, error_rate * 100))
+        return target
+
+class ChangeWorkerPool(object):
+    """
+    Pool of threads that process changes.  The workers share a single ShotgunSync instance
+    so that everything it caches is shared, but each worker has its own Perforce connection.
+    """
+
+    # time in seconds to wait before trying to re-connect to Perforce:
+    RECONNECT_DELAY = 5
+
+    def __init__(self, app, p4_sync, p4_user, p4_pass, process_change):
+        """
+        Construction
+
+        :param app:             The app bundle that constructed this object
+        :param p4_sync:         The ShotgunSync instance used by all workers
+        :param p4_user:         The Perforce user that workers should connect as
+        :param p4_pass:         The Perforce password that workers should connect with
+        :param process_change:  Function called by a worker to process a change with the
+                                signature process_change(p4_sync, p4, p4_change)
+        """
+        self.__app = app
+        self.__p4_sync = p4_sync
+        self.__p4_user = p4_user
+        self.__p4_pass = p4_pass
+        self.__process_change = process_change
+
+        self.__tasks = Queue.Queue()
+        self.__results = Queue.Queue()
+        self.__num_workers = 0
+
+    def __len__(self):
+        """
+        The number of workers in the pool
+        """
+        return self.__num_workers
+
+    def resize(self, num_workers):
+        """
+        Start or stop workers so that the specified number are running.  Workers that are
+        stopped finish the change they are currently processing first.
+
+        :param num_workers: The number of workers that should be running
+        """
+        while self.__num_workers < num_workers:
+            worker = threading.Thread(target=self.__run_worker, name="change_worker_%d" % self.__num_workers)
+            worker.daemon = True
+            worker.start()
+            self.__num_workers += 1
+        while self.__num_workers > num_workers:
+            # each worker stops when it takes one of these from the queue:
+            self.__tasks.put(None)
+            self.__num_workers -= 1
+
+    def submit(self, p4_change):
+        """
+        Queue a change to be processed by the next available worker.
+
+        :param p4_change:   The P4Change to process
+        """
+        self.__tasks.put(p4_change)
+
+    def get_result(self, timeout):
+        """
+        Wait for a worker to finish processing a change.
+
+        :param timeout:     Maximum time in seconds to wait
+        :returns tuple:     (change id, latency, error) or None if no change was finished.  The
+                            change id is None if a worker failed before it could process
+                            the change, in which case the change is processed again later
+        """
+        try:
+            return self.__results.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    def __run_worker(self):
+        """
+        Process changes until told to stop.
+        """
+        p4 = None
+        try:
+            while True:
+                p4_change = self.__tasks.get()
+                if p4_change is None:
+                    return
+
+                if not p4 or not p4.connected():
+                    try:
+                        p4 = p4_fw.connection.connect(False, self.__p4_user, self.__p4_pass, "")
+                    except Exception, e:
+                        # put the change back so that it's picked up once Perforce is back:
+                        self.__app.log_error("Failed to connect to Perforce server: %s" % e)
+                        p4 = None
+                        self.__tasks.put(p4_change)
+                        self.__results.put((None, 0.0, True))
+                        time.sleep(ChangeWorkerPool.RECONNECT_DELAY)
+                        continue
+
+                start_time = time.time()
+                error = False
+                try:
+                    self.__process_change(self.__p4_sync, p4, p4_change)
+                except Exception, e:
+                    self.__app.log_exception("Failed to process change %d" % p4_change.change)
+                    error = True
+                self.__results.put((p4_change.change, time.time() - start_time, error))
+        finally:
+            if p4:
+                p4.disconnect()
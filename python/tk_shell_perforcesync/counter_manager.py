@@ -0,0 +1,206 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Cached access to the Perforce counter that records the last change synced for a project
+"""
+
+import time
+
+import sgtk
+
+p4_fw = sgtk.platform.get_framework("tk-framework-perforce")
+from P4 import P4Exception
+
+class CounterManager(object):
+    """
+    Cache the project counter and coalesce updates to it so that the daemon doesn't need
+    to read and write the counter for every change it processes.
+
+    - The counter is only read from Perforce the first time it's needed and again once
+      another daemon has been found to be processing changes (see invalidate).
+    - Updates are written once enough changes have been processed or enough time has
+      passed since the last write.  Updates are written with a compare-and-set from the 
+      value read just before so that the counter is never moved backwards, even if other
+      daemons write it at the same time.
+
+    If the daemon stops before an update is written then the changes after the counter are
+    processed again when it restarts.  These changes will already have been claimed so all
+    changes between the counter and the most recent change when the counter is first read
+    are treated as a recovery window in which changes that were claimed by this daemon's 
+    previous process are checked for in Shotgun instead of being skipped.
+    """
+
+    # number of times to try writing the counter if other daemons keep changing it:
+    MAX_WRITE_ATTEMPTS = 5
+
+    def __init__(self, app, counter_name, flush_interval, flush_changes):
+        """
+        Construction
+
+        :param app:             The app bundle that constructed this object
+        :param counter_name:    The name of the Perforce counter
+        :param flush_interval:  Maximum time in seconds before an update is written
+        :param flush_changes:   Number of updates after which the counter is written
+        """
+        self.__app = app
+        self.__counter_name = counter_name
+        self.__flush_interval = flush_interval
+        self.__flush_changes = max(1, flush_changes)
+
+        self.__value = None
+        self.__written_value = None
+        self.__num_pending = 0
+        self.__last_flush_time = time.time()
+        self.__recovery_window = None
+
+    @property
+    def name(self):
+        """
+        The name of the Perforce counter
+        """
+        return self.__counter_name
+
+    @property
+    def written_value(self):
+        """
+        The value the counter had when it was last read from or written to Perforce, or None
+        if it hasn't been read yet
+        """
+        return self.__written_value
+
+    def get(self, p4, refresh=False):
+        """
+        Return the value of the counter, including any updates that haven't been written yet.
+
+        :param p4:          The Perforce connection to use
+        :param refresh:     If True then the counter is always read from Perforce
+        :returns int:       The value of the counter or None if it couldn't be read
+        """
+        if self.__value is None or refresh:
+            value = self.__read(p4)
+            if value is None:
+                return None
+            if self.__recovery_window is None:
+                self.__recovery_window = (value, self.__get_head_change(p4) or value)
+                if self.__recovery_window[1] > value:
+                    self.__app.log_debug("Changes %d - %d will be checked for in Shotgun if they have already "
+                                         "been claimed" % (value + 1, self.__recovery_window[1]))
+            self.__written_value = value
+            self.__value = max(value, self.__value or 0)
+        return self.__value
+
+    def in_recovery_window(self, change_id):
+        """
+        Determine if the specified change was submitted before the counter was first read, so
+        if it has already been claimed it may have been claimed by this daemon before it was
+        restarted and not recorded in the counter.  Use ChangeClaim.is_own_claim to check
+        who claimed it.
+
+        :param change_id:   The id of the change to check
+        :returns bool:      True if the change is in the recovery window
+        """
+        return (self.__recovery_window is not None
+                and self.__recovery_window[0] < change_id <= self.__recovery_window[1])
+
+    def invalidate(self, p4):
+        """
+        Make sure the counter is read from Perforce the next time it's needed, e.g. because
+        another daemon has been found to be processing changes.  Any pending update is
+        written first.
+
+        :param p4:  The Perforce connection to use
+        """
+        self.flush(p4)
+        if not self.__num_pending:
+            self.__value = None
+
+    def advance(self, p4, change_id):
+        """
+        Record that all changes up to the specified change have been processed, writing the
+        counter if an update is due.
+
+        :param p4:          The Perforce connection to use
+        :param change_id:   The id of the change to move the counter to
+        """
+        if self.__value is not None and change_id <= self.__value:
+            return
+        self.__value = change_id
+        self.__num_pending += 1
+        if (self.__num_pending >= self.__flush_changes
+            or time.time() - self.__last_flush_time >= self.__flush_interval):
+            self.flush(p4)
+
+    def flush(self, p4):
+        """
+        Write any pending update to the counter.  If the counter has been moved further on
+        by something else since it was last read then it isn't moved backwards.
+
+        :param p4:  The Perforce connection to use
+        """
+        self.__last_flush_time = time.time()
+        if not self.__num_pending:
+            return
+
+        for _ in range(CounterManager.MAX_WRITE_ATTEMPTS):
+            current_value = self.__read(p4)
+            if current_value is None:
+                # try again next time:
+                return
+            if current_value != self.__written_value:
+                self.__app.log_debug("Perforce counter '%s' was changed to %d by another process"
+                                     % (self.__counter_name, current_value))
+                self.__written_value = current_value
+            if current_value >= self.__value:
+                self.__value = current_value
+                break
+
+            self.__app.log_debug("Updating the Perforce counter '%s' to %s" % (self.__counter_name, self.__value))
+            try:
+                # only update the counter if nothing else has changed it since it was read:
+                p4.run_counter("--from=%d" % current_value, "--to=%d" % self.__value, self.__counter_name)
+                break
+            except P4Exception, e:
+                error = p4.errors[0] if p4.errors else e
+            except Exception, e:
+                error = e
+        else:
+            self.__app.log_error("Failed to update Perforce counter '%s' - %s" % (self.__counter_name, error))
+            return
+
+        self.__written_value = self.__value
+        self.__num_pending = 0
+
+    def __read(self, p4):
+        """
+        Read the counter from Perforce.
+
+        :returns int:   The value of the counter or None if it couldn't be read
+        """
+        try:
+            p4_res = p4.run_counter(self.__counter_name)
+            return int(p4_res[0]["value"]) if p4_res else 0
+        except P4Exception, e:
+            self.__app.log_error("Failed to retrieve Perforce counter '%s' - %s"
+                                 % (self.__counter_name, (p4.errors[0] if p4.errors else e)))
+        except Exception, e:
+            self.__app.log_error("Failed to retrieve Perforce counter '%s' - %s" % (self.__counter_name, e))
+
+    def __get_head_change(self, p4):
+        """
+        Return the most recently submitted change or None if it couldn't be found.
+        """
+        try:
+            p4_res = p4.run_changes("-m", "1", "-s", "submitted")
+            return int(p4_res[0]["change"]) if p4_res else 0
+        except P4Exception, e:
+            self.__app.log_warning("Failed to find the most recent change: %s" % (p4.errors[0] if p4.errors else e))
+        except Exception, e:
+            self.__app.log_warning("Failed to find the most recent change: %s" % e)
@@ -0,0 +1,99 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Local index, shared between all daemons running on the same machine, recording which
+Toolkit projects each Perforce change touches
+"""
+
+import os
+import sqlite3
+import threading
+
+from .util import ensure_folder_exists
+
+class MembershipIndex(object):
+    """
+    SQLite backed index of {change:project ids}.  The first daemon to classify a change
+    records the projects it touches (which may be none) so that daemons running for other
+    projects can skip it without describing it again.
+    """
+
+    INDEX_FILE_NAME = "change_membership.db"
+
+    def __init__(self, app, location):
+        """
+        Construction
+
+        :param app:         The app bundle that constructed this object
+        :param location:    The shared directory to store the index in
+        """
+        self.__app = app
+        ensure_folder_exists(location)
+        self.__path = os.path.join(location, MembershipIndex.INDEX_FILE_NAME)
+
+        # sqlite connections can't be shared between threads:
+        self.__local = threading.local()
+
+    def lookup(self, server, change_id):
+        """
+        Look up the projects that a change touches.
+
+        :param server:      The Perforce server (P4PORT) the change was submitted to
+        :param change_id:   The id of the change
+        :returns set:       The set of project ids the change touches or None if the change
+                            hasn't been classified yet
+        """
+        try:
+            row = self.__connection().execute("SELECT projects FROM change_membership "
+                                              "WHERE server = ? AND change = ?",
+                                              (server, int(change_id))).fetchone()
+        except sqlite3.Error, e:
+            self.__app.log_warning("Failed to query change membership index '%s': %s" % (self.__path, e))
+            return None
+
+        if row is None:
+            return None
+        return set(int(project_id) for project_id in row[0].split(",") if project_id)
+
+    def record(self, server, change_id, project_ids):
+        """
+        Record the projects that a change touches.  If the change has already been
+        recorded then the existing entry is kept.
+
+        :param server:      The Perforce server (P4PORT) the change was submitted to
+        :param change_id:   The id of the change
+        :param project_ids: The set of project ids the change touches
+        """
+        projects = ",".join(str(project_id) for project_id in sorted(project_ids))
+        try:
+            connection = self.__connection()
+            with connection:
+                connection.execute("INSERT OR IGNORE INTO change_membership (server, change, projects) "
+                                   "VALUES (?, ?, ?)", (server, int(change_id), projects))
+        except sqlite3.Error, e:
+            self.__app.log_warning("Failed to update change membership index '%s': %s" % (self.__path, e))
+
+    def __connection(self):
+        """
+        Return the connection to the index for the current thread, creating it if needed.
+        """
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.__path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS change_membership ("
+                                   "server TEXT NOT NULL, "
+                                   "change INTEGER NOT NULL, "
+                                   "projects TEXT NOT NULL, "
+                                   "PRIMARY KEY (server, change))")
+            self.__local.connection = connection
+        return connection
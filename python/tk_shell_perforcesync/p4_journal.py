@@ -0,0 +1,321 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Offline access to the change, file revision and counter records stored in a Perforce
+checkpoint or journal file so that historical changes can be synced without querying
+the Perforce server
+"""
+
+import os
+import re
+import sys
+import gzip
+import sqlite3
+import hashlib
+
+from sgtk import TankError
+
+from .util import get_cache_location
+
+# journal fields are either @-quoted strings (with embedded @'s doubled) or bare values:
+_FIELD_RE = re.compile(r"@((?:[^@]|@@)*)@|(\S+)")
+
+# db.rev actions:
+_REV_ACTIONS = {0:"add", 1:"edit", 2:"delete", 3:"branch", 4:"integrate", 5:"import", 6:"purge",
+                7:"move/add", 8:"move/delete", 9:"archive"}
+_DELETED_ACTIONS = set(["delete", "move/delete", "purge", "archive"])
+
+# journal operations that put or replace a record and that delete a record:
+_PUT_OPERATIONS = set(["pv", "rv"])
+_DELETE_OPERATIONS = set(["dv"])
+
+# db.change status:
+_CHANGE_STATUSES = {0:"pending", 1:"submitted", 2:"shelved"}
+
+def read_journal(path):
+    """
+    Read the records from a checkpoint or journal file.
+
+    :param path:    The path of the file to read, optionally gzip compressed
+    :returns:       Generator yielding (operation, table, fields) for each record, e.g.
+                    ('pv', 'db.change', ['37', '37', 'client', ...])
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        record = ""
+        for line in f:
+            record += line
+            # a record is complete once all quoted fields are closed - escaped @'s come in
+            # pairs so the number of @'s in a complete record is always even:
+            if record.count("@") % 2:
+                continue
+            fields = [quoted.replace("@@", "@") if bare is None or bare == "" else bare
+                      for quoted, bare in _FIELD_RE.findall(record)]
+            record = ""
+            if len(fields) < 3:
+                continue
+            yield (fields[0], fields[2], fields[3:])
+
+class JournalDepot(object):
+    """
+    Local SQLite copy of the change, file revision and counter tables from one or more
+    checkpoint or journal files.  The first file should be a checkpoint with any journals
+    applied on top in order.
+    """
+
+    def __init__(self, app, paths):
+        """
+        Construction
+
+        :param app:     The app bundle that constructed this object
+        :param paths:   The checkpoint and journal files to read, in order
+        """
+        self.__app = app
+        self.__paths = [os.path.abspath(p) for p in paths]
+
+        key = hashlib.sha1("|".join(self.__paths)).hexdigest()[:12]
+        self.__db_path = os.path.join(get_cache_location(self.__app), "journal_%s.db" % key)
+        self.__connection = None
+
+    @property
+    def name(self):
+        """
+        A name identifying the files this depot was read from
+        """
+        return "journal:%s" % ",".join(self.__paths)
+
+    def load(self):
+        """
+        Read all records from the checkpoint and journal files, unless they have already
+        been read and haven't been modified since.
+        """
+        for path in self.__paths:
+            if not os.path.exists(path):
+                raise TankError("Checkpoint or journal file '%s' does not exist!" % path)
+
+        connection = self.connection()
+        signature = ";".join("%s:%d:%d" % (p, os.path.getsize(p), os.path.getmtime(p)) for p in self.__paths)
+        row = connection.execute("SELECT value FROM meta WHERE name = 'signature'").fetchone()
+        if row and row[0] == signature:
+            self.__app.log_info("Using previously loaded journal data from '%s'" % self.__db_path)
+            return
+
+        with connection:
+            for table in ["changes", "descs", "revs", "counters", "meta"]:
+                connection.execute("DELETE FROM %s" % table)
+
+        for path in self.__paths:
+            self.__app.log_info("Reading Perforce records from '%s'..." % path)
+            num_records = 0
+            with connection:
+                for operation, table, fields in read_journal(path):
+                    if self.__apply(connection, operation, table, fields):
+                        num_records += 1
+            self.__app.log_info("Read %d change, file revision and counter records" % num_records)
+
+        with connection:
+            connection.execute("INSERT INTO meta (name, value) VALUES ('signature', ?)", (signature,))
+
+    def connection(self):
+        """
+        Return the connection to the local database, creating it if needed.
+        """
+        if self.__connection is None:
+            connection = sqlite3.connect(self.__db_path)
+            connection.text_factory = str
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS changes (change INTEGER PRIMARY KEY, "
+                                   "desc_key INTEGER, client TEXT, user TEXT, time INTEGER, status INTEGER, "
+                                   "description TEXT)")
+                connection.execute("CREATE TABLE IF NOT EXISTS descs (desc_key INTEGER PRIMARY KEY, description TEXT)")
+                connection.execute("CREATE TABLE IF NOT EXISTS revs (depot_file TEXT, rev INTEGER, type TEXT, "
+                                   "action INTEGER, change INTEGER, mod_time INTEGER, digest TEXT, size INTEGER, "
+                                   "PRIMARY KEY (depot_file, rev))")
+                connection.execute("CREATE INDEX IF NOT EXISTS revs_change ON revs (change)")
+                connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value TEXT)")
+                connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            self.__connection = connection
+        return self.__connection
+
+    def find_config_roots(self, config_location):
+        """
+        Find all depot directories that contain a Toolkit configuration back-mapping file.
+
+        :param config_location: The location of the file relative to the project root
+        :returns list:          The depot project roots
+        """
+        suffix = "/%s" % config_location
+        rows = self.connection().execute("SELECT DISTINCT depot_file FROM revs WHERE substr(depot_file, -?) = ?",
+                                         (len(suffix), suffix)).fetchall()
+        return sorted(row[0][:-len(suffix)] for row in rows)
+
+    def get_counter(self, name):
+        """
+        Return the value of a counter or None if it isn't set.
+        """
+        row = self.connection().execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def get_change_range(self):
+        """
+        Return the (first, last) submitted change ids or (0, 0) if there are none.
+        """
+        row = self.connection().execute("SELECT min(change), max(change) FROM changes WHERE status = 1").fetchone()
+        return (row[0] or 0, row[1] or 0)
+
+    def __apply(self, connection, operation, table, fields):
+        """
+        Apply a single journal record to the local database.
+
+        :returns bool:  True if the record was for one of the tables that are kept
+        """
+        if operation not in _PUT_OPERATIONS and operation not in _DELETE_OPERATIONS:
+            return False
+        try:
+            if table == "db.change":
+                if operation in _DELETE_OPERATIONS:
+                    connection.execute("DELETE FROM changes WHERE change = ?", (int(fields[0]),))
+                else:
+                    connection.execute("INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                       (int(fields[0]), int(fields[1]), fields[2], fields[3], int(fields[4]),
+                                        int(fields[5]), fields[6]))
+            elif table == "db.desc":
+                if operation in _DELETE_OPERATIONS:
+                    connection.execute("DELETE FROM descs WHERE desc_key = ?", (int(fields[0]),))
+                else:
+                    connection.execute("INSERT OR REPLACE INTO descs VALUES (?, ?)", (int(fields[0]), fields[1]))
+            elif table == "db.rev":
+                if operation in _DELETE_OPERATIONS:
+                    connection.execute("DELETE FROM revs WHERE depot_file = ? AND rev = ?", (fields[0], int(fields[1])))
+                else:
+                    connection.execute("INSERT OR REPLACE INTO revs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                       (fields[0], int(fields[1]), fields[2], int(fields[3]), int(fields[4]),
+                                        int(fields[6]), fields[7], int(fields[8])))
+            elif table == "db.counters":
+                if operation in _DELETE_OPERATIONS:
+                    connection.execute("DELETE FROM counters WHERE name = ?", (fields[0],))
+                else:
+                    connection.execute("INSERT OR REPLACE INTO counters VALUES (?, ?)", (fields[0], fields[1]))
+            else:
+                return False
+        except (IndexError, ValueError), e:
+            self.__app.log_warning("Skipping invalid '%s' record: %s" % (table, e))
+            return False
+        return True
+
+class OfflineP4(object):
+    """
+    Read-only stand-in for a Perforce connection that answers the queries made by
+    ShotgunSync from a JournalDepot instead of the Perforce server.
+
+    Only the specified project root is treated as a Toolkit project and it is mapped to
+    the local pipeline configuration root as the contents of the configuration file aren't
+    stored in the journal.
+    """
+
+    def __init__(self, depot, project_root, pc_root, config_location):
+        """
+        Construction
+
+        :param depot:               The JournalDepot to read from
+        :param project_root:        The depot root of the project being synced
+        :param pc_root:             The local pipeline configuration root for the project
+        :param config_location:     The location of the configuration back-mapping file
+                                    relative to the project root
+        """
+        self.__depot = depot
+        self.__config_path = "%s/%s" % (project_root.rstrip("/"), config_location)
+        self.__pc_root = pc_root
+        self.port = depot.name
+        self.errors = []
+
+    def connected(self):
+        return True
+
+    def disconnect(self):
+        pass
+
+    def run_describe(self, *args):
+        """
+        Return the description of one or more changes in the same form as 'p4 describe'.
+        """
+        change_ids = []
+        for arg in args:
+            change_ids.extend(arg if isinstance(arg, (list, tuple)) else [arg])
+
+        connection = self.__depot.connection()
+        results = []
+        for change_id in change_ids:
+            row = connection.execute("SELECT c.change, c.client, c.user, c.time, c.status, "
+                                     "coalesce(d.description, c.description) "
+                                     "FROM changes c LEFT JOIN descs d ON d.desc_key = c.desc_key "
+                                     "WHERE c.change = ?", (int(change_id),)).fetchone()
+            if not row:
+                continue
+            change, client, user, time, status, desc = row
+            revs = connection.execute("SELECT depot_file, rev, action, type, digest, size FROM revs "
+                                      "WHERE change = ? ORDER BY depot_file", (change,)).fetchall()
+            depot_files = [r[0] for r in revs]
+            results.append({"change":str(change),
+                            "client":client,
+                            "user":user,
+                            "time":str(time),
+                            "status":_CHANGE_STATUSES.get(status, "pending"),
+                            "desc":desc,
+                            "path":"%s/..." % os.path.commonprefix(depot_files).rsplit("/", 1)[0] if depot_files else "",
+                            "depotFile":depot_files,
+                            "rev":[str(r[1]) for r in revs],
+                            "action":[_REV_ACTIONS.get(r[2], "edit") for r in revs],
+                            "type":[r[3] for r in revs],
+                            "digest":[r[4] for r in revs],
+                            "fileSize":[str(r[5]) for r in revs]})
+        return results
+
+    def run_fstat(self, *args):
+        """
+        Return the file revisions submitted in a change ('-e <change>') in the same form
+        as 'p4 fstat', excluding deleted revisions.  Other arguments are ignored.
+        """
+        args = list(args)
+        if "-e" not in args:
+            raise TankError("Offline fstat only supports querying the files in a change")
+        change_id = int(args[args.index("-e") + 1])
+        rows = self.__depot.connection().execute("SELECT depot_file, rev, action, mod_time FROM revs "
+                                                 "WHERE change = ?", (change_id,)).fetchall()
+        return [{"depotFile":depot_file, "headRev":str(rev), "headModTime":str(mod_time)}
+                for depot_file, rev, action, mod_time in rows
+                if _REV_ACTIONS.get(action) not in _DELETED_ACTIONS]
+
+    def run_files(self, path):
+        """
+        Return the head revision of a file in the same form as 'p4 files' if it exists.
+        Only the configuration file of the project being synced is reported as existing.
+        """
+        if path != self.__config_path:
+            return []
+        row = self.__depot.connection().execute("SELECT rev, change FROM revs WHERE depot_file = ? "
+                                                "ORDER BY rev DESC LIMIT 1", (path,)).fetchone()
+        if not row:
+            return []
+        return [{"depotFile":path, "rev":str(row[0]), "change":str(row[1])}]
+
+    def run_print(self, path):
+        """
+        Return the contents of the project configuration file in the same form as 'p4 print'.
+        The file contents aren't stored in the journal so a configuration that maps all
+        platforms to the local pipeline configuration root is returned.
+        """
+        p4_res = self.run_files(path)
+        if not p4_res:
+            return []
+        return [p4_res[0], "- {%s: '%s'}\n" % (sys.platform, self.__pc_root)]
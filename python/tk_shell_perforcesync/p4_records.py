@@ -0,0 +1,181 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Compact typed records for the Perforce changes and file revisions handled by the sync.
+These are built once from the P4 results so that values are only parsed once and large
+changes don't need a dictionary (or list of strings) per file.
+"""
+
+from array import array
+from datetime import datetime
+
+def _to_int(value, default=0):
+    """
+    Convert a value returned by Perforce to an int, returning the default if it isn't set
+    or isn't a number.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+class P4FileTable(object):
+    """
+    Columnar table of the files in a change as returned by 'p4 describe'.  Numeric columns
+    are stored in arrays and repeated strings (actions and file types) are interned.
+    """
+
+    __slots__ = ("depot_files", "revisions", "actions", "types", "digests", "file_sizes")
+
+    def __init__(self, depot_files=None, revisions=None, actions=None, types=None, digests=None,
+                 file_sizes=None):
+        """
+        Construction
+
+        :param depot_files: List of depot paths
+        :param revisions:   List of revisions, one per depot path
+        :param actions:     List of actions, e.g. 'edit'
+        :param types:       List of file types, e.g. 'text'
+        :param digests:     List of file digests
+        :param file_sizes:  List of file sizes, -1 where the size isn't known
+        """
+        self.depot_files = list(depot_files or [])
+        num_files = len(self.depot_files)
+        self.revisions = array("l", [_to_int(r) for r in (revisions or [])[:num_files]])
+        self.actions = [intern(str(a)) for a in (actions or [])[:num_files]]
+        self.types = [intern(str(t)) for t in (types or [])[:num_files]]
+        self.digests = list((digests or [])[:num_files])
+        self.file_sizes = array("l", [_to_int(s, -1) for s in (file_sizes or [])[:num_files]])
+
+    def __len__(self):
+        return len(self.depot_files)
+
+    def __iter__(self):
+        """
+        Iterate over the depot paths of the files in the table.
+        """
+        return iter(self.depot_files)
+
+class P4Change(object):
+    """
+    A submitted Perforce change as returned by 'p4 describe'
+    """
+
+    __slots__ = ("change", "status", "user", "client", "time", "desc", "path", "files")
+
+    def __init__(self, change, status, user, client, time, desc, path="", files=None):
+        """
+        Construction
+
+        :param change:  The change id
+        :param status:  The status of the change, e.g. 'submitted'
+        :param user:    The Perforce user that submitted the change
+        :param client:  The workspace the change was submitted from
+        :param time:    The time the change was submitted in seconds since the epoch
+        :param desc:    The change description
+        :param path:    The common path of all files in the change, e.g. '//depot/a/...'
+        :param files:   The P4FileTable of files in the change
+        """
+        self.change = change
+        self.status = status
+        self.user = user
+        self.client = client
+        self.time = time
+        self.desc = desc
+        self.path = path
+        self.files = files if files is not None else P4FileTable()
+
+    @classmethod
+    def from_describe(cls, p4_res):
+        """
+        Create a P4Change from a single result returned by 'p4 describe'.
+
+        :param p4_res:      The describe result dictionary
+        :returns P4Change:  The new change record
+        """
+        files = P4FileTable(p4_res.get("depotFile"), p4_res.get("rev"), p4_res.get("action"),
+                            p4_res.get("type"), p4_res.get("digest"), p4_res.get("fileSize"))
+        return cls(_to_int(p4_res.get("change")), p4_res.get("status", ""), p4_res.get("user", ""),
+                   p4_res.get("client", ""), _to_int(p4_res.get("time")), p4_res.get("desc", ""),
+                   p4_res.get("path", ""), files)
+
+    @property
+    def is_submitted(self):
+        """
+        True if this is a submitted change
+        """
+        return self.status == "submitted"
+
+    @property
+    def common_directory(self):
+        """
+        The deepest directory that contains all files in the change, taken from the
+        common path returned by describe, or an empty string if this isn't known
+        """
+        path = self.path or ""
+        for wildcard in ["*", "..."]:
+            index = path.find(wildcard)
+            if index >= 0:
+                path = path[:index]
+        # anything after the last separator is a file name or partial directory name:
+        return path[:path.rfind("/")].rstrip("/") if "/" in path else ""
+
+    @property
+    def submitted_at(self):
+        """
+        The time the change was submitted as a datetime
+        """
+        return datetime.fromtimestamp(self.time)
+
+    def __repr__(self):
+        return "<P4Change %d (%s) by %s, %d file(s)>" % (self.change, self.status, self.user, len(self.files))
+
+class P4FileRevision(object):
+    """
+    A file revision as returned by 'p4 fstat'
+    """
+
+    __slots__ = ("depot_file", "revision", "head_mod_time")
+
+    def __init__(self, depot_file, revision, head_mod_time=0):
+        """
+        Construction
+
+        :param depot_file:      The depot path of the file
+        :param revision:        The revision of the file
+        :param head_mod_time:   The modification time of the revision in seconds since the
+                                epoch, 0 if not known
+        """
+        self.depot_file = depot_file
+        self.revision = revision
+        self.head_mod_time = head_mod_time
+
+    @classmethod
+    def from_fstat(cls, p4_res):
+        """
+        Create a P4FileRevision from a single result returned by 'p4 fstat'.
+
+        :param p4_res:              The fstat result dictionary
+        :returns P4FileRevision:    The new file revision record or None if the result
+                                    doesn't contain a depot path and head revision
+        """
+        depot_file = p4_res.get("depotFile")
+        revision = _to_int(p4_res.get("headRev"))
+        if not depot_file or not revision:
+            return None
+        return cls(depot_file, revision, _to_int(p4_res.get("headModTime")))
+
+    @property
+    def path_revision(self):
+        """
+        The (depot path, revision) tuple for this file revision
+        """
+        return (self.depot_file, self.revision)
@@ -0,0 +1,125 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Pool of worker processes that match depot paths against Toolkit templates and build
+contexts for them, so that this CPU bound work can use more than one core for changes
+that contain a very large number of files
+"""
+
+import os
+import sys
+import multiprocessing
+
+import sgtk
+
+# tk instances owned by the current worker process, keyed by pipeline configuration root:
+_worker_tk_instances = {}
+
+def _get_worker_tk(pc_root):
+    """
+    Return the tk instance for the specified pipeline configuration in the current worker
+    process, creating it the first time it's needed.
+    """
+    tk = _worker_tk_instances.get(pc_root)
+    if not tk:
+        tk = sgtk.sgtk_from_path(pc_root)
+        _worker_tk_instances[pc_root] = tk
+    return tk
+
+def _resolve_paths(task):
+    """
+    Resolve a chunk of paths in a worker process.
+
+    :param task:    Tuple of (template pc root, context pc root, list of project root relative
+                    paths)
+    :returns list:  List of (valid, serialized context) tuples in the same order as the paths
+    """
+    template_pc_root, context_pc_root, relative_paths = task
+    tk = _get_worker_tk(template_pc_root)
+    context_tk = _get_worker_tk(context_pc_root)
+
+    results = []
+    for relative_path in relative_paths:
+        template = None
+        for data_root in tk.roots.values():
+            proxy_local_path = os.path.join(data_root, relative_path)
+            try:
+                template = tk.template_from_path(proxy_local_path)
+                if template:
+                    break
+            except:
+                pass
+        if not template:
+            results.append((False, None))
+            continue
+
+        context = context_tk.context_from_path(proxy_local_path)
+        results.append((True, sgtk.context.serialize(context) if context else None))
+    return results
+
+class PathResolverPool(object):
+    """
+    Runs template matching and context construction for depot paths across a pool of
+    worker processes.  Each worker keeps its own tk instances, built the first time it sees
+    each pipeline configuration root, for as long as the pool is running.  The workers are
+    stopped automatically when the process exits.
+
+    The workers are forked from the current process so this is only available on
+    platforms that support fork.
+    """
+
+    # number of paths sent to a worker at a time:
+    CHUNK_SIZE = 250
+
+    def __init__(self, app, num_processes):
+        """
+        Construction
+
+        :param app:             The app bundle that constructed this object
+        :param num_processes:   The number of worker processes to run
+        """
+        self.__app = app
+        self.__num_processes = num_processes
+        self.__pool = None
+
+    @staticmethod
+    def is_supported():
+        """
+        Determine if worker processes can be used on this platform.
+        """
+        return sys.platform != "win32"
+
+    def resolve(self, items):
+        """
+        Match each path against the templates and build a context for it.
+
+        :param items:   List of (template pc root, context pc root, project root relative path)
+                        tuples
+        :returns list:  List of (valid, serialized context) tuples in the same order as the
+                        items.  Contexts can be restored with sgtk.context.deserialize
+        """
+        # group consecutive paths for the same pipeline configurations into chunks:
+        tasks = []
+        for template_pc_root, context_pc_root, relative_path in items:
+            if (not tasks or tasks[-1][0] != template_pc_root or tasks[-1][1] != context_pc_root
+                or len(tasks[-1][2]) >= PathResolverPool.CHUNK_SIZE):
+                tasks.append((template_pc_root, context_pc_root, []))
+            tasks[-1][2].append(relative_path)
+
+        if not self.__pool:
+            self.__app.log_debug("Starting %d path resolver processes..." % self.__num_processes)
+            self.__pool = multiprocessing.Pool(self.__num_processes)
+
+        # map returns the results in the same order as the tasks:
+        results = []
+        for chunk_results in self.__pool.map(_resolve_paths, tasks, 1):
+            results.extend(chunk_results)
+        return results
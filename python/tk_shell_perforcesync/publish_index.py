@@ -0,0 +1,253 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Local index of the published files in a project, kept up to date by tailing the Shotgun
+event log
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+import sgtk
+
+from .util import get_cache_location
+from .shotgun_scheduler import get_shotgun_scheduler
+from .publish_resolver import depot_path_from_entity
+
+class PublishIndex(object):
+    """
+    SQLite backed index of {(depot path, revision):published file id} for the current
+    project.
+
+    The index is bootstrapped by reading all published files in the project and is then
+    kept current by reading the EventLogEntry records for published files that have been
+    created, changed, retired or revived since the last update.  The id of the last event
+    read is stored with the index so that tailing resumes where it left off after a
+    restart.  The event log is read at most once per update interval so publishes that
+    are registered by other processes may not be found until the next update.
+    """
+
+    INDEX_FILE_NAME = "publish_index.db"
+
+    # number of published files to read at a time when bootstrapping:
+    BOOTSTRAP_PAGE_SIZE = 5000
+
+    # maximum number of events to read in a single request:
+    EVENT_PAGE_SIZE = 500
+
+    def __init__(self, app, update_interval=0):
+        """
+        Construction
+
+        :param app:             The app bundle that constructed this object
+        :param update_interval: The minimum time in seconds between reads of the event log.
+                                Updates within this time of the last one do nothing
+        """
+        self.__app = app
+        self.__update_interval = update_interval
+        self.__last_update_time = None
+        self.__update_lock = threading.Lock()
+        self.__shotgun = get_shotgun_scheduler(self.__app)
+        self.__pf_entity_type = sgtk.util.get_published_file_entity_type(self.__app.sgtk)
+        self.__path = os.path.join(get_cache_location(self.__app), PublishIndex.INDEX_FILE_NAME)
+
+        # sqlite connections can't be shared between threads:
+        self.__local = threading.local()
+
+    def update(self):
+        """
+        Bring the index up to date, bootstrapping it first if needed.
+
+        :returns bool:  True if the index is up to date, False if it couldn't be updated
+                        and shouldn't be relied on
+        """
+        with self.__update_lock:
+            update_time = time.time()
+            if (self.__last_update_time is not None
+                and update_time - self.__last_update_time < self.__update_interval):
+                # updated recently enough:
+                return True
+            try:
+                cursor = self.__get_cursor()
+                if cursor is None:
+                    self.__bootstrap()
+                else:
+                    self.__tail_events(cursor)
+            except sqlite3.Error, e:
+                self.__app.log_warning("Failed to update the published file index '%s': %s" % (self.__path, e))
+                return False
+            except Exception, e:
+                self.__app.log_warning("Failed to read published file events from Shotgun: %s" % e)
+                return False
+            self.__last_update_time = update_time
+            return True
+
+    def lookup(self, path_revisions):
+        """
+        Look up the published files for the specified depot file revisions.
+
+        :param path_revisions:  List of (depot path, revision) tuples to look up
+        :returns dict:          Dictionary of {(depot path, revision):entity} for all
+                                revisions found in the index
+        """
+        found = {}
+        try:
+            connection = self.__connection()
+            for depot_path, revision in path_revisions:
+                row = connection.execute("SELECT entity_id FROM publishes WHERE depot_path = ? AND revision = ?",
+                                         (depot_path, int(revision))).fetchone()
+                if row:
+                    found[(depot_path, int(revision))] = {"type":self.__pf_entity_type, "id":row[0]}
+        except sqlite3.Error, e:
+            self.__app.log_warning("Failed to query the published file index '%s': %s" % (self.__path, e))
+        return found
+
+    def add(self, depot_path, revision, entity):
+        """
+        Add a published file to the index, e.g. once it's been registered.
+
+        :param depot_path:  The depot path of the published file
+        :param revision:    The revision of the published file
+        :param entity:      The published file entity
+        """
+        try:
+            connection = self.__connection()
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO publishes (depot_path, revision, entity_id) "
+                                   "VALUES (?, ?, ?)", (depot_path, int(revision), entity["id"]))
+        except sqlite3.Error, e:
+            self.__app.log_warning("Failed to update the published file index '%s': %s" % (self.__path, e))
+
+    def __bootstrap(self):
+        """
+        Populate the index with all published files in the project.
+        """
+        # find the most recent event before reading the publishes so that nothing that
+        # changes whilst they're being read gets missed:
+        sg_event = self.__shotgun.find_one("EventLogEntry", [], ["id"],
+                                           order=[{"field_name":"id", "direction":"desc"}])
+        cursor = sg_event["id"] if sg_event else 0
+
+        self.__app.log_info("Building local index of published files...")
+        count = 0
+        last_id = 0
+        while True:
+            # page through using the id so that new publishes don't affect the paging:
+            sg_res = self.__shotgun.find(self.__pf_entity_type,
+                                         [["project", "is", self.__app.context.project],
+                                          ["id", "greater_than", last_id]],
+                                         ["id", "path", "version_number"],
+                                         order=[{"field_name":"id", "direction":"asc"}],
+                                         limit=PublishIndex.BOOTSTRAP_PAGE_SIZE)
+            if not sg_res:
+                break
+            last_id = sg_res[-1]["id"]
+            connection = self.__connection()
+            with connection:
+                count += self.__store_entities(sg_res, connection)
+
+        connection = self.__connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('cursor', ?)", (cursor,))
+        self.__app.log_info("Indexed %d published file(s)" % count)
+
+    def __tail_events(self, cursor):
+        """
+        Apply all published file events since the specified event id to the index.
+        """
+        event_types = ["Shotgun_%s_%s" % (self.__pf_entity_type, event)
+                       for event in ["New", "Change", "Retirement", "Revival"]]
+        while True:
+            sg_events = self.__shotgun.find("EventLogEntry",
+                                            [["id", "greater_than", cursor],
+                                             ["event_type", "in", event_types],
+                                             ["project", "is", self.__app.context.project]],
+                                            ["id", "entity", "meta"],
+                                            order=[{"field_name":"id", "direction":"asc"}],
+                                            limit=PublishIndex.EVENT_PAGE_SIZE)
+            if not sg_events:
+                return
+
+            # the entity link is empty for retired entities so use the id stored in the meta data:
+            entity_ids = set()
+            for sg_event in sg_events:
+                entity_id = (sg_event.get("meta") or {}).get("entity_id") or (sg_event.get("entity") or {}).get("id")
+                if entity_id:
+                    entity_ids.add(entity_id)
+
+            # re-read the current state of every entity that changed - any that aren't
+            # found have been retired:
+            sg_res = []
+            if entity_ids:
+                sg_res = self.__shotgun.find(self.__pf_entity_type,
+                                             [["id", "in", list(entity_ids)]],
+                                             ["id", "path", "version_number"])
+            retired_ids = entity_ids - set(sg_entity["id"] for sg_entity in sg_res)
+
+            cursor = sg_events[-1]["id"]
+            connection = self.__connection()
+            with connection:
+                connection.executemany("DELETE FROM publishes WHERE entity_id = ?",
+                                       [(entity_id,) for entity_id in entity_ids])
+                self.__store_entities(sg_res, connection)
+                connection.execute("UPDATE meta SET value = max(value, ?) WHERE name = 'cursor'", (cursor,))
+
+            self.__app.log_debug("Applied %d published file event(s) to the local index (%d retired)"
+                                 % (len(sg_events), len(retired_ids)))
+            if len(sg_events) < PublishIndex.EVENT_PAGE_SIZE:
+                return
+
+    def __store_entities(self, sg_entities, connection):
+        """
+        Store the depot path and revision of the specified published file entities using
+        the connection's current transaction.
+
+        :returns int:   The number of entities stored
+        """
+        rows = []
+        for sg_entity in sg_entities:
+            path_and_version = depot_path_from_entity(sg_entity)
+            if not path_and_version:
+                continue
+            rows.append((path_and_version[0], sg_entity.get("version_number") or path_and_version[1],
+                         sg_entity["id"]))
+        connection.executemany("INSERT OR REPLACE INTO publishes (depot_path, revision, entity_id) "
+                               "VALUES (?, ?, ?)", rows)
+        return len(rows)
+
+    def __get_cursor(self):
+        """
+        Return the id of the last event applied to the index or None if the index hasn't
+        been bootstrapped yet.
+        """
+        row = self.__connection().execute("SELECT value FROM meta WHERE name = 'cursor'").fetchone()
+        return int(row[0]) if row else None
+
+    def __connection(self):
+        """
+        Return the connection to the index for the current thread, creating it if needed.
+        """
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.__path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS publishes ("
+                                   "depot_path TEXT NOT NULL, "
+                                   "revision INTEGER NOT NULL, "
+                                   "entity_id INTEGER NOT NULL, "
+                                   "PRIMARY KEY (depot_path, revision))")
+                connection.execute("CREATE INDEX IF NOT EXISTS publishes_entity_id ON publishes (entity_id)")
+                connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self.__local.connection = connection
+        return connection
@@ -0,0 +1,300 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Bulk resolution of depot file revisions to their published file entities in Shotgun
+"""
+
+import os
+
+import sgtk
+from sgtk import TankError
+
+p4_fw = sgtk.platform.get_framework("tk-framework-perforce")
+
+from .util import get_cache_location
+from .shotgun_scheduler import get_shotgun_scheduler
+
+def normalize_depot_path(depot_path):
+    """
+    Return the normalized form of a depot path as stored in the depot path field on
+    published files - any revision specifier and surrounding whitespace is removed.
+
+    :param depot_path:  The depot path to normalize
+    :returns str:       The normalized depot path
+    """
+    depot_path = (depot_path or "").strip()
+    for separator in ["#", "@"]:
+        depot_path = depot_path.split(separator)[0]
+    return depot_path
+
+def depot_path_from_entity(sg_entity):
+    """
+    Return the depot path and revision stored in the path url of a published file entity.
+
+    :param sg_entity:   The published file entity, including the 'path' field
+    :returns tuple:     (depot path, revision) or None if the entity doesn't have a depot path
+    """
+    url = (sg_entity.get("path") or {}).get("url")
+    if not url:
+        return None
+    return p4_fw.util.depot_path_from_url(url)
+
+class PublishResolver(object):
+    """
+    Resolve (depot path, revision) pairs to published file entities in bulk.  This is used
+    both to check for existing publishes and to resolve dependencies, both of which are
+    typically the same small set of upstream files referenced by many changes, so resolved
+    entities are kept in a bounded cache that can be shared across changes.
+    """
+
+    # field on the published file entity that the normalized depot path is stored in:
+    DEPOT_PATH_FIELD = "sg_depot_path"
+
+    # maximum number of (path, revision) pairs to query in a single find:
+    QUERY_CHUNK_SIZE = 100
+
+    # number of published files to read and update at a time when backfilling:
+    BACKFILL_PAGE_SIZE = 500
+
+    # file in the cache location that records that all published files in the project
+    # have the depot path field set:
+    BACKFILLED_FLAG_FILE_NAME = "depot_paths_backfilled"
+
+    def __init__(self, app, cache, schema_cache, index=None):
+        """
+        Construction
+
+        :param app:             The app bundle that constructed this object
+        :param cache:           The LruCache to keep resolved entities in
+        :param schema_cache:    The SchemaCache used to check for the depot path field
+        :param index:           An optional PublishIndex to resolve entities from instead
+                                of querying Shotgun
+        """
+        self.__app = app
+        self.__shotgun = get_shotgun_scheduler(self.__app)
+        self.__cache = cache
+        self.__schema_cache = schema_cache
+        self.__index = index
+        self.__backfilled_flag_path = os.path.join(get_cache_location(self.__app),
+                                                   PublishResolver.BACKFILLED_FLAG_FILE_NAME)
+        self.__depot_paths_backfilled = None
+
+    def has_depot_path_field(self):
+        """
+        Determine if the depot path field exists on the published file entity.
+
+        :returns bool:  True if the field exists
+        """
+        pf_entity_type = sgtk.util.get_published_file_entity_type(self.__app.sgtk)
+        try:
+            return PublishResolver.DEPOT_PATH_FIELD in self.__schema_cache.get(pf_entity_type)
+        except Exception, e:
+            self.__app.log_warning("Failed to read Shotgun schema for '%s': %s" % (pf_entity_type, e))
+            return False
+
+    def resolve(self, path_revisions):
+        """
+        Find the published file entities for the specified depot file revisions.
+
+        :param path_revisions:  List of (depot path, revision) tuples to resolve
+        :returns dict:          Dictionary of {(depot path, revision):entity} containing
+                                an entry for each revision that has been published
+        """
+        resolved = {}
+        to_find = set()
+        for depot_path, revision in path_revisions:
+            key = (depot_path, int(revision))
+            entity = self.__cache.get(key)
+            if entity:
+                resolved[key] = entity
+            else:
+                to_find.add(key)
+
+        if to_find and self.__index and self.__index.update():
+            # the index is up to date so anything not in it hasn't been published:
+            for key, entity in self.__index.lookup(to_find).iteritems():
+                self.__cache.set(key, entity)
+                resolved[key] = entity
+            return resolved
+
+        use_depot_path_field = to_find and self.has_depot_path_field()
+
+        to_find = sorted(to_find)
+        for chunk_start in range(0, len(to_find), PublishResolver.QUERY_CHUNK_SIZE):
+            chunk = to_find[chunk_start:chunk_start+PublishResolver.QUERY_CHUNK_SIZE]
+            if use_depot_path_field:
+                found = self.__find_publishes_by_depot_path(chunk)
+                missing = [key for key in chunk if key not in found]
+                if missing and not self.__are_depot_paths_backfilled():
+                    # publishes that haven't been backfilled yet can only be found by name:
+                    found.update(self.__find_publishes_by_name(missing, only_missing_depot_path=True))
+            else:
+                found = self.__find_publishes_by_name(chunk)
+            for key, entity in found.iteritems():
+                self.add(key[0], key[1], entity)
+                resolved[key] = entity
+
+        return resolved
+
+    def add(self, depot_path, revision, entity):
+        """
+        Add a published file entity to the cache, e.g. once it's been registered.
+
+        :param depot_path:  The depot path of the published file
+        :param revision:    The revision of the published file
+        :param entity:      The published file entity
+        """
+        self.__cache.set((depot_path, int(revision)), {"type":entity["type"], "id":entity["id"]})
+        if self.__index:
+            self.__index.add(depot_path, revision, entity)
+
+    def backfill_depot_paths(self):
+        """
+        Set the depot path field on all published files in the project that were registered
+        before the field existed.  Once this has finished, publishes are no longer looked for
+        by name.
+
+        :returns int:   The number of published files updated
+        """
+        if not self.has_depot_path_field():
+            raise TankError("The '%s' field doesn't exist on the published file entity - please create it first!"
+                            % PublishResolver.DEPOT_PATH_FIELD)
+
+        pf_entity_type = sgtk.util.get_published_file_entity_type(self.__app.sgtk)
+        updated = 0
+        last_id = 0
+        while True:
+            # page through using the id so that updated entities don't affect the paging:
+            sg_res = self.__shotgun.find(pf_entity_type,
+                                         [["project", "is", self.__app.context.project],
+                                          [PublishResolver.DEPOT_PATH_FIELD, "is", None],
+                                          ["id", "greater_than", last_id]],
+                                         ["id", "path"],
+                                         order=[{"field_name":"id", "direction":"asc"}],
+                                         limit=PublishResolver.BACKFILL_PAGE_SIZE)
+            if not sg_res:
+                break
+            last_id = sg_res[-1]["id"]
+
+            sg_batch_requests = []
+            for sg_entity in sg_res:
+                path_and_version = depot_path_from_entity(sg_entity)
+                if not path_and_version:
+                    continue
+                sg_batch_requests.append({"request_type":"update",
+                                          "entity_type":pf_entity_type,
+                                          "entity_id":sg_entity["id"],
+                                          "data":{PublishResolver.DEPOT_PATH_FIELD:
+                                                  normalize_depot_path(path_and_version[0])}})
+            if sg_batch_requests:
+                self.__shotgun.batch(sg_batch_requests)
+                updated += len(sg_batch_requests)
+                self.__app.log_info("Set the depot path on %d published file(s)..." % updated)
+
+        self.__set_depot_paths_backfilled()
+        return updated
+
+    def __are_depot_paths_backfilled(self):
+        """
+        Determine if all published files in the project have the depot path field set so
+        that publishes no longer need to be looked for by name.  This is recorded in a flag
+        file once backfill_depot_paths() has finished or once Shotgun has been checked and
+        no published files without the field were found.
+
+        :returns bool:  True if the depot paths have been backfilled
+        """
+        if self.__depot_paths_backfilled is None:
+            # check Shotgun once, the first time it's needed:
+            self.__depot_paths_backfilled = os.path.exists(self.__backfilled_flag_path)
+            if not self.__depot_paths_backfilled:
+                pf_entity_type = sgtk.util.get_published_file_entity_type(self.__app.sgtk)
+                try:
+                    sg_res = self.__shotgun.find_one(pf_entity_type,
+                                                     [["project", "is", self.__app.context.project],
+                                                      [PublishResolver.DEPOT_PATH_FIELD, "is", None]],
+                                                     ["id"])
+                except Exception, e:
+                    self.__app.log_warning("Failed to check for published files without a depot path: %s" % e)
+                    self.__depot_paths_backfilled = None
+                    return False
+                if not sg_res:
+                    self.__set_depot_paths_backfilled()
+        elif not self.__depot_paths_backfilled:
+            # the backfill may have been run by another process since:
+            self.__depot_paths_backfilled = os.path.exists(self.__backfilled_flag_path)
+        return self.__depot_paths_backfilled
+
+    def __set_depot_paths_backfilled(self):
+        """
+        Record that all published files in the project have the depot path field set.
+        """
+        self.__depot_paths_backfilled = True
+        try:
+            open(self.__backfilled_flag_path, "w").close()
+        except EnvironmentError, e:
+            self.__app.log_warning("Failed to write '%s': %s" % (self.__backfilled_flag_path, e))
+
+    def __find_publishes_by_depot_path(self, path_revisions):
+        """
+        Query Shotgun for the published files matching the specified file revisions in
+        a single request, filtering on the depot path field.
+        """
+        pf_entity_type = sgtk.util.get_published_file_entity_type(self.__app.sgtk)
+        pair_filters = []
+        for depot_path, revision in path_revisions:
+            pair_filters.append({"filter_operator":"all",
+                                 "filters":[[PublishResolver.DEPOT_PATH_FIELD, "is", normalize_depot_path(depot_path)],
+                                            ["version_number", "is", revision]]})
+        filters = [["project", "is", self.__app.context.project],
+                   {"filter_operator":"any", "filters":pair_filters}]
+        sg_res = self.__shotgun.find(pf_entity_type, filters,
+                                     ["id", "version_number", PublishResolver.DEPOT_PATH_FIELD])
+
+        keys_by_path = dict([((normalize_depot_path(p), r), (p, r)) for p, r in path_revisions])
+        found = {}
+        for sg_entity in sg_res:
+            key = keys_by_path.get((sg_entity.get(PublishResolver.DEPOT_PATH_FIELD),
+                                    sg_entity.get("version_number")))
+            if key and key not in found:
+                found[key] = {"type":sg_entity["type"], "id":sg_entity["id"]}
+        return found
+
+    def __find_publishes_by_name(self, path_revisions, only_missing_depot_path=False):
+        """
+        Query Shotgun for the published files matching the specified file revisions in
+        a single request.  This filters on the publish name (always the file name) and
+        version and then checks the path of each result.
+
+        :param only_missing_depot_path: If True then only published files that don't have
+                                        the depot path field set will be found
+        """
+        pf_entity_type = sgtk.util.get_published_file_entity_type(self.__app.sgtk)
+        pair_filters = []
+        for depot_path, revision in path_revisions:
+            pair_filters.append({"filter_operator":"all",
+                                 "filters":[["name", "is", os.path.basename(depot_path)],
+                                            ["version_number", "is", revision]]})
+        filters = [["project", "is", self.__app.context.project],
+                   {"filter_operator":"any", "filters":pair_filters}]
+        if only_missing_depot_path:
+            filters.append([PublishResolver.DEPOT_PATH_FIELD, "is", None])
+        sg_res = self.__shotgun.find(pf_entity_type, filters, ["id", "path", "version_number"])
+
+        wanted = set(path_revisions)
+        found = {}
+        for sg_entity in sg_res:
+            path_and_version = depot_path_from_entity(sg_entity)
+            if not path_and_version:
+                continue
+            key = (path_and_version[0], sg_entity.get("version_number"))
+            if key in wanted and key not in found:
+                found[key] = {"type":sg_entity["type"], "id":sg_entity["id"]}
+        return found
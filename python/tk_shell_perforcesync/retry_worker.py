@@ -0,0 +1,123 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Worker that drains the queue of failed work independently of the main sync daemon
+"""
+
+import time
+
+import sgtk
+from sgtk import TankError
+
+p4_fw = sgtk.platform.get_framework("tk-framework-perforce")
+
+from .shotgun_sync import ShotgunSync
+from .work_queue import WorkQueue
+from .shotgun_scheduler import ShotgunScheduler
+
+class RetryWorker(object):
+    """
+    Retry failed work items from the WorkQueue, grouped by change, rescheduling any that
+    fail again.
+    """
+
+    # maximum number of work items to retry in a single pass:
+    BATCH_SIZE = 100
+
+    def __init__(self, app, p4_user=None, p4_pass=None):
+        """
+        Construction
+
+        :param app:            The app bundle that constructed this object
+        :param p4_user:        The Perforce user that the command should be run under
+        :param p4_pass:        The Perforce password that the command should be run under
+        """
+        self.__app = app
+        self.__p4_user = p4_user
+        self.__p4_pass = p4_pass
+
+        self._interval = self.__app.get_setting("poll_interval")
+        self._p4_sync = ShotgunSync(self.__app, self.__p4_user, self.__p4_pass)
+        self._work_queue = self._p4_sync.work_queue
+        if not self._work_queue:
+            raise TankError("The work queue is disabled - set 'use_work_queue' to enable it!")
+
+    def run(self):
+        """
+        Run the retry worker continuously
+        """
+        while True:
+            p4 = None
+            processed = 0
+            try:
+                p4 = p4_fw.connection.connect(False, self.__p4_user, self.__p4_pass, "")
+                processed = self.process_due_items(p4)
+            except TankError, e:
+                self.__app.log_error("Failed to retry queued work: %s" % e)
+            except Exception, e:
+                self.__app.log_exception("Unhandled exception when retrying queued work!")
+            finally:
+                if p4:
+                    p4.disconnect()
+
+            if not processed:
+                time.sleep(self._interval)
+
+    def process_due_items(self, p4):
+        """
+        Retry all work items that are currently due.
+
+        :param p4:      The Perforce connection to use
+        :returns int:   The number of items that were retried
+        """
+        items = self._work_queue.due(RetryWorker.BATCH_SIZE)
+        if not items:
+            return 0
+
+        # group the items by change so that each change is only processed once:
+        items_by_change = {}
+        for item in items:
+            items_by_change.setdefault(item["change"], []).append(item)
+
+        for change_id in sorted(items_by_change):
+            change_items = items_by_change[change_id]
+            self.__app.log_info("Retrying %d failed work item(s) for change %d..." % (len(change_items), change_id))
+            with self._p4_sync.shotgun.lane(ShotgunScheduler.LANE_BULK):
+                failures = self._p4_sync.retry_failed_work(p4, change_id, change_items)
+            self.__update_items(change_items, failures)
+
+        return len(items)
+
+    def __update_items(self, items, failures):
+        """
+        Update the queue for the retried items using the failures that occurred.
+        """
+        failures_by_key = dict([((f["kind"], f["stage"], f["depot_path"], f["revision"]), f) for f in failures])
+        change_failures = [f for f in failures if f["kind"] == WorkQueue.KIND_CHANGE]
+
+        for item in items:
+            key = (item["kind"], item["stage"], item["depot_path"], item["revision"])
+            failure = failures_by_key.pop(key, None)
+            if not failure and change_failures and item["stage"] != WorkQueue.STAGE_VERSIONS:
+                # the change couldn't be synced so nothing in it will have succeeded:
+                failure = change_failures[0]
+                failures_by_key.pop((failure["kind"], failure["stage"], failure["depot_path"],
+                                     failure["revision"]), None)
+            if failure:
+                self._work_queue.failed(item, failure["error"])
+            else:
+                self.__app.log_debug("Work item %d for change %d succeeded" % (item["id"], item["change"]))
+                self._work_queue.succeeded(item["id"])
+
+        # anything else that failed is new work to be retried:
+        for failure in failures_by_key.values():
+            self._work_queue.add(failure["kind"], failure["change"], failure["stage"], failure["error"],
+                                 failure["depot_path"], failure["revision"])
@@ -0,0 +1,160 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Process-wide cache of the Shotgun schema for the entity types used by the sync
+"""
+
+import os
+import json
+import time
+import threading
+import urlparse
+
+from .util import get_cache_location
+from .shotgun_scheduler import get_shotgun_scheduler
+
+class SchemaCache(object):
+    """
+    Cache of Shotgun entity schemas.  Schemas are held in memory for the lifetime of the
+    process (shared between all instances) and persisted to disk so that new processes
+    don't need to read them from the server until they expire.
+    """
+
+    # schemas shared by all instances in this process, keyed by (site, entity type):
+    __schemas = {}
+    __lock = threading.Lock()
+
+    def __init__(self, app, ttl):
+        """
+        Construction
+
+        :param app:     The app bundle that constructed this object
+        :param ttl:     Time in seconds that a schema persisted to disk remains valid for
+        """
+        self.__app = app
+        self.__shotgun = get_shotgun_scheduler(self.__app)
+        self.__ttl = ttl
+
+        self.__site = urlparse.urlparse(self.__shotgun.base_url).netloc or "default"
+        self.__cache_path = os.path.join(get_cache_location(self.__app),
+                                         "schema_%s.json" % self.__site.replace(":", "_"))
+
+    def preload(self, entity_types):
+        """
+        Make sure the schemas for the specified entity types are cached.
+
+        :param entity_types:    List of entity types to load the schema for
+        """
+        for entity_type in entity_types:
+            try:
+                self.get(entity_type)
+            except Exception, e:
+                # not fatal - we'll try again the first time the schema is needed
+                self.__app.log_warning("Failed to read Shotgun schema for '%s': %s" % (entity_type, e))
+
+    def get(self, entity_type):
+        """
+        Return the schema for the specified entity type.  This will only read the schema
+        from Shotgun if it isn't cached in memory or on disk.
+
+        :param entity_type: The entity type to return the schema for
+        :returns dict:      The schema as returned by schema_field_read()
+        """
+        key = (self.__site, entity_type)
+        with SchemaCache.__lock:
+            schema = SchemaCache.__schemas.get(key)
+            if schema is not None:
+                return schema
+
+            schema = self.__load_from_disk(entity_type)
+            if schema is None:
+                schema = self.__read_from_shotgun(entity_type)
+            SchemaCache.__schemas[key] = schema
+            return schema
+
+    def refresh(self, entity_type):
+        """
+        Discard any cached schema for the entity type and re-read it from Shotgun.  This
+        should be called whenever a request fails because of a schema related error.
+
+        :param entity_type: The entity type to refresh the schema for
+        :returns dict:      The refreshed schema
+        """
+        self.__app.log_debug("Refreshing cached Shotgun schema for '%s'..." % entity_type)
+        with SchemaCache.__lock:
+            schema = self.__read_from_shotgun(entity_type)
+            SchemaCache.__schemas[(self.__site, entity_type)] = schema
+            return schema
+
+    @staticmethod
+    def is_schema_error(error):
+        """
+        Determine if the specified error looks like it was caused by an out-of-date schema,
+        e.g. a field that doesn't exist or has the wrong type.
+
+        :param error:   The exception raised by the Shotgun API
+        :returns bool:  True if the error appears to be schema related
+        """
+        msg = str(error).lower()
+        return "field" in msg and ("not exist" in msg or "invalid" in msg or "valid types" in msg
+                                   or "valid_types" in msg or "not found" in msg)
+
+    def __read_from_shotgun(self, entity_type):
+        """
+        Read the schema for an entity type from Shotgun and persist it to disk.
+        """
+        self.__app.log_debug("Reading Shotgun schema for '%s'..." % entity_type)
+        schema = self.__shotgun.schema_field_read(entity_type)
+        self.__save_to_disk(entity_type, schema)
+        return schema
+
+    def __load_from_disk(self, entity_type):
+        """
+        Load the schema for an entity type from the disk cache if it hasn't expired.
+        """
+        cached = self.__read_cache_file()
+        entry = cached.get(entity_type)
+        if not entry or time.time() - entry.get("time", 0) > self.__ttl:
+            return None
+        return entry.get("schema")
+
+    def __save_to_disk(self, entity_type, schema):
+        """
+        Persist the schema for an entity type to the disk cache.
+        """
+        cached = self.__read_cache_file()
+        cached[entity_type] = {"time":time.time(), "schema":schema}
+        tmp_path = "%s.%d.tmp" % (self.__cache_path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(cached, f)
+            # rename is atomic so other processes never see a partially written file:
+            if os.name == "nt" and os.path.exists(self.__cache_path):
+                # rename won't replace an existing file on Windows
+                os.remove(self.__cache_path)
+            os.rename(tmp_path, self.__cache_path)
+        except (IOError, OSError, TypeError, ValueError), e:
+            self.__app.log_warning("Failed to write Shotgun schema cache '%s': %s" % (self.__cache_path, e))
+
+    def __read_cache_file(self):
+        """
+        Read the contents of the disk cache, returning an empty dictionary if it doesn't
+        exist or can't be read.
+        """
+        if not os.path.exists(self.__cache_path):
+            return {}
+        try:
+            with open(self.__cache_path, "r") as f:
+                cached = json.load(f)
+            return cached if isinstance(cached, dict) else {}
+        except (IOError, OSError, ValueError), e:
+            self.__app.log_warning("Failed to read Shotgun schema cache '%s': %s" % (self.__cache_path, e))
+            return {}
@@ -0,0 +1,228 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Client-side scheduler that rate limits the Shotgun API calls made by the sync
+"""
+
+import time
+import threading
+import contextlib
+
+# one scheduler per app instance so that all calls made by the app share the same limit:
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def get_shotgun_scheduler(app):
+    """
+    Return the scheduler that wraps the Shotgun connection for the specified app, creating
+    it the first time it's requested.
+
+    :param app:                 The app bundle to return the scheduler for
+    :returns ShotgunScheduler:  The scheduler for the app
+    """
+    with _schedulers_lock:
+        scheduler = _schedulers.get(id(app))
+        if not scheduler:
+            scheduler = ShotgunScheduler(app,
+                                         None,
+                                         app.get_setting("shotgun_max_request_rate"),
+                                         app.get_setting("shotgun_min_request_rate"),
+                                         app.get_setting("shotgun_target_latency"))
+            _schedulers[id(app)] = scheduler
+        return scheduler
+
+class ShotgunScheduler(object):
+    """
+    Wraps a Shotgun connection, rate limiting all requests using a token bucket.
+
+    The rate adapts to how Shotgun is responding - it is halved when requests fail with an
+    error that suggests the server is overloaded, reduced when requests are slower than the
+    target latency and slowly increased again whilst requests are fast.
+
+    Requests are made in one of two priority lanes - requests in the bulk lane (e.g. range
+    syncs and retries) are only sent when no interactive requests (e.g. the daemon handling
+    newly submitted changes) are waiting.
+
+    Unless a connection is specified, each request is made using the app's Shotgun connection
+    for the calling thread (Toolkit keeps a separate connection per thread) so requests made
+    by different threads run in parallel and only the token bucket is shared.
+    """
+
+    LANE_INTERACTIVE = "interactive"
+    LANE_BULK = "bulk"
+
+    # the Shotgun API methods that make requests to the server:
+    THROTTLED_METHODS = set(["find", "find_one", "create", "update", "delete", "revive", "batch",
+                             "upload", "upload_thumbnail", "summarize", "schema_field_read",
+                             "schema_read", "schema_entity_read"])
+
+    # fraction of the maximum rate added after each fast request:
+    RATE_INCREASE_FRACTION = 0.05
+
+    def __init__(self, app, shotgun, max_rate, min_rate, target_latency):
+        """
+        Construction
+
+        :param app:             The app bundle that constructed this object
+        :param shotgun:         The Shotgun connection to wrap or None to use the app's
+                                connection for the calling thread
+        :param max_rate:        The maximum number of requests per second.  If this is 0 then
+                                requests are not rate limited
+        :param min_rate:        The rate will never be reduced below this
+        :param target_latency:  Requests that take longer than this many seconds will cause
+                                the rate to be reduced
+        """
+        self.__app = app
+        self.__shotgun = shotgun
+        self.__max_rate = float(max_rate)
+        self.__min_rate = float(max(0.01, min(min_rate, max_rate)))
+        self.__target_latency = target_latency
+
+        self.__rate = self.__max_rate
+        self.__tokens = 1.0
+        self.__last_refill = time.time()
+        self.__interactive_waiting = 0
+        self.__condition = threading.Condition()
+        self.__local = threading.local()
+        self.__error_count = 0
+
+    @property
+    def rate(self):
+        """
+        The current request rate in requests per second
+        """
+        return self.__rate
+
+    @property
+    def error_count(self):
+        """
+        The number of requests that have failed since this scheduler was created
+        """
+        return self.__error_count
+
+    @property
+    def request_count(self):
+        """
+        The number of requests made by the current thread since this scheduler was created
+        """
+        return getattr(self.__local, "request_count", 0)
+
+    @contextlib.contextmanager
+    def lane(self, lane):
+        """
+        Context manager that makes all requests in the current thread use the specified lane.
+
+        :param lane:    The lane to use, LANE_INTERACTIVE or LANE_BULK
+        """
+        previous_lane = getattr(self.__local, "lane", ShotgunScheduler.LANE_INTERACTIVE)
+        self.__local.lane = lane
+        try:
+            yield
+        finally:
+            self.__local.lane = previous_lane
+
+    def call(self, function, *args, **kwargs):
+        """
+        Call a function that makes a request using a Shotgun connection other than the
+        one wrapped by this scheduler (e.g. sgtk.util.register_publish which uses Toolkit's
+        connection) so that it's rate limited in the same lane and counted in the same way
+        as the requests made through the scheduler.
+
+        :param function:    The function to call
+        :param args:        The positional arguments to pass to the function
+        :param kwargs:      The keyword arguments to pass to the function
+        :returns:           The result of the function
+        """
+        self.__local.request_count = getattr(self.__local, "request_count", 0) + 1
+        if self.__max_rate > 0:
+            self.__acquire(getattr(self.__local, "lane", ShotgunScheduler.LANE_INTERACTIVE))
+        start_time = time.time()
+        try:
+            res = function(*args, **kwargs)
+        except Exception, e:
+            self.__adapt(time.time() - start_time, e)
+            raise
+        self.__adapt(time.time() - start_time)
+        return res
+
+    def __getattr__(self, name):
+        """
+        Return the attribute from the wrapped Shotgun connection, rate limiting it if it's
+        a method that makes a request to the server.
+        """
+        attr = getattr(self.__shotgun or self.__app.shotgun, name)
+        if name not in ShotgunScheduler.THROTTLED_METHODS:
+            return attr
+
+        def _throttled(*args, **kwargs):
+            return self.call(attr, *args, **kwargs)
+        return _throttled
+
+    def __acquire(self, lane):
+        """
+        Wait until a request can be made in the specified lane.
+        """
+        interactive = lane != ShotgunScheduler.LANE_BULK
+        with self.__condition:
+            if interactive:
+                self.__interactive_waiting += 1
+            try:
+                while True:
+                    self.__refill()
+                    if self.__tokens >= 1.0 and (interactive or not self.__interactive_waiting):
+                        self.__tokens -= 1.0
+                        return
+                    wait_time = max(0.001, (1.0 - self.__tokens) / self.__rate)
+                    self.__condition.wait(wait_time)
+            finally:
+                if interactive:
+                    self.__interactive_waiting -= 1
+                    self.__condition.notify_all()
+
+    def __refill(self):
+        """
+        Add the tokens accumulated since the last refill.  The bucket holds at most one
+        second's worth of requests.
+        """
+        now = time.time()
+        self.__tokens = min(max(1.0, self.__rate), self.__tokens + (now - self.__last_refill) * self.__rate)
+        self.__last_refill = now
+
+    def __adapt(self, latency, error=None):
+        """
+        Adjust the rate based on the latency and result of a request.
+        """
+        with self.__condition:
+            if error is not None:
+                self.__error_count += 1
+            if self.__max_rate <= 0:
+                return
+            previous_rate = self.__rate
+            if error is not None and self.__is_overload_error(error):
+                self.__rate = max(self.__min_rate, self.__rate * 0.5)
+            elif latency > self.__target_latency:
+                self.__rate = max(self.__min_rate, self.__rate * 0.8)
+            elif error is None:
+                self.__rate = min(self.__max_rate,
+                                  self.__rate + self.__max_rate * ShotgunScheduler.RATE_INCREASE_FRACTION)
+
+        if self.__rate < previous_rate:
+            self.__app.log_debug("Reduced Shotgun request rate to %.1f requests/second (latency %.2fs%s)"
+                                 % (self.__rate, latency, (", error: %s" % error) if error else ""))
+
+    @staticmethod
+    def __is_overload_error(error):
+        """
+        Determine if an error suggests that Shotgun is overloaded or throttling requests.
+        """
+        msg = str(error).lower()
+        return any(s in msg for s in ["429", "502", "503", "504", "rate limit", "too many requests",
+                                      "timed out", "timeout", "temporarily unavailable"])
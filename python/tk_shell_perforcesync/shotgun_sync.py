@@ -16,6 +16,7 @@ with Shotgun
 import os
 import sys
 import urllib
+import hashlib
 from datetime import datetime
 from pprint import pprint
 
@@ -25,6 +26,44 @@ from sgtk import TankError
 p4_fw = sgtk.platform.get_framework("tk-framework-perforce")
 from P4 import P4Exception
 
+from .schema_cache import SchemaCache
+from .publish_resolver import PublishResolver, normalize_depot_path
+from .publish_index import PublishIndex
+from .p4_records import P4Change, P4FileRevision
+from .p4_journal import JournalDepot, OfflineP4
+from .write_buffer import ShotgunWriteBuffer
+from .path_resolver_pool import PathResolverPool
+from .cache import LruCache
+from .membership_index import MembershipIndex
+from .work_queue import WorkQueue
+from .shotgun_scheduler import get_shotgun_scheduler, ShotgunScheduler
+from .util import get_shared_cache_location
+
+def _canonical_hash(data):
+    """
+    Build a hash for the specified data that is independent of dictionary ordering so that
+    equal data structures always produce the same hash.
+    
+    :param data:    The data to hash - typically a dictionary of review data
+    :returns str:   A hex digest for the data
+    """
+    def _canonical_repr(value):
+        if isinstance(value, dict):
+            items = sorted((_canonical_repr(k), _canonical_repr(v)) for k, v in value.iteritems())
+            return "{%s}" % ",".join("%s:%s" % item for item in items)
+        elif isinstance(value, (list, tuple)):
+            return "%s[%s]" % (type(value).__name__, ",".join(_canonical_repr(v) for v in value))
+        elif isinstance(value, (set, frozenset)):
+            return "set[%s]" % ",".join(sorted(_canonical_repr(v) for v in value))
+        elif isinstance(value, unicode):
+            # make sure equal str & unicode values produce the same hash:
+            return repr(value.encode("utf-8"))
+        elif isinstance(value, (int, long)) and not isinstance(value, bool):
+            return str(value)
+        return repr(value)
+    
+    return hashlib.sha1(_canonical_repr(data)).hexdigest()
+
 class ShotgunSync(object):
     """
     Handle syncronisation of Perforce changes with Shotgun
@@ -42,6 +81,16 @@ class ShotgunSync(object):
     #CONFIG_BACK_MAPPING_FILE_LOCATION = "tank/config/%s" % sgtk.platform.constants.CONFIG_BACK_MAPPING_FILE
     CONFIG_BACK_MAPPING_FILE_LOCATION = "tank/config/tank_configs.yml" 
     
+    # maximum number of Version entities to create in a single batch request:
+    VERSION_BATCH_SIZE = 50
+    
+    # number of changes to check for existing Revision entities in a single query:
+    REVISION_PREFETCH_CHUNK_SIZE = 500
+    
+    # actions for files that were copied from another depot path and so can reuse the work 
+    # done for the file they were copied from:
+    INTEGRATED_FILE_ACTIONS = ("integrate", "branch", "copy")
+    
     def __init__(self, app, p4_user=None, p4_pass=None):
         """
         Construction
@@ -54,27 +103,156 @@ class ShotgunSync(object):
         self.__p4_user = p4_user
         self.__p4_pass = p4_pass
         
-        # some useful cache info:        
-        self.__project_roots = set()
-        self.__project_pc_roots = {}
-        self.__pc_tk_instances = {}
-        self.__depot_path_details_cache = {}
+        # all Shotgun requests go through the rate limited scheduler:
+        self._shotgun = get_shotgun_scheduler(self._app)
+        
+        # some useful cache info - all caches are bounded so that memory use stays
+        # flat when running as a daemon:
+        cache_size = self._app.get_setting("cache_max_size")
+        cache_ttl = self._app.get_setting("cache_ttl")
+        cache_negative_ttl = self._app.get_setting("cache_negative_ttl")
+        self.__project_roots = LruCache("project roots", cache_size, cache_ttl)
+        self.__project_pc_roots = LruCache("pipeline config roots", cache_size, cache_ttl, cache_negative_ttl)
+        self.__pc_tk_instances = LruCache("tk instances", cache_size, cache_ttl)
+        self.__depot_path_details_cache = LruCache("depot path details", cache_size, cache_ttl, cache_negative_ttl)
+        self.__directory_project_roots = LruCache("directory project roots", cache_size, cache_ttl, cache_negative_ttl)
+        
+        # change membership is shared with other daemons through a local index:
+        self.__membership_index = None
+        if self._app.get_setting("use_membership_index"):
+            self.__membership_index = MembershipIndex(self._app, get_shared_cache_location(self._app))
+        
+        # failed work is recorded in a durable queue so that it can be retried later:
+        self.__work_queue = None
+        if self._app.get_setting("use_work_queue"):
+            self.__work_queue = WorkQueue(self._app, 
+                                          self._app.get_setting("retry_max_attempts"),
+                                          self._app.get_setting("retry_base_delay"),
+                                          self._app.get_setting("retry_max_delay"))
+        self.__failures = None
+        
+        # read the schema for all entity types we write to up front so that it's
+        # never read whilst processing changes:
+        self.__published_file_field = None
+        self.__schema_cache = SchemaCache(self._app, self._app.get_setting("schema_cache_ttl"))
+        self.__schema_cache.preload(["Revision", 
+                                     sgtk.util.get_published_file_entity_type(self._app.sgtk), 
+                                     "Version"])
+        
+        # Shotgun writes for consecutive changes can be grouped into a single batch:
+        self.__write_buffer = None
+        if self._app.get_setting("write_buffer_size") > 0:
+            self.__write_buffer = ShotgunWriteBuffer(self._app, 
+                                                     self._shotgun,
+                                                     self._app.get_setting("write_buffer_size"),
+                                                     self._app.get_setting("write_buffer_max_age"))
+        
+        # resolved published files are cached across changes:
+        self.__publish_cache = LruCache("published files", self._app.get_setting("publish_cache_size"), cache_ttl)
+        publish_index = None
+        if self._app.get_setting("use_publish_index"):
+            publish_index = PublishIndex(self._app, self._app.get_setting("publish_index_update_interval"))
+        self.__publish_resolver = PublishResolver(self._app, self.__publish_cache, self.__schema_cache, publish_index)
+        
+        # integrated and copied files reuse the work done for the file with the same content 
+        # and project root relative path that they were copied from:
+        self.__content_cache = LruCache("file contents", self._app.get_setting("content_cache_size"), cache_ttl)
+        
+        # template matching & context construction for large changes can be spread across
+        # a pool of worker processes:
+        self.__path_resolver_pool = None
+        self.__path_resolver_min_files = self._app.get_setting("path_resolver_min_files")
+        if self._app.get_setting("path_resolver_processes") > 0:
+            if PathResolverPool.is_supported():
+                self.__path_resolver_pool = PathResolverPool(self._app, self._app.get_setting("path_resolver_processes"))
+            else:
+                self._app.log_warning("Path resolver processes aren't supported on this platform, depot "
+                                      "paths will be resolved in the main process")
         
-    def sync_changes(self, start_change, end_change):
+    @property
+    def shotgun(self):
+        """
+        The rate limited Shotgun connection used by this instance
+        """
+        return self._shotgun
+
+    @property
+    def write_buffer(self):
+        """
+        The buffer used to group the Shotgun writes for consecutive changes or None if
+        writes aren't buffered
+        """
+        return self.__write_buffer
+
+    @property
+    def work_queue(self):
+        """
+        The queue that failed work is recorded in, or None if it's disabled
+        """
+        return self.__work_queue
+
+    @property
+    def caches(self):
+        """
+        All caches used by this instance
+        """
+        return [self.__project_roots, self.__project_pc_roots, self.__pc_tk_instances,
+                self.__depot_path_details_cache, self.__directory_project_roots, self.__publish_cache,
+                self.__content_cache]
+
+    def log_cache_stats(self):
+        """
+        Log statistics for all caches used by this instance
+        """
+        for cache in self.caches:
+            self._app.log_debug("Cache stats - %s" % cache.format_stats())
+
+    def invalidate_caches(self):
+        """
+        Clear all cached information so that it will be looked up again the next
+        time it's needed.
+        """
+        for cache in self.caches:
+            cache.clear()
+
+    def sync_changes(self, start_change, end_change, p4=None):
         """
         Sync a range of changes with Shotgun
         
         :param start_change:    The first change to sync
         :param end_change:      The last change to sync
+        :param p4:              An optional Perforce connection to use.  If not specified then
+                                a new connection will be made for the duration of the sync.
         """
         self._app.log_info("Syncing changes %d - %d..." % (start_change, end_change))
         
+        # syncing a range of changes is bulk work so shouldn't hold up interactive requests:
+        with self._shotgun.lane(ShotgunScheduler.LANE_BULK):
+            self.__sync_change_range(start_change, end_change, p4)
+            
+    def __sync_change_range(self, start_change, end_change, p4=None):
+        """
+        Sync a range of changes with Shotgun
+        
+        :param start_change:    The first change to sync
+        :param end_change:      The last change to sync
+        :param p4:              An optional Perforce connection to use
+        """
+        # find all changes in the range that have already been synced so that they
+        # can be skipped without querying Perforce:
+        synced_changes = self.__find_synced_changes(start_change, end_change)
+        
         # connect to Perforce:
-        p4 = self.__connect_to_perforce()
+        own_connection = p4 is None
+        if own_connection:
+            p4 = self.__connect_to_perforce()
         if p4:
             try:
                 # sync changes:
                 for change_id in range(start_change, end_change+1):
+                    if change_id in synced_changes:
+                        self._app.log_debug("Change %d has already been synced, skipping" % change_id)
+                        continue
                     try:
                         self.__sync_change(change_id, p4)
                     except TankError, e:
@@ -82,8 +260,51 @@ class ShotgunSync(object):
                     except Exception, e:
                         self._app.log_exception("Failed to sync change %d: %s" % (change_id, e))
             finally:
-                # always disconnect:
-                p4.disconnect()
+                # always disconnect if we made the connection:
+                if own_connection:
+                    p4.disconnect()
+
+    def __find_synced_changes(self, start_change, end_change):
+        """
+        Find all changes in the specified range that already have a Revision entity in
+        Shotgun.  This uses a small number of paged queries rather than one per change.
+        
+        :param start_change:    The first change in the range
+        :param end_change:      The last change in the range
+        :returns set:           Set of change ids that have already been synced
+        """
+        return self.__find_changes_with_revisions(range(start_change, end_change+1))
+    
+    def __find_changes_with_revisions(self, change_ids):
+        """
+        Find which of the specified changes already have a Revision entity in Shotgun.
+        
+        :param change_ids:  List of change ids to check, in ascending order
+        :returns set:       Set of change ids that have already been synced
+        """
+        synced_changes = set()
+        chunk_size = ShotgunSync.REVISION_PREFETCH_CHUNK_SIZE
+        for chunk_start in range(0, len(change_ids), chunk_size):
+            chunk = change_ids[chunk_start:chunk_start+chunk_size]
+            codes = [str(change_id) for change_id in chunk]
+            try:
+                sg_res = self._shotgun.find("Revision", 
+                                           [["project", "is", self._app.context.project], ["code", "in", codes]], 
+                                           ["code"])
+            except Exception, e:
+                # not fatal as each change is also checked before it's created
+                self._app.log_warning("Failed to query existing Revision entities for changes %d - %d: %s" 
+                                      % (chunk[0], chunk[-1], e))
+                continue
+            
+            for sg_revision in sg_res:
+                try:
+                    synced_changes.add(int(sg_revision["code"]))
+                except (TypeError, ValueError):
+                    pass
+        
+        self._app.log_debug("Found %d changes that have already been synced" % len(synced_changes))
+        return synced_changes
 
     def __sync_change(self, change_id, p4):
         """
@@ -118,8 +339,8 @@ class ShotgunSync(object):
             if not p4_res:
                 return
             
-            p4_change = p4_res[0]
-            if p4_change.get("status") != "submitted":
+            p4_change = P4Change.from_describe(p4_res[0])
+            if not p4_change.is_submitted:
                 # only care about submitted changes
                 return
             
@@ -143,82 +364,170 @@ class ShotgunSync(object):
     def is_change_in_context(self, p4, p4_change):
         """
         Determine if the specified change is valid for the current context (project).
-        This will check that at least one file in the change is within the project root
+        This will check that at least one file in the change is within the project root.
+        
+        The result of classifying a change is recorded in the shared membership index so
+        that any other daemon running for a different project can skip the change with a
+        local lookup instead of classifying it again.  If Perforce can't be queried then 
+        the P4Exception is raised and nothing is recorded so that the change can be 
+        classified again later.
         
         :param p4:           The Perforce connection to use
-        :param p4_change:    The Perforce changelist to check
+        :param p4_change:    The P4Change to check
         """ 
-        self._app.log_debug("Checking that change '%s' contains files that are in the current project..." % p4_change["change"])
-        for depot_path in p4_change.get("depotFile", []):
+        change_id = p4_change.change
+        project_id = self._app.context.project["id"]
+        
+        # check to see if this change has already been classified:
+        if self.__membership_index:
+            project_ids = self.__membership_index.lookup(p4.port, change_id)
+            if project_ids is not None:
+                self._app.log_debug("Change '%d' found in membership index, touches projects: %s" 
+                                    % (change_id, sorted(project_ids)))
+                return project_id in project_ids
+        
+        self._app.log_debug("Checking that change '%d' contains files that are in the current project..." % change_id)
+        project_ids = self.__classify_change(p4, p4_change)
+        if self.__membership_index:
+            self.__membership_index.record(p4.port, change_id, project_ids)
+        
+        # the change is in this project if any of its files are:
+        return project_id in project_ids
+
+    def is_change_known_to_be_foreign(self, p4, change_id):
+        """
+        Check the shared membership index to see if the specified change has already been
+        classified as not touching the current project.  This never queries Perforce.
+        
+        :param p4:          The Perforce connection the change belongs to
+        :param change_id:   The id of the change to check
+        :returns bool:      True if the change is known to not be in this project, False if
+                            it is in this project or hasn't been classified yet
+        """
+        if not self.__membership_index:
+            return False
+        project_ids = self.__membership_index.lookup(p4.port, change_id)
+        return project_ids is not None and self._app.context.project["id"] not in project_ids
 
+    def __classify_change(self, p4, p4_change):
+        """
+        Find all Toolkit projects that files in the specified change belong to.
+        
+        :param p4:           The Perforce connection to use
+        :param p4_change:    The P4Change to classify
+        :returns set:        The set of project ids for the files in the change
+        """
+        if not len(p4_change.files):
+            return set()
+        
+        # fast path - if the directory containing all files in the change is within a 
+        # project root then all files are in that project (project roots aren't nested):
+        common_directory = p4_change.common_directory
+        if common_directory and self.__get_directory_project_root(common_directory, p4):
+            return self.__get_project_ids(p4, [p4_change.files.depot_files[0]])
+        
+        # otherwise find the project root for each distinct directory and fully resolve
+        # a single representative file for each root that was found:
+        representative_files = {}
+        checked_directories = set()
+        for depot_path in p4_change.files:
+            directory = depot_path[:depot_path.rfind("/")]
+            if directory in checked_directories:
+                continue
+            checked_directories.add(directory)
+            project_root = self.__get_directory_project_root(directory, p4)
+            if project_root and project_root not in representative_files:
+                representative_files[project_root] = depot_path
+                
+        return self.__get_project_ids(p4, representative_files.values())
+    
+    def __get_project_ids(self, p4, depot_paths):
+        """
+        Find the Toolkit projects that the specified depot paths belong to.
+        
+        :param p4:           The Perforce connection to use
+        :param depot_paths:  List of depot paths to resolve
+        :returns set:        The set of project ids for the depot paths
+        """
+        project_ids = set()
+        for depot_path in depot_paths:
             # find the depot root and tk instance for the depot path:
             details = self.__find_file_details(depot_path, p4)
             if not details:
-                return
+                # file isn't in a Toolkit project
+                continue
             _, tk = details
-            
-            if tk.pipeline_configuration.get_project_id() == self._app.context.project["id"]:
-                # this file is in the project, therefore so is the change!
-                return True
-            
-        # none of the files in the change are in this project!
-        return False
-        
+            project_ids.add(tk.pipeline_configuration.get_project_id())
+        return project_ids
 
-    def create_sg_entity_for_change(self, p4_change):
+    def create_sg_entity_for_change(self, p4_change, claimed=False):
         """
-        Create a 'Revision' entity for a Perforce change in Shotgun.  A change
-        is created and then the matching change with the lowest id is retrieved
-        to ensure this process was the first to create the entity.
+        Create a 'Revision' entity for a Perforce change in Shotgun.  
         
-        If it wasn't then it deletes the entity imediately and returns nothing
-        as it's assumed that another process created this change first. 
+        If the change has been claimed (see ChangeClaim) then this process is the only one
+        that will create it so the entity is just created.  Otherwise, a change is created and
+        then the matching change with the lowest id is retrieved to ensure this process was 
+        the first to create the entity.  If it wasn't then it deletes the entity imediately 
+        and returns nothing as it's assumed that another process created this change first.
         
-        :param p4_change: The Perforce change to be populated in Shotgun
+        :param p4_change:   The P4Change to be populated in Shotgun
+        :param claimed:     True if this process has exclusively claimed the change, in which
+                            case a failure to create the entity is recorded so that it's retried
+                            as no other daemon will process the change
         """
         if not p4_change:
             return
 
-        change_id = str(p4_change["change"])
-        created_at = datetime.fromtimestamp(int(p4_change["time"]))
+        change_id = str(p4_change.change)
+        created_at = p4_change.submitted_at
         
         self._app.log_info("Creating Shotgun Revision entity for Perforce change %s" % change_id)        
         
         # check to see if this change exists in Shotgun:
-        try:
-            sg_res = self._app.shotgun.find_one("Revision", [["project", "is", self._app.context.project], ["code", "is", change_id]])
-            if sg_res:
-                # change already exists for this project and we
-                # don't want to create it twice!
-                self._app.log_debug("Shotgun Revision entity for Perforce change %s already exists!" % change_id)        
+        if not claimed:
+            try:
+                sg_res = self._shotgun.find_one("Revision", [["project", "is", self._app.context.project], ["code", "is", change_id]])
+                if sg_res:
+                    # change already exists for this project and we
+                    # don't want to create it twice!
+                    self._app.log_debug("Shotgun Revision entity for Perforce change %s already exists!" % change_id)        
+                    return
+            except Exception, e:
+                self._app.log_error("Failed to query change from Shotgun: %s" % e)
                 return
-        except Exception, e:
-            self._app.log_error("Failed to query change from Shotgun: %s" % e)
-            return
         
         # it doesn't exist so lets create it:
         sg_change = None
         try:
-            sg_user = self.__get_sg_user(p4_change["user"])        
+            sg_user = self.__get_sg_user(p4_change.user)        
         
             change_data = {}
             change_data["code"] = change_id
-            change_data["description"] = p4_change.get("desc", "")
+            change_data["description"] = p4_change.desc
             change_data["project"] = self._app.context.project
             change_data["created_by"] = sg_user
             change_data["created_at"] = created_at 
-            change_data["sg_workspace"] = p4_change.get("client")
+            change_data["sg_workspace"] = p4_change.client
             
-            sg_change = self._app.shotgun.create("Revision", change_data)
+            sg_change = self._shotgun.create("Revision", change_data)
         except Exception, e:
             self._app.log_error("Failed to create change (Revision) entity in Shotgun: %s" % e)
+            if claimed:
+                # nothing else will process this change so make sure it gets retried:
+                self.__record_failure(WorkQueue.KIND_CHANGE, change_id, WorkQueue.STAGE_CONTENTS, e)
             return
         
+        if claimed:
+            # nothing else can have created this change so we're done
+            self._app.log_debug("Successfully created Shotgun Revision entity %d for Perforce change %s" 
+                                % (sg_change["id"], change_id))
+            return sg_change
+        
         # next check that the entity created is the most recent one - this is so that
         # we can ensure nothing else created it at the same time!
         try:
             # find the revision entity for our change with the lowest id:
-            sg_first_change = self._app.shotgun.find_one("Revision", 
+            sg_first_change = self._shotgun.find_one("Revision", 
                                             [["project", "is", self._app.context.project], ["code", "is", change_id]],
                                             order = [{"field_name":"id", "direction":"asc"}])
             if not sg_first_change:
@@ -226,7 +535,7 @@ class ShotgunSync(object):
                 return
             elif sg_first_change["id"] != sg_change["id"]:
                 # someone else got there first so lets delete the change we just created!
-                if not self._app.shotgun.delete("Revision", sg_change["id"]):
+                if not self._shotgun.delete("Revision", sg_change["id"]):
                     self._app.log_error("Failed to delete change (Revision) entity %s in Shotgun - please fix manually!" % change_id)
                 return
         except Exception, e:
@@ -239,19 +548,677 @@ class ShotgunSync(object):
                             % (sg_change["id"], change_id))
         return sg_change
 
-
     def sync_change_contents(self, p4, p4_change, sg_change_entity):
         """
         Sync the files modified in the specified Perforce change to the specified
         Shotgun Revision entity.
         
         :param p4:                  The Perforce connection to use
-        :param p4_change:           The Perforce change description to sync
+        :param p4_change:           The P4Change to sync
         :param sg_change_entity:    The Shotgun Revision entity
         """
-        change_id = str(p4_change["change"])
+        change_id = str(p4_change.change)
+        
+        p4_file_details = self.__find_change_file_revisions(p4, change_id)
+        if p4_file_details is None:
+            return
+        
+        # process all remaining file revisions for the change, return a list of
+        # corresponding Shotgun entities:
+        published_file_entities = self.__process_file_revisions(p4, p4_file_details, p4_change)
+        if not published_file_entities:
+            return
+        
+        # build the update data for the change:
+        published_file_field = self.__get_published_file_field()
+        change_data = {published_file_field:[]}
+        for pf in published_file_entities:
+            change_data[published_file_field].append({"type":pf["type"], "id":pf["id"]})
+            
+        # update the change:
+        self._app.log_debug("Updating Published files for change (Revision) entity %s..." % (sg_change_entity["code"]))
+        try:
+            try:
+                self._shotgun.update("Revision", sg_change_entity["id"], change_data)
+            except Exception, e:
+                if not SchemaCache.is_schema_error(e):
+                    raise
+                # the cached schema may be out of date so refresh it and try again:
+                published_file_field = self.__get_published_file_field(refresh=True)
+                change_data = {published_file_field:change_data.values()[0]}
+                self._shotgun.update("Revision", sg_change_entity["id"], change_data)
+        except Exception, e:
+            self._app.log_error("Failed to update revision entity %d - %s" % (sg_change_entity["id"], e))
+            self.__record_failure(WorkQueue.KIND_CHANGE, change_id, WorkQueue.STAGE_CONTENTS, e)
+
+    def queue_change(self, p4, p4_change):
+        """
+        Sync a change that this process has exclusively claimed, adding the Revision entity
+        (linked to the published files) and the dependencies for the change to the write 
+        buffer instead of writing them straight away.  Publishes and review Versions are 
+        still registered immediately.
+        
+        :param p4:          The Perforce connection to use
+        :param p4_change:   The P4Change to sync
+        :returns bool:      True if the writes for the change were buffered
+        """
+        change_id = str(p4_change.change)
+        
+        p4_file_details = self.__find_change_file_revisions(p4, change_id)
+        if p4_file_details is None:
+            return False
+
+        sg_requests = []
+        try:
+            published_file_entities = self.__process_file_revisions(p4, p4_file_details, p4_change, sg_requests)
+            change_data = self.__build_revision_data(p4_change, self.__get_sg_user(p4_change.user), 
+                                                     published_file_entities)
+        except Exception, e:
+            self._app.log_exception("Failed to sync change %s" % change_id)
+            self.__record_failure(WorkQueue.KIND_CHANGE, change_id, WorkQueue.STAGE_CONTENTS, e)
+            return False
+        
+        # the Revision is created first so that it's in the same transaction as the dependencies:
+        sg_requests.insert(0, {"request_type":"create", "entity_type":"Revision", "data":change_data})
+        self.__write_buffer.add(int(change_id), sg_requests)
+        return True
+    
+    def __build_revision_data(self, p4_change, sg_user, published_file_entities):
+        """
+        Build the data to create the Revision entity for a change with.
+        
+        :param p4_change:                   The P4Change to create the Revision for
+        :param sg_user:                     The Shotgun user that submitted the change
+        :param published_file_entities:     The published files to link to the Revision
+        :returns dict:                      The Revision entity data
+        """
+        change_data = {}
+        change_data["code"] = str(p4_change.change)
+        change_data["description"] = p4_change.desc
+        change_data["project"] = self._app.context.project
+        change_data["created_by"] = sg_user
+        change_data["created_at"] = p4_change.submitted_at
+        change_data["sg_workspace"] = p4_change.client
+        if published_file_entities:
+            change_data[self.__get_published_file_field()] = [{"type":pf["type"], "id":pf["id"]} 
+                                                              for pf in published_file_entities]
+        return change_data
+    
+    def record_change_failure(self, change_id, error):
+        """
+        Record that syncing the contents of a change failed so that it's retried later.
+        
+        :param change_id:   The id of the change
+        :param error:       The error that caused the failure
+        """
+        self.__record_failure(WorkQueue.KIND_CHANGE, change_id, WorkQueue.STAGE_CONTENTS, error)
+    
+    def flush_writes(self):
+        """
+        Write all buffered requests to Shotgun.  Any changes that fail to be written are
+        recorded so that they can be retried later.  Only claimed changes are buffered so
+        the Revision entities are written without checking for existing ones.
+        
+        :returns list:  The ids of the changes that were written successfully
+        """
+        if self.__write_buffer is None or not self.__write_buffer.change_ids:
+            return []
+        
+        written, failed, _ = self.__flush_write_buffer(self.__write_buffer)
+        for change_id, error in failed:
+            self._app.log_error("Failed to write Shotgun data for change %d - %s" % (change_id, error))
+            self.__record_failure(WorkQueue.KIND_CHANGE, change_id, WorkQueue.STAGE_CONTENTS, error)
+        return sorted(written)
+    
+    def __flush_write_buffer(self, write_buffer):
+        """
+        Flush a write buffer.  The Revision data in the buffer was built using the cached
+        schema so if any changes fail because of a schema error then the schema is refreshed
+        and those changes are written again.
         
-        # get details for all files in change excluding any deletes, move/deletes, etc.
+        :param write_buffer:    The ShotgunWriteBuffer to flush
+        :returns tuple:         (list of change ids that were written,
+                                 list of (change id, error) tuples for changes that failed,
+                                 dictionary of {change id:list of entities created for the change})
+        """
+        written, failed = write_buffer.flush()
+        created_entities = dict(write_buffer.created_entities)
+        schema_failures = [change_id for change_id, error in failed if SchemaCache.is_schema_error(error)]
+        if not schema_failures:
+            return (written, failed, created_entities)
+        
+        # the cached schema may be out of date so refresh it and try again:
+        published_file_field = self.__get_published_file_field()
+        refreshed_field = self.__get_published_file_field(refresh=True)
+        if refreshed_field == published_file_field:
+            return (written, failed, created_entities)
+        
+        failed_requests = write_buffer.failed_requests
+        for change_id in schema_failures:
+            sg_requests = []
+            for request in failed_requests[change_id]:
+                if request["entity_type"] == "Revision" and published_file_field in request.get("data", {}):
+                    change_data = dict(request["data"])
+                    change_data[refreshed_field] = change_data.pop(published_file_field)
+                    request = dict(request, data=change_data)
+                sg_requests.append(request)
+            write_buffer.add(change_id, sg_requests)
+        retry_written, retry_failed = write_buffer.flush()
+        created_entities.update(write_buffer.created_entities)
+        
+        failed = [(change_id, error) for change_id, error in failed if change_id not in schema_failures]
+        return (written + retry_written, failed + retry_failed, created_entities)
+    
+    def __remove_duplicate_revisions(self, created_entities):
+        """
+        Make sure that each change written in a batch only has a single Revision entity.  For
+        any change where the Revision entity created isn't the one with the lowest id, another
+        process got there first so everything created for the change is deleted again.
+        
+        :param created_entities:    Dictionary of {change id:list of entities created for the change}
+        :returns list:              The ids of the changes whose entities were deleted
+        """
+        revision_ids = {}
+        for change_id, sg_entities in created_entities.iteritems():
+            for sg_entity in sg_entities:
+                if sg_entity.get("type") == "Revision":
+                    revision_ids[str(change_id)] = sg_entity["id"]
+        if not revision_ids:
+            return []
+        
+        try:
+            sg_res = self._shotgun.find("Revision", 
+                                        [["project", "is", self._app.context.project], 
+                                         ["code", "in", revision_ids.keys()]],
+                                        ["code"],
+                                        order=[{"field_name":"id", "direction":"asc"}])
+        except Exception, e:
+            self._app.log_error("Failed to determine if the Revision entities written for changes %s are the only "
+                                "entities registered for them - please check manually! (%s)" 
+                                % (", ".join(sorted(revision_ids)), e))
+            return []
+        first_revision_ids = {}
+        for sg_revision in sg_res:
+            first_revision_ids.setdefault(sg_revision["code"], sg_revision["id"])
+        
+        duplicate_changes = []
+        sg_batch_requests = []
+        for code, revision_id in revision_ids.iteritems():
+            if first_revision_ids.get(code, revision_id) == revision_id:
+                continue
+            # someone else got there first so delete everything we created for the change:
+            duplicate_changes.append(int(code))
+            for sg_entity in created_entities[int(code)]:
+                sg_batch_requests.append({"request_type":"delete", 
+                                          "entity_type":sg_entity["type"], 
+                                          "entity_id":sg_entity["id"]})
+        if sg_batch_requests:
+            self._app.log_debug("Deleting duplicate Revision entities for changes %s..." % sorted(duplicate_changes))
+            try:
+                self._shotgun.batch(sg_batch_requests)
+            except Exception, e:
+                self._app.log_error("Failed to delete duplicate change (Revision) entities for changes %s in "
+                                    "Shotgun - please fix manually! (%s)" % (sorted(duplicate_changes), e))
+        return duplicate_changes
+
+    def backfill_publish_depot_paths(self):
+        """
+        Set the depot path field on all published files in the project that were
+        registered before the field was added.
+        
+        :returns int:   The number of published files that were updated
+        """
+        with self._shotgun.lane(ShotgunScheduler.LANE_BULK):
+            return self.__publish_resolver.backfill_depot_paths()
+
+    def backfill_changes_from_journal(self, journal_paths, project_root=None, start_change=None, end_change=None):
+        """
+        Sync historical changes with Shotgun using the records in a Perforce checkpoint and/or
+        journal files instead of querying the Perforce server.  Changes go through the same
+        classification and publish registration as when syncing from the server, except
+        that publish and review data stored in Perforce isn't available.
+        
+        :param journal_paths:   The checkpoint and journal files to read, in order
+        :param project_root:    The depot root of the current project.  If not specified then
+                                the depot is searched for a single project root
+        :param start_change:    The first change to sync, defaults to the first submitted change
+        :param end_change:      The last change to sync, defaults to the 'change' counter
+        """
+        depot = JournalDepot(self._app, journal_paths)
+        depot.load()
+        
+        if not project_root:
+            project_roots = depot.find_config_roots(ShotgunSync.CONFIG_BACK_MAPPING_FILE_LOCATION)
+            if len(project_roots) != 1:
+                raise TankError("Found %d project roots in the journal (%s) - please specify the project root "
+                                "to backfill" % (len(project_roots), ", ".join(project_roots) or "none"))
+            project_root = project_roots[0]
+        project_root = project_root.rstrip("/")
+        self._app.log_info("Backfilling changes for depot project root '%s'" % project_root)
+
+        first_change, last_change = depot.get_change_range()
+        if start_change is None:
+            start_change = first_change
+        if end_change is None:
+            counter = depot.get_counter("change")
+            end_change = int(counter) if counter and counter.isdigit() else last_change
+        
+        p4 = OfflineP4(depot, project_root, self._app.sgtk.pipeline_configuration.get_path(), 
+                       ShotgunSync.CONFIG_BACK_MAPPING_FILE_LOCATION)
+        self.sync_changes(start_change, end_change, p4)
+
+    def spool_changes(self, spool, start_change=None, end_change=None, p4=None):
+        """
+        Read a range of changes from Perforce and append everything needed to write them to
+        Shotgun to the spool without writing anything to Shotgun.  The spool is applied
+        separately by apply_spool.
+        
+        :param spool:           The ChangeSpool to append to
+        :param start_change:    The first change to extract, defaults to the change after the
+                                last change extracted to the spool
+        :param end_change:      The last change to extract, defaults to the most recent change
+        :param p4:              An optional Perforce connection to use
+        :returns int:           The number of changes added to the spool
+        """
+        if start_change is None:
+            if not spool.last_extracted_change:
+                raise TankError("No changes have been extracted to the spool yet - please specify the start change")
+            start_change = spool.last_extracted_change + 1
+        
+        own_connection = p4 is None
+        if own_connection:
+            p4 = self.__connect_to_perforce()
+            if not p4:
+                return 0
+        try:
+            if end_change is None:
+                try:
+                    p4_res = p4.run_changes("-m", "1", "-s", "submitted")
+                except P4Exception, e:
+                    raise TankError("Failed to find the most recent change: %s" % (p4.errors[0] if p4.errors else e))
+                end_change = int(p4_res[0]["change"]) if p4_res else 0
+            if end_change < start_change:
+                self._app.log_info("No new changes to extract")
+                return 0
+            
+            self._app.log_info("Extracting changes %d - %d to the spool in '%s'..." 
+                               % (start_change, end_change, spool.location))
+            synced_changes = self.__find_synced_changes(start_change, end_change)
+            num_spooled = 0
+            for change_id in range(start_change, end_change+1):
+                if change_id not in synced_changes and self.__spool_change(spool, p4, change_id):
+                    num_spooled += 1
+                    spool.mark_extracted(change_id)
+            spool.mark_extracted(end_change)
+            return num_spooled
+        finally:
+            if own_connection:
+                p4.disconnect()
+
+    def apply_spool(self, spool, batch_size):
+        """
+        Write the changes in the spool to Shotgun.  Changes are applied in batches and 
+        anything that already exists in Shotgun (e.g. if a previous run was interrupted) 
+        is skipped, so this can safely be re-run at any time.
+        
+        :param spool:       The ChangeSpool to apply
+        :param batch_size:  The number of changes to write to Shotgun together
+        :returns int:       The number of spooled changes that were applied
+        """
+        num_applied = 0
+        with self._shotgun.lane(ShotgunScheduler.LANE_BULK):
+            while True:
+                entries = spool.read_pending(max(1, batch_size))
+                if not entries:
+                    break
+                self.__apply_spooled_changes([record for _, record in entries])
+                spool.mark_applied(entries[-1][0])
+                num_applied += len(entries)
+        return num_applied
+
+    def __spool_change(self, spool, p4, change_id):
+        """
+        Extract a single change and append it to the spool.
+        
+        :returns bool:  True if the change was added to the spool
+        """
+        temporary_files = set()
+        try:
+            record = self.__extract_change(p4, change_id, temporary_files)
+            if not record:
+                return False
+            spool.append(record)
+        except Exception, e:
+            self._app.log_exception("Failed to extract change %d" % change_id)
+            self.__record_failure(WorkQueue.KIND_CHANGE, change_id, WorkQueue.STAGE_CONTENTS, e)
+            # nothing will use the temporary files now:
+            self.__remove_temporary_files(temporary_files)
+            return False
+        return True
+
+    def __extract_change(self, p4, change_id, temporary_files):
+        """
+        Read everything needed to write a change to Shotgun from Perforce.  Any temporary 
+        files referenced by the publish and review data are kept until the change is applied.
+        
+        :param p4:                  The Perforce connection to use
+        :param change_id:           The id of the change to extract
+        :param temporary_files:     Set that any temporary files created will be added to
+        :returns dict:              The change record or None if the change doesn't need to be 
+                                    synced
+        """
+        try:
+            p4_res = p4.run_describe(change_id)
+        except P4Exception, e:
+            raise TankError("Failed to query perforce change %d: %s" % (change_id, p4.errors[0] if p4.errors else e))
+        if not p4_res:
+            return None
+        p4_change = P4Change.from_describe(p4_res[0])
+        if not p4_change.is_submitted or not self.is_change_in_context(p4, p4_change):
+            return None
+        
+        self._app.log_info("Extracting change %d" % change_id)
+        p4_file_details = self.__find_change_file_revisions(p4, str(change_id))
+        if p4_file_details is None:
+            return None
+        sg_user = self.__get_sg_user(p4_change.user)
+        
+        # files that are already published only need to be linked to the Revision:
+        valid_file_revisions = self.__validate_file_revisions(p4, p4_file_details, p4_change)
+        existing_publishes = self.__publish_resolver.resolve([fr[0] for fr in valid_file_revisions])
+        store_depot_path = self.__publish_resolver.has_depot_path_field()
+        
+        files = []
+        dependency_paths = set()
+        for path_revision, p4_file, path_context, content_key, reuse_content in valid_file_revisions:
+            spooled_file = {"depot_path":path_revision[0], "revision":path_revision[1]}
+            if path_revision not in existing_publishes:
+                res = self.__build_publish_data(p4, path_revision, p4_file, path_context, p4_change, 
+                                                sg_user, store_depot_path, temporary_files, content_key,
+                                                reuse_content)
+                if not res:
+                    continue
+                publish_data, dependency_info = res
+                publish_data["context"] = sgtk.context.serialize(publish_data["context"])
+                dependency_paths.update(dependency_info.get("paths") or [])
+                spooled_file["publish_data"] = publish_data
+                spooled_file["dependencies"] = dependency_info
+                spooled_file["review_data"] = self.__load_review_data(p4, change_id, path_revision[0], 
+                                                                      path_revision[1], sg_user, 
+                                                                      p4_change.client, temporary_files)
+            files.append(spooled_file)
+        
+        # the dependency revisions are found now so that Perforce isn't needed to apply the change:
+        dependency_revisions = {}
+        if dependency_paths:
+            dependency_revisions = self.__find_dependency_revisions(p4, change_id, dependency_paths)
+        
+        return {"change":p4_change.change,
+                "user":p4_change.user,
+                "client":p4_change.client,
+                "time":p4_change.time,
+                "desc":p4_change.desc,
+                "created_by":sg_user,
+                "files":files,
+                "dependency_revisions":dependency_revisions,
+                "temp_files":sorted(temporary_files)}
+
+    def __apply_spooled_changes(self, records):
+        """
+        Write a batch of spooled changes to Shotgun.  Publishes are registered individually
+        but the Revision entities and dependencies for all changes are created in a single
+        batch request.  The review Versions for a change are only created once its Revision
+        has been written so that applying the change again after a failure creates them
+        exactly once.
+        
+        :param records:     List of spooled change records
+        """
+        change_ids = [record["change"] for record in records]
+        synced_changes = self.__find_synced_changes(min(change_ids), max(change_ids))
+        pending_records = []
+        for record in records:
+            if record["change"] in synced_changes:
+                self._app.log_debug("Change %d has already been synced, skipping" % record["change"])
+                self.__remove_temporary_files(record.get("temp_files", []))
+            else:
+                pending_records.append(record)
+        if not pending_records:
+            return
+        
+        # find the existing publishes for all changes in one go - this also finds any
+        # publishes registered by a previous attempt to apply the same changes:
+        existing_publishes = self.__publish_resolver.resolve([(f["depot_path"], f["revision"]) 
+                                                              for record in pending_records 
+                                                              for f in record["files"]])
+        
+        write_buffer = ShotgunWriteBuffer(self._app, self._shotgun, sys.maxint, 0)
+        review_versions = {}
+        for record in pending_records:
+            change_id = record["change"]
+            self._app.log_info("Applying spooled change %d" % change_id)
+            try:
+                sg_requests, review_versions[change_id] = self.__build_spooled_change_requests(record, 
+                                                                                              existing_publishes)
+                write_buffer.add(change_id, sg_requests)
+            except Exception, e:
+                self._app.log_exception("Failed to apply spooled change %d" % change_id)
+                self.__record_failure(WorkQueue.KIND_CHANGE, change_id, WorkQueue.STAGE_CONTENTS, e)
+            finally:
+                self.__remove_temporary_files(record.get("temp_files", []))
+        
+        written, failed, created_entities = self.__flush_write_buffer(write_buffer)
+        for change_id, error in failed:
+            self._app.log_error("Failed to write Shotgun data for spooled change %d - %s" % (change_id, error))
+            self.__record_failure(WorkQueue.KIND_CHANGE, change_id, WorkQueue.STAGE_CONTENTS, error)
+        
+        # the changes may have been synced by something else whilst they were written, in
+        # which case the review Versions are left to whatever synced them:
+        duplicate_changes = self.__remove_duplicate_revisions(created_entities)
+        for change_id in sorted(written):
+            if change_id not in duplicate_changes and review_versions.get(change_id):
+                self.__create_review_versions(*review_versions[change_id])
+
+    def __build_spooled_change_requests(self, record, existing_publishes):
+        """
+        Register the new publishes for a spooled change and build the requests to create its 
+        Revision entity and dependencies.  Publishes that were registered by a previous attempt 
+        to apply the change aren't registered again but their dependencies and review data
+        are still used.
+        
+        :param record:                  The spooled change record
+        :param existing_publishes:      Dictionary of {(depot path, revision):published file entity}
+        :returns tuple:                 (list of Shotgun batch requests for the change,
+                                         arguments for __create_review_versions or None if there 
+                                         are no review Versions to create)
+        """
+        change_id = record["change"]
+        p4_change = P4Change(change_id, "submitted", record["user"], record["client"], record["time"], 
+                             record["desc"])
+        
+        publish_entities = {}
+        new_publish_dependencies = {}
+        new_publish_review_data = {}
+        for spooled_file in record["files"]:
+            path_revision = (spooled_file["depot_path"], spooled_file["revision"])
+            publish_data = spooled_file.get("publish_data")
+            sg_published_file = existing_publishes.get(path_revision)
+            if sg_published_file:
+                publish_entities[path_revision] = sg_published_file
+                if not publish_data:
+                    # the publish existed when the change was extracted:
+                    continue
+                # otherwise it was registered by a previous attempt to apply the change but 
+                # the Revision and dependencies, which are written together, weren't:
+            elif not publish_data:
+                # the publish existed when the change was extracted but has since been removed:
+                self._app.log_error("Published file for %s#%d no longer exists - unable to link it to change %d!" 
+                                    % (path_revision + (change_id,)))
+                self.__record_failure(WorkQueue.KIND_FILE, change_id, WorkQueue.STAGE_PUBLISH, 
+                                      "Published file not found", path_revision[0], path_revision[1])
+                continue
+            else:
+                publish_data["context"] = sgtk.context.deserialize(str(publish_data["context"]))
+                publish_data["tk"] = self._app.sgtk
+                sg_published_file = self.__register_publish(change_id, path_revision, publish_data)
+                if not sg_published_file:
+                    continue
+                publish_entities[path_revision] = {"type":sg_published_file["type"], "id":sg_published_file["id"]}
+            
+            new_publish_dependencies[path_revision] = spooled_file.get("dependencies") or {}
+            if spooled_file.get("review_data"):
+                new_publish_review_data[path_revision] = spooled_file["review_data"]
+        
+        dependency_publishes = {}
+        if new_publish_dependencies and record.get("dependency_revisions"):
+            dependency_publishes = self.__resolve_dependency_publishes(record["dependency_revisions"])
+        sg_requests = self.__build_dependency_requests(new_publish_dependencies, dependency_publishes, 
+                                                       publish_entities)
+        
+        # the Revision is created first so that it's in the same transaction as the dependencies:
+        change_data = self.__build_revision_data(p4_change, record.get("created_by"), publish_entities.values())
+        sg_requests.insert(0, {"request_type":"create", "entity_type":"Revision", "data":change_data})
+        
+        review_versions = None
+        if new_publish_review_data:
+            review_versions = (p4_change, new_publish_review_data, publish_entities)
+        return (sg_requests, review_versions)
+
+    def retry_failed_work(self, p4, change_id, work_items):
+        """
+        Retry work that previously failed for a change (see WorkQueue).  Any failures that
+        happen whilst retrying are returned rather than being added to the work queue.
+        
+        :param p4:          The Perforce connection to use
+        :param change_id:   The id of the change to retry the work for
+        :param work_items:  List of work item dictionaries for the change
+        :returns list:      List of failure dictionaries, each containing the kind, change, 
+                            stage, depot_path, revision and error of the failed work.  An
+                            empty list means that all work succeeded.
+        """
+        self.__failures = []
+        try:
+            try:
+                p4_res = p4.run_describe(change_id)
+            except P4Exception, e:
+                raise TankError("Failed to query perforce change %d: %s" 
+                                % (change_id, p4.errors[0] if p4.errors else e))
+            if not p4_res or p4_res[0].get("status") != "submitted":
+                raise TankError("Change %d is not a submitted change!" % change_id)
+            p4_change = P4Change.from_describe(p4_res[0])
+            
+            # the change may have been recorded because it couldn't be classified:
+            if not self.is_change_in_context(p4, p4_change):
+                self._app.log_info("Change %d isn't in this project, nothing to retry" % change_id)
+                return []
+            
+            # re-syncing the change contents will register any missing publishes and make
+            # sure the Revision entity is linked to them: 
+            if [item for item in work_items if item["stage"] != WorkQueue.STAGE_VERSIONS]:
+                sg_change = self._shotgun.find_one("Revision", 
+                                                  [["project", "is", self._app.context.project], 
+                                                   ["code", "is", str(change_id)]], 
+                                                  ["code"])
+                if not sg_change:
+                    sg_change = self.create_sg_entity_for_change(p4_change)
+                if sg_change:
+                    self.sync_change_contents(p4, p4_change, sg_change)
+                else:
+                    self.__record_failure(WorkQueue.KIND_CHANGE, change_id, WorkQueue.STAGE_CONTENTS, 
+                                          "Failed to find or create Revision entity")
+            
+            # the publishes already exist for any failed versions so these have to be 
+            # created directly:
+            path_revisions = [(item["depot_path"], item["revision"]) for item in work_items 
+                              if item["stage"] == WorkQueue.STAGE_VERSIONS]
+            if path_revisions:
+                self.__retry_review_versions(p4, p4_change, path_revisions)
+                
+        except Exception, e:
+            self._app.log_exception("Failed to retry work for change %d" % change_id)
+            self.__record_failure(WorkQueue.KIND_CHANGE, change_id, WorkQueue.STAGE_CONTENTS, e)
+        finally:
+            failures = self.__failures
+            self.__failures = None
+        return failures
+
+    def __retry_review_versions(self, p4, p4_change, path_revisions):
+        """
+        Create the review Versions for file revisions that were published previously.
+        
+        :param p4:              The Perforce connection to use
+        :param p4_change:       The P4Change the files were submitted in
+        :param path_revisions:  List of (depot path, revision) tuples to create Versions for
+        """
+        change_id = p4_change.change
+        sg_user = self.__get_sg_user(p4_change.user)
+        change_client = p4_change.client
+        
+        publish_entities = self.__publish_resolver.resolve(path_revisions)
+        temporary_files = set()
+        try:
+            review_data = {}
+            for depot_path, file_revision in path_revisions:
+                if (depot_path, file_revision) not in publish_entities:
+                    self.__record_failure(WorkQueue.KIND_FILE, change_id, WorkQueue.STAGE_VERSIONS, 
+                                          "Published file not found", depot_path, file_revision)
+                    continue
+                data = self.__load_review_data(p4, change_id, depot_path, file_revision, 
+                                               sg_user, change_client, temporary_files)
+                if data:
+                    review_data[(depot_path, file_revision)] = data
+            if review_data:
+                self.__create_review_versions(p4_change, review_data, publish_entities)
+        finally:
+            self.__remove_temporary_files(temporary_files)
+
+    def __get_published_file_field(self, refresh=False):
+        """
+        Determine the field on the Revision entity that published files should be linked
+        through.  This uses the cached schema so never reads the schema from Shotgun unless
+        a refresh is requested.
+        
+        :param refresh:    If True then the Revision schema will be re-read from Shotgun
+        :returns str:      The name of the published files field
+        """
+        if self.__published_file_field and not refresh:
+            return self.__published_file_field
+        
+        # ----------------------------------------------------------------------------------------------
+        # (TEMP) - whilst installing for testing, I messed up when creating the sg_published_files field 
+        # on the Revision entity, creating it with the wrong type!
+        # Until this is fixed, we need to check here to see if sg_publishedfiles should be used instead!
+        # Note: this won't affect other installs so it's safe to leave in here
+        published_file_entity_type = sgtk.util.get_published_file_entity_type(self._app.sgtk)
+        if refresh:
+            revision_schema = self.__schema_cache.refresh("Revision")
+        else:
+            revision_schema = self.__schema_cache.get("Revision")
+        pf_field = None
+        for field in ["published_files", "sg_published_files", "sg_publishedfiles"]:
+            schema = revision_schema.get(field)
+            try:
+                if (schema
+                    and schema.get("data_type", {}).get("value") == "multi_entity"
+                    and published_file_entity_type in schema.get("properties", {}).get("valid_types", {}).get("value", [])):
+                    # ok to use this field!
+                    pf_field = field
+                    break
+            except:
+                pass
+        # default to the 'correct' field anyway!
+        self.__published_file_field = pf_field or "published_files"
+        # ----------------------------------------------------------------------------------------------                
+        return self.__published_file_field
+
+    def __find_change_file_revisions(self, p4, change_id):
+        """
+        Find all file revisions in a change, excluding any deletes, move/deletes, etc.
+        
+        :param p4:          The Perforce connection to use
+        :param change_id:   The id of the change
+        :returns dict:      Dictionary of {(depot path, revision):P4FileRevision} or None if
+                            Perforce couldn't be queried
+        """
         p4_res = []
         try:
             p4_res = p4.run_fstat("-T", "depotFile, headRev, headModTime", 
@@ -259,72 +1226,32 @@ class ShotgunSync(object):
                                   "-e", change_id, 
                                   "//...")
         except P4Exception, e:
-            self._app.log_error("Failed to query file revisions for change %s: %s" 
-                                % (change_id, p4.errors[0] if p4.errors else e))
-            return
+            error = p4.errors[0] if p4.errors else e
+            self._app.log_error("Failed to query file revisions for change %s: %s" % (change_id, error))
+            self.__record_failure(WorkQueue.KIND_CHANGE, change_id, WorkQueue.STAGE_CONTENTS, error)
+            return None
 
         p4_file_details = {}
         for p4_file in p4_res:
-            depot_file = p4_file.get("depotFile")
-            head_rev = p4_file.get("headRev")
-            if not depot_file or not head_rev:
+            file_revision = P4FileRevision.from_fstat(p4_file)
+            if not file_revision:
                 continue
             
-            p4_file_details[(depot_file, int(head_rev))] = p4_file
-        
-        # process all remaining file revisions for the change, return a list of
-        # corresponding Shotgun entities:
-        published_file_entities = self.__process_file_revisions(p4, p4_file_details, p4_change)
-        if not published_file_entities:
-            return
-        
-        # ----------------------------------------------------------------------------------------------
-        # (TEMP) - whilst installing for testing, I messed up when creating the sg_published_files field 
-        # on the Revision entity, creating it with the wrong type!
-        # Until this is fixed, we need to check here to see if sg_publishedfiles should be used instead!
-        # Note: this won't affect other installs so it's safe to leave in here
-        published_file_entity_type = sgtk.util.get_published_file_entity_type(self._app.sgtk)
-        if not hasattr(self, "__published_file_field"):
-            pf_field = None
-            revision_schema = self._app.sgtk.shotgun.schema_field_read("Revision")
-            for field in ["published_files", "sg_published_files", "sg_publishedfiles"]:
-                schema = revision_schema.get(field)
-                try:
-                    if (schema
-                        and schema.get("data_type", {}).get("value") == "multi_entity"
-                        and published_file_entity_type in schema.get("properties", {}).get("valid_types", {}).get("value", [])):
-                        # ok to use this field!
-                        pf_field = field
-                        break
-                except:
-                    pass
-            # default to the 'correct' field anyway!
-            self.__published_file_field = pf_field or "published_files"
-        # ----------------------------------------------------------------------------------------------                
-        
-        # build the update data for the change:
-        change_data = {self.__published_file_field:[]}
-        for pf in published_file_entities:
-            change_data[self.__published_file_field].append({"type":pf["type"], "id":pf["id"]})
-            
-        # update the change:
-        self._app.log_debug("Updating Published files for change (Revision) entity %s..." % (sg_change_entity["code"]))
-        try:
-            self._app.shotgun.update("Revision", sg_change_entity["id"], change_data)
-        except Exception, e:
-            self._app.log_error("Failed to update revision entity %d - %s" % (sg_change_entity["id"], e))
+            p4_file_details[file_revision.path_revision] = file_revision
+        return p4_file_details
 
-    def __process_file_revisions(self, p4, p4_file_details, p4_change):
+    def __process_file_revisions(self, p4, p4_file_details, p4_change, deferred_requests=None):
         """
         Process all file revisions for a change.
+        
+        :param deferred_requests:   If a list is passed then the batch requests to create the
+                                    dependencies are added to it instead of being sent
         """
 
         # pull some useful info from the change:
-        sg_user = self.__get_sg_user(p4_change["user"])
-        change_id = int(p4_change["change"])        
-        change_client = p4_change.get("client", "")
-        change_desc = p4_change.get("desc", "")
-        change_time = datetime.fromtimestamp(int(p4_change["time"]))
+        sg_user = self.__get_sg_user(p4_change.user)
+        change_id = p4_change.change
+        change_client = p4_change.client
 
         temporary_files = set()
         try:
@@ -340,106 +1267,43 @@ class ShotgunSync(object):
             new_publish_dependencies = {} # dependency details for new publishes
             new_publish_review_data = {}
             
-            for path_revision, p4_file in p4_file_details.iteritems():
+            # first, check that the depot paths are Toolkit files:
+            valid_file_revisions = self.__validate_file_revisions(p4, p4_file_details, p4_change)
+            
+            # find existing publish entities for all valid files in one go:
+            existing_publishes = self.__publish_resolver.resolve([fr[0] for fr in valid_file_revisions])
+            store_depot_path = self.__publish_resolver.has_depot_path_field()
+            
+            for path_revision, p4_file, path_context, content_key, reuse_content in valid_file_revisions:
     
                 (depot_path, file_revision) = path_revision
                 
                 self._app.log_debug("Processing %s#%d" % path_revision)
                 
-                # first, check that the depot path is a Toolkit file:
-                path_is_valid, path_context = self.__validate_depot_path(depot_path, p4) 
-                if not path_is_valid:
-                    self._app.log_info("File '%s#%d' is not recognized by toolkit, skipping" % path_revision)
-                    continue
-                
                 # find existing publish entity if there is one:
-                sg_published_file = self.__find_publish_entity(depot_path, file_revision)
+                sg_published_file = existing_publishes.get(path_revision)
                 if not sg_published_file:
                     # Didn't find a published file so lets gather the data ready to be able to create one...
                     #
-                    publish_data = {}
-                    
-                    # load any publish data we have stored for this file:
-                    try:
-                        load_res = p4_fw.load_publish_data(depot_path, sg_user, change_client, file_revision, p4)
-                        if load_res and isinstance(load_res, dict):
-                            publish_data = load_res.get("data", {})
-                            temporary_files.update(load_res.get("temp_files", []))
-                    except TankError, e:
-                        self._app.log_error("Failed to load publish data for %s#%d: %s" % (depot_path, file_revision, e))
-                        continue
-                    except Exception, e:
-                        self._app.log_exception("Failed to load publish data for %s#%d" % path_revision)
-                        continue
-                    
-                    # try to ensure we have a valid context for the published file:
-                    context = publish_data.get("context")
-                    if not context:
-                        # Fall back to the context that was built from the path
-                        context = path_context
-                    if not context:
-                        self._app.log_error("Failed to determine context to use for %s#%d - unable to register publish!" 
-                                            % path_revision)
+                    res = self.__build_publish_data(p4, path_revision, p4_file, path_context, p4_change, 
+                                                    sg_user, store_depot_path, temporary_files, content_key,
+                                                    reuse_content)
+                    if not res:
                         continue
-                    if not context.project:
-                        self._app.log_error("Failed to determine project to use for %s#%d - unable to register publish!" 
-                                            % path_revision)
-                        continue
-                        
-                    # update publish data with additional information:
-                    publish_data["name"] = os.path.basename(depot_path)            
-                    publish_data["path"] = p4_fw.util.url_from_depot_path(depot_path, file_revision)
-                    publish_data["version_number"] = file_revision
-                    publish_data["comment"] = change_desc # Always use change list description for the comment!
-                    publish_data["created_by"] = sg_user
+                    publish_data, dependency_info = res
                     publish_data["tk"] = self._app.sgtk
-                    publish_data["context"] = context
-        
-                    publish_time = change_time
-                    head_mod_time = p4_file.get("headModTime")
-                    if head_mod_time:
-                        publish_time = datetime.fromtimestamp(int(head_mod_time))
-                    publish_data["created_at"] = publish_time            
-                    
-                    # extract the dependency data from the publish data - we'll
-                    # update this later once everything has been registered           
-                    dependency_ids = dependency_paths = []
-                    if "dependency_ids" in publish_data:
-                        dependency_ids = publish_data["dependency_ids"]
-                        del(publish_data["dependency_ids"])
-                    if "dependency_paths" in publish_data:
-                        dependency_paths = publish_data["dependency_paths"]
-                        del(publish_data["dependency_paths"])
-                    new_publish_dependencies[path_revision] = {"ids":dependency_ids, "paths":dependency_paths}
         
                     # register the new publish:
-                    self._app.log_info("Registering new published file: %s#%d" % path_revision)
-                    sg_published_file = None
-                    try:
-                        # Some notes about using register_publish with this data:
-                        # Note: Abstract fields won't get translated - if we need this functionality then 
-                        # we'll have to figure out how to handle it for this use case - non-trivial!
-                        sg_published_file = sgtk.util.register_publish(**publish_data)
-                    except Exception, e:
-                        self._app.log_error("Failed to register publish for '%s': %s" % (depot_path, e))
+                    sg_published_file = self.__register_publish(change_id, path_revision, publish_data)
+                    if not sg_published_file:
                         continue
                     
                     publish_entities[path_revision] = {"type":sg_published_file["type"], "id":sg_published_file["id"]}
+                    new_publish_dependencies[path_revision] = dependency_info
                     
                     # Finally, look for any review data to be registered for this published file:
-                    review_data = {}
-                    try:
-                        load_res = p4_fw.load_publish_review_data(depot_path, sg_user, change_client, file_revision, p4)
-                        if load_res and isinstance(load_res, dict):
-                            review_data = load_res.get("data")
-                            temporary_files.update(load_res.get("temp_files", []))                        
-                    except TankError, e:
-                        self._app.log_error("Failed to load review data for %s#%d: %s" % (depot_path, file_revision, e))
-                        continue
-                    except Exception, e:
-                        self._app.log_exception("Failed to load review data for %s#%d" % path_revision)
-                        continue
-        
+                    review_data = self.__load_review_data(p4, change_id, depot_path, file_revision, 
+                                                          sg_user, change_client, temporary_files)
                     if review_data:
                         new_publish_review_data[path_revision] = review_data
     
@@ -459,149 +1323,559 @@ class ShotgunSync(object):
     
             dependency_publishes = {}
             if all_dependency_paths:
-                # get perforce details for the paths at this change:
-                p4_paths = dict([("%s@%d" % (p, change_id), p) for p in all_dependency_paths])
-                p4_res = p4_fw.util.get_depot_file_details(p4, p4_paths.keys())
-        
-                # use the revision info retrieved from Perforce to find the
-                # Shotgun entities
-                for depot_path_key, p4_details in p4_res.iteritems():
-                    file_revision = p4_details.get("headRev") if p4_details else None
-                    if not file_revision:
-                        continue
-                    file_revision = int(file_revision)
-                    depot_path = p4_paths[depot_path_key]
-                    
-                    # find the entity from Shotgun:
-                    sg_published_file = self.__find_publish_entity(depot_path, file_revision)
-                    
-                    if sg_published_file:
-                        dependency_publishes[depot_path] = sg_published_file
+                dependency_revisions = self.__find_dependency_revisions(p4, change_id, all_dependency_paths)
+                dependency_publishes = self.__resolve_dependency_publishes(dependency_revisions)
     
             # update the dependency information in Shotgun where needed for the
             # newly created entities:
-            pf_entity_type = sgtk.util.get_published_file_entity_type(self._app.sgtk)
-            pf_dependency_type = "PublishedFileDependency" if pf_entity_type == "PublishedFile" else "TankDependency"
-            sg_batch_requests = []
-            
-            self._app.log_debug("Updating dependencies...")
-            for path_revision, info in new_publish_dependencies.iteritems():
-                (depot_path, file_revision) = path_revision
-                
-                dep_ids = set(info.get("ids", []))
-                dep_paths = info.get("paths", [])
-                
-                # convert dependency paths to ids:
-                for dep_path in dep_paths:
-                    dep_entity = dependency_publishes.get(dep_path)
-                    if not dep_entity:
-                        self._app.log_error("Failed to find Shotgun entity for dependency '%s' when processing %s#%d" 
-                                            % (dep_path, depot_path, file_revision))
-                        continue
-                    
-                    dep_ids.add(dep_entity["id"])
-                    
-                if not dep_ids:
-                    continue
-                    
-                # create sg update data:
-                publish_entity = publish_entities[path_revision]
-                for id in dep_ids:
-                    dependent_entity = {"type":pf_entity_type, "id":id}
-                                    
-                    create_data = None
-                    # handle both new and old style published file entity types - shouldn't be needed
-                    # but best to do just in case!
-                    if pf_entity_type == "PublishedFile":                
-                        create_data = {"published_file": publish_entity, 
-                                       "dependent_published_file": dependent_entity}
-                    else:# pf_entity_type == TankPublishedFile
-                        create_data = {"tank_published_file": publish_entity, 
-                                       "dependent_tank_published_file": dependent_entity}
-                    
-                    # add the request to the list to be processed:
-                    sg_batch_requests.append({"request_type": "create", 
-                                              "entity_type": pf_dependency_type,
-                                              "data":create_data})
+            sg_batch_requests = self.__build_dependency_requests(new_publish_dependencies, dependency_publishes, 
+                                                                 publish_entities)
     
-            if sg_batch_requests:
+            if deferred_requests is not None:
+                deferred_requests.extend(sg_batch_requests)
+            elif sg_batch_requests:
                 self._app.log_debug("Creating %d new dependencies in Shotgun..." % len(sg_batch_requests))
-                self._app.shotgun.batch(sg_batch_requests)                
+                self._shotgun.batch(sg_batch_requests)                
     
             # --------------------------------------------------------------------------------------------
             # --------------------------------------------------------------------------------------------
             # THIRD PASS:    
             # - if any review data was found for the new entities then process it:
             if new_publish_review_data:
-                
-                # first, consolidate data across entities:
-                consolidated_review_data = []
-                for path_revision, data in new_publish_review_data.iteritems():
-    
-                    found_entry = None
-                    for entry in consolidated_review_data:
-                         if entry["data"] == data:
-                             found_entry = entry
-                             break
-                         
-                    if not found_entry:
-                        # new data so add a new entry:
-                        found_entry = {"data":data, "publishes":list()}
-                        consolidated_review_data.append(found_entry)
-                        
-                    found_entry["publishes"].append(publish_entities[path_revision])
-    
-                # and create new Version entities for each consolidated review data:
-                for entry in consolidated_review_data:
-                    
-                    data = entry["data"]
-                    publishes = entry["publishes"]
-                    
-                    # update data:
-                    data["description"] = change_desc # Always use change list description for the comment!
-                    data["user"] = sg_user
-                    data["created_by"] = sg_user
-                    data["created_at"] = change_time
-                    
-                    uploaded_movie_path = None
-                    if "sg_uploaded_movie" in data:
-                        uploaded_movie_path = data["sg_uploaded_movie"]
-                        del(data["sg_uploaded_movie"])
-    
-                    if "published_files" in data:
-                        del(data["published_files"])
-    
-                    if pf_entity_type == "PublishedFile":
-                        data["published_files"] = publishes
-                    else:# == "TankPublishedFile"
-                        # the old tank published file link can only handle a single entity!
-                        data["tank_published_file"] = publishes[0]
-    
-                    try:
-                        # create the entity:                
-                        version_entity = self._app.shotgun.create("Version", data)
-        
-                        if uploaded_movie_path:
-                            # upload the movie:
-                            self._app.shotgun.upload("Version", 
-                                                       version_entity['id'], 
-                                                       uploaded_movie_path, 
-                                                       "sg_uploaded_movie" )
-                    except Exception, e:
-                        self._app.log_error("Failed to create Shotgun Version entity!: %s" % e)
+                self.__create_review_versions(p4_change, new_publish_review_data, publish_entities)
                             
         finally:
             # delete all temp files that were created:
-            for path in temporary_files:
-                if not os.path.exists(path):
-                    continue
-                try:
-                    os.remove(path)
-                except:
-                    pass
+            self.__remove_temporary_files(temporary_files)
                       
         return publish_entities.values()
 
+    def __validate_file_revisions(self, p4, p4_file_details, p4_change):
+        """
+        Filter the file revisions in a change to just those that Toolkit can process.  Files 
+        that were integrated, branched or copied from a different depot path with the same
+        content and project root relative path reuse the result for the file they came from.
+        
+        :param p4:                  The Perforce connection to use
+        :param p4_file_details:     Dictionary of {(depot path, revision):P4FileRevision}
+        :param p4_change:           The P4Change the file revisions belong to
+        :returns list:              List of ((depot path, revision), P4FileRevision, context, 
+                                    content key, reuse content) tuples for the valid file 
+                                    revisions.  The content key is None if the file's content 
+                                    isn't known and reuse content is True if the file can reuse
+                                    the publish data loaded for the file it came from
+        """
+        file_revisions = p4_file_details.items()
+        digests = dict(zip(p4_change.files.depot_files, p4_change.files.digests))
+        actions = dict(zip(p4_change.files.depot_files, p4_change.files.actions))
+        
+        content_keys = {}
+        reuse_content = {}
+        resolved = {}
+        to_resolve = []
+        for path_revision, p4_file in file_revisions:
+            depot_path = path_revision[0]
+            content_key = self.__get_content_key(p4, depot_path, digests.get(depot_path))
+            content_keys[path_revision] = content_key
+            content = self.__content_cache.get(content_key) if content_key else None
+            # a file resubmitted at the same depot path is always processed again:
+            reuse_content[path_revision] = bool(content and content["depot_path"] != depot_path
+                                                and actions.get(depot_path) in ShotgunSync.INTEGRATED_FILE_ACTIONS)
+            if reuse_content[path_revision]:
+                resolved[path_revision] = (content["valid"], content["context"])
+            else:
+                to_resolve.append(path_revision)
+        if len(to_resolve) < len(file_revisions):
+            self._app.log_debug("Reusing path validation for %d files with previously seen content" 
+                                % (len(file_revisions) - len(to_resolve)))
+        
+        if self.__path_resolver_pool and len(to_resolve) >= self.__path_resolver_min_files:
+            try:
+                resolved.update(self.__validate_depot_paths_in_pool(p4, to_resolve))
+            except Exception, e:
+                self._app.log_warning("Failed to resolve depot paths using the path resolver processes, "
+                                      "falling back to the main process: %s" % e)
+        
+        for path_revision in to_resolve:
+            if path_revision not in resolved:
+                resolved[path_revision] = self.__validate_depot_path(path_revision[0], p4)
+            content_key = content_keys[path_revision]
+            if content_key and not self.__content_cache.get(content_key):
+                path_is_valid, path_context = resolved[path_revision]
+                self.__content_cache.set(content_key, {"depot_path":path_revision[0], "valid":path_is_valid, 
+                                                       "context":path_context})
+        
+        valid_file_revisions = []
+        for path_revision, p4_file in file_revisions:
+            path_is_valid, path_context = resolved[path_revision]
+            if not path_is_valid:
+                self._app.log_info("File '%s#%d' is not recognized by toolkit, skipping" % path_revision)
+                continue
+            valid_file_revisions.append((path_revision, p4_file, path_context, content_keys[path_revision],
+                                         reuse_content[path_revision]))
+        return valid_file_revisions
+
+    def __validate_depot_paths_in_pool(self, p4, path_revisions):
+        """
+        Validate depot paths, matching templates and constructing contexts in the path resolver
+        processes.  Finding the tk instance for each path is done in the main process as it 
+        needs Perforce.
+        
+        :param p4:                  The Perforce connection to use
+        :param path_revisions:      List of (depot path, revision) tuples
+        :returns dict:              Dictionary of {(depot path, revision):(valid, context)}
+        """
+        context_pc_root = self._app.sgtk.pipeline_configuration.get_path()
+        
+        in_project = []
+        to_resolve = []
+        resolved = {}
+        for path_revision in path_revisions:
+            project_path = self.__get_project_relative_path(path_revision[0], p4)
+            if project_path:
+                tk, relative_path = project_path
+                to_resolve.append((tk.pipeline_configuration.get_path(), context_pc_root, relative_path))
+                in_project.append(path_revision)
+            else:
+                resolved[path_revision] = (False, None)
+        
+        self._app.log_debug("Resolving %d depot paths using the path resolver processes..." % len(to_resolve))
+        results = self.__path_resolver_pool.resolve(to_resolve)
+        
+        # the results are in the same order as the paths:
+        for path_revision, (path_is_valid, serialized_context) in zip(in_project, results):
+            path_context = None
+            if serialized_context:
+                path_context = self.__fill_task_from_step(sgtk.context.deserialize(serialized_context))
+            resolved[path_revision] = (path_is_valid, path_context)
+        return resolved
+
+    def __get_content_key(self, p4, depot_path, digest):
+        """
+        Return the key used to find information about previously processed files that have 
+        the same content and project root relative path as the specified file.
+        
+        :param p4:          The Perforce connection to use
+        :param depot_path:  The depot path of the file
+        :param digest:      The digest of the file revision's content
+        :returns tuple:     (digest, relative path) or None if the file can't be matched
+        """
+        if not digest:
+            return None
+        project_path = self.__get_project_relative_path(depot_path, p4)
+        if not project_path:
+            return None
+        return (digest, project_path[1])
+
+    def __build_publish_data(self, p4, path_revision, p4_file, path_context, p4_change, sg_user, 
+                             store_depot_path, temporary_files, content_key=None, reuse_content=False):
+        """
+        Gather the data needed to register a new publish for a file revision.  The returned
+        publish data doesn't include the 'tk' instance.
+        
+        :param p4:                  The Perforce connection to use
+        :param path_revision:       The (depot path, revision) of the file
+        :param p4_file:             The P4FileRevision for the file
+        :param path_context:        The context built from the depot path
+        :param p4_change:           The P4Change being processed
+        :param sg_user:             The Shotgun user that submitted the change
+        :param store_depot_path:    True if the depot path field should be set
+        :param temporary_files:     Set that any temporary files created will be added to
+        :param content_key:         The content key returned for the file by __validate_file_revisions
+        :param reuse_content:       True if publish data loaded for the file this one was copied from 
+                                    should be reused rather than loaded again, as returned by 
+                                    __validate_file_revisions
+        :returns tuple:             (publish data, {"ids":dependency ids, "paths":dependency paths})
+                                    or None if the publish can't be registered
+        """
+        (depot_path, file_revision) = path_revision
+        
+        content = self.__content_cache.get(content_key) if content_key else None
+        if reuse_content and content and "publish_data" in content:
+            self._app.log_debug("Reusing publish data for %s#%d from a file with the same content" % path_revision)
+            publish_data = dict(content["publish_data"])
+            dependency_info = content["dependency_info"]
+        else:
+            loaded_files = set()
+            res = self.__load_publish_data(p4, path_revision, path_context, p4_change, sg_user, loaded_files)
+            temporary_files.update(loaded_files)
+            if not res:
+                return None
+            publish_data, dependency_info = res
+            # publish data that references temporary files can't be reused as the files are
+            # removed once the change has been processed:
+            if content is not None and content["depot_path"] == depot_path and not loaded_files:
+                content["publish_data"] = dict(publish_data)
+                content["dependency_info"] = dependency_info
+            
+        # update publish data with additional information:
+        publish_data["name"] = os.path.basename(depot_path)            
+        publish_data["path"] = p4_fw.util.url_from_depot_path(depot_path, file_revision)
+        publish_data["version_number"] = file_revision
+        publish_data["comment"] = p4_change.desc # Always use change list description for the comment!
+        publish_data["created_by"] = sg_user
+
+        publish_time = p4_change.submitted_at
+        if p4_file.head_mod_time:
+            publish_time = datetime.fromtimestamp(p4_file.head_mod_time)
+        publish_data["created_at"] = publish_time            
+        
+        # store the depot path in its own field so that the publish can be found
+        # without having to parse the path url:
+        if store_depot_path:
+            sg_fields = dict(publish_data.get("sg_fields") or {})
+            sg_fields[PublishResolver.DEPOT_PATH_FIELD] = normalize_depot_path(depot_path)
+            publish_data["sg_fields"] = sg_fields
+        
+        return (publish_data, dependency_info)
+
+    def __load_publish_data(self, p4, path_revision, path_context, p4_change, sg_user, temporary_files):
+        """
+        Load the publish data stored for a file revision and determine the context to publish 
+        it with.
+        
+        :param p4:                  The Perforce connection to use
+        :param path_revision:       The (depot path, revision) of the file
+        :param path_context:        The context built from the depot path
+        :param p4_change:           The P4Change being processed
+        :param sg_user:             The Shotgun user that submitted the change
+        :param temporary_files:     Set that any temporary files created will be added to
+        :returns tuple:             (publish data, {"ids":dependency ids, "paths":dependency paths})
+                                    or None if the publish can't be registered
+        """
+        (depot_path, file_revision) = path_revision
+        change_id = p4_change.change
+        publish_data = {}
+        
+        # load any publish data we have stored for this file - this isn't 
+        # available when reading changes from a journal:
+        try:
+            load_res = None
+            if not isinstance(p4, OfflineP4):
+                load_res = p4_fw.load_publish_data(depot_path, sg_user, p4_change.client, file_revision, p4)
+            if load_res and isinstance(load_res, dict):
+                publish_data = load_res.get("data", {})
+                temporary_files.update(load_res.get("temp_files", []))
+        except TankError, e:
+            self._app.log_error("Failed to load publish data for %s#%d: %s" % (depot_path, file_revision, e))
+            self.__record_failure(WorkQueue.KIND_FILE, change_id, WorkQueue.STAGE_PUBLISH, e, 
+                                  depot_path, file_revision)
+            return None
+        except Exception, e:
+            self._app.log_exception("Failed to load publish data for %s#%d" % path_revision)
+            self.__record_failure(WorkQueue.KIND_FILE, change_id, WorkQueue.STAGE_PUBLISH, e, 
+                                  depot_path, file_revision)
+            return None
+        
+        # try to ensure we have a valid context for the published file:
+        context = publish_data.get("context")
+        if not context:
+            # Fall back to the context that was built from the path
+            context = path_context
+        if not context:
+            self._app.log_error("Failed to determine context to use for %s#%d - unable to register publish!" 
+                                % path_revision)
+            return None
+        if not context.project:
+            self._app.log_error("Failed to determine project to use for %s#%d - unable to register publish!" 
+                                % path_revision)
+            return None
+            
+        publish_data["context"] = context
+        
+        # extract the dependency data from the publish data - we'll
+        # update this later once everything has been registered           
+        dependency_ids = dependency_paths = []
+        if "dependency_ids" in publish_data:
+            dependency_ids = publish_data["dependency_ids"]
+            del(publish_data["dependency_ids"])
+        if "dependency_paths" in publish_data:
+            dependency_paths = publish_data["dependency_paths"]
+            del(publish_data["dependency_paths"])
+        
+        return (publish_data, {"ids":dependency_ids, "paths":dependency_paths})
+
+    def __register_publish(self, change_id, path_revision, publish_data):
+        """
+        Register a new publish in Shotgun.
+        
+        :param change_id:       The id of the change being processed
+        :param path_revision:   The (depot path, revision) of the file
+        :param publish_data:    The arguments to pass to register_publish
+        :returns dict:          The new published file entity or None if it failed
+        """
+        (depot_path, file_revision) = path_revision
+        self._app.log_info("Registering new published file: %s#%d" % path_revision)
+        try:
+            # Some notes about using register_publish with this data:
+            # Note: Abstract fields won't get translated - if we need this functionality then 
+            # we'll have to figure out how to handle it for this use case - non-trivial!
+            # register_publish uses Toolkit's Shotgun connection so it's called through the
+            # scheduler to be rate limited with everything else:
+            sg_published_file = self._shotgun.call(sgtk.util.register_publish, **publish_data)
+        except Exception, e:
+            self._app.log_error("Failed to register publish for '%s': %s" % (depot_path, e))
+            self.__record_failure(WorkQueue.KIND_FILE, change_id, WorkQueue.STAGE_PUBLISH, e, 
+                                  depot_path, file_revision)
+            return None
+        
+        self.__publish_resolver.add(depot_path, file_revision, sg_published_file)
+        return sg_published_file
+
+    def __find_dependency_revisions(self, p4, change_id, dependency_paths):
+        """
+        Find the revision of each dependency path at the specified change.
+        
+        :param p4:                  The Perforce connection to use
+        :param change_id:           The id of the change being processed
+        :param dependency_paths:    The depot paths of the dependencies
+        :returns dict:              Dictionary of {depot path:revision} for all paths found
+        """
+        # get perforce details for the paths at this change:
+        p4_paths = dict([("%s@%d" % (p, int(change_id)), p) for p in dependency_paths])
+        p4_res = p4_fw.util.get_depot_file_details(p4, p4_paths.keys())
+
+        dependency_revisions = {}
+        for depot_path_key, p4_details in p4_res.iteritems():
+            file_revision = p4_details.get("headRev") if p4_details else None
+            if not file_revision:
+                continue
+            dependency_revisions[p4_paths[depot_path_key]] = int(file_revision)
+        return dependency_revisions
+
+    def __resolve_dependency_publishes(self, dependency_revisions):
+        """
+        Find the published files for the specified dependency revisions in one go.
+        
+        :param dependency_revisions:    Dictionary of {depot path:revision}
+        :returns dict:                  Dictionary of {depot path:published file entity}
+        """
+        dependency_publishes = {}
+        sg_published_files = self.__publish_resolver.resolve(dependency_revisions.items())
+        for depot_path, file_revision in dependency_revisions.iteritems():
+            sg_published_file = sg_published_files.get((depot_path, file_revision))
+            if sg_published_file:
+                dependency_publishes[depot_path] = sg_published_file
+        return dependency_publishes
+
+    def __build_dependency_requests(self, new_publish_dependencies, dependency_publishes, publish_entities):
+        """
+        Build the batch requests to create the dependencies for newly registered publishes.
+        
+        :param new_publish_dependencies:    Dictionary of {(depot path, revision):{"ids":[], "paths":[]}}
+        :param dependency_publishes:        Dictionary of {depot path:published file entity} for the
+                                            dependency paths
+        :param publish_entities:            Dictionary of {(depot path, revision):published file entity}
+        :returns list:                      The Shotgun batch requests
+        """
+        pf_entity_type = sgtk.util.get_published_file_entity_type(self._app.sgtk)
+        pf_dependency_type = "PublishedFileDependency" if pf_entity_type == "PublishedFile" else "TankDependency"
+        sg_batch_requests = []
+        
+        self._app.log_debug("Updating dependencies...")
+        for path_revision, info in new_publish_dependencies.iteritems():
+            (depot_path, file_revision) = path_revision
+            
+            dep_ids = set(info.get("ids", []))
+            dep_paths = info.get("paths", [])
+            
+            # convert dependency paths to ids:
+            for dep_path in dep_paths:
+                dep_entity = dependency_publishes.get(dep_path)
+                if not dep_entity:
+                    self._app.log_error("Failed to find Shotgun entity for dependency '%s' when processing %s#%d" 
+                                        % (dep_path, depot_path, file_revision))
+                    continue
+                
+                dep_ids.add(dep_entity["id"])
+                
+            if not dep_ids:
+                continue
+                
+            # create sg update data:
+            publish_entity = publish_entities[path_revision]
+            for id in dep_ids:
+                dependent_entity = {"type":pf_entity_type, "id":id}
+                                
+                create_data = None
+                # handle both new and old style published file entity types - shouldn't be needed
+                # but best to do just in case!
+                if pf_entity_type == "PublishedFile":                
+                    create_data = {"published_file": publish_entity, 
+                                   "dependent_published_file": dependent_entity}
+                else:# pf_entity_type == TankPublishedFile
+                    create_data = {"tank_published_file": publish_entity, 
+                                   "dependent_tank_published_file": dependent_entity}
+                
+                # add the request to the list to be processed:
+                sg_batch_requests.append({"request_type": "create", 
+                                          "entity_type": pf_dependency_type,
+                                          "data":create_data})
+        return sg_batch_requests
+
+    def __remove_temporary_files(self, temporary_files):
+        """
+        Delete temporary files created whilst loading publish & review data.
+        
+        :param temporary_files:    The paths of the temporary files to delete
+        """
+        for path in temporary_files:
+            if not os.path.exists(path):
+                continue
+            try:
+                os.remove(path)
+            except:
+                pass
+
+    def __load_review_data(self, p4, change_id, depot_path, file_revision, sg_user, change_client, temporary_files):
+        """
+        Load any review data stored for the specified file revision.
+        
+        :param p4:                  The Perforce connection to use
+        :param change_id:           The id of the change being processed
+        :param depot_path:          The depot path of the file
+        :param file_revision:       The revision of the file
+        :param sg_user:             The Shotgun user that submitted the change
+        :param change_client:       The client (workspace) the change was submitted from
+        :param temporary_files:     Set that any temporary files created will be added to
+        :returns dict:              The review data if there is any, otherwise None
+        """
+        if isinstance(p4, OfflineP4):
+            # review data is stored in Perforce so isn't available offline:
+            return None
+        try:
+            load_res = p4_fw.load_publish_review_data(depot_path, sg_user, change_client, file_revision, p4)
+            if load_res and isinstance(load_res, dict):
+                temporary_files.update(load_res.get("temp_files", []))                        
+                return load_res.get("data")
+        except TankError, e:
+            self._app.log_error("Failed to load review data for %s#%d: %s" % (depot_path, file_revision, e))
+            self.__record_failure(WorkQueue.KIND_FILE, change_id, WorkQueue.STAGE_VERSIONS, e, 
+                                  depot_path, file_revision)
+        except Exception, e:
+            self._app.log_exception("Failed to load review data for %s#%d" % (depot_path, file_revision))
+            self.__record_failure(WorkQueue.KIND_FILE, change_id, WorkQueue.STAGE_VERSIONS, e, 
+                                  depot_path, file_revision)
+
+    def __create_review_versions(self, p4_change, new_publish_review_data, publish_entities):
+        """
+        Create Version entities for the review data found for newly registered publishes.
+        
+        :param p4_change:                   The P4Change being processed
+        :param new_publish_review_data:     Dictionary of {(depot path, revision):review data}
+        :param publish_entities:            Dictionary of {(depot path, revision):published file entity}
+        """
+        sg_user = self.__get_sg_user(p4_change.user)
+        change_id = p4_change.change
+        change_desc = p4_change.desc
+        change_time = p4_change.submitted_at
+        pf_entity_type = sgtk.util.get_published_file_entity_type(self._app.sgtk)
+        
+        # first, consolidate data across entities - entries are grouped by a
+        # canonical hash of their review data rather than by comparing every
+        # pair of entries:
+        consolidated_review_data = {}
+        for path_revision, data in new_publish_review_data.iteritems():
+            data_key = _canonical_hash(data)
+            found_entry = consolidated_review_data.get(data_key)
+            if not found_entry:
+                # new data so add a new entry:
+                found_entry = {"data":data, "publishes":list(), "path_revisions":list()}
+                consolidated_review_data[data_key] = found_entry
+                
+            found_entry["publishes"].append(publish_entities[path_revision])
+            found_entry["path_revisions"].append(path_revision)
+
+        # build the Version create requests for each consolidated review data:
+        version_requests = []
+        for entry in consolidated_review_data.values():
+            
+            data = entry["data"]
+            publishes = entry["publishes"]
+            
+            # update data:
+            data["description"] = change_desc # Always use change list description for the comment!
+            data["user"] = sg_user
+            data["created_by"] = sg_user
+            data["created_at"] = change_time
+            
+            uploaded_movie_path = None
+            if "sg_uploaded_movie" in data:
+                uploaded_movie_path = data["sg_uploaded_movie"]
+                del(data["sg_uploaded_movie"])
+
+            if "published_files" in data:
+                del(data["published_files"])
+
+            if pf_entity_type == "PublishedFile":
+                data["published_files"] = publishes
+            else:# == "TankPublishedFile"
+                # the old tank published file link can only handle a single entity!
+                data["tank_published_file"] = publishes[0]
+                
+            version_requests.append(({"request_type": "create", 
+                                      "entity_type": "Version", 
+                                      "data": data}, 
+                                     uploaded_movie_path,
+                                     entry["path_revisions"]))
+
+        # and create the Version entities in chunks:
+        self.__create_versions(change_id, version_requests)
+
+    def __create_versions(self, change_id, version_requests):
+        """
+        Create Version entities in Shotgun using chunked batch requests and then upload
+        any movies for the newly created entities.
+        
+        :param change_id:           The id of the change being processed
+        :param version_requests:    List of (batch request, uploaded movie path, path revisions) tuples
+        """
+        chunk_size = ShotgunSync.VERSION_BATCH_SIZE
+        for chunk_start in range(0, len(version_requests), chunk_size):
+            chunk = version_requests[chunk_start:chunk_start+chunk_size]
+            
+            self._app.log_debug("Creating %d new Version entities in Shotgun..." % len(chunk))
+            try:
+                version_entities = self._shotgun.batch([request for request, _, _ in chunk])
+            except Exception, e:
+                self._app.log_error("Failed to create Shotgun Version entities!: %s" % e)
+                for _, _, path_revisions in chunk:
+                    for depot_path, file_revision in path_revisions:
+                        self.__record_failure(WorkQueue.KIND_FILE, change_id, WorkQueue.STAGE_VERSIONS, e, 
+                                              depot_path, file_revision)
+                continue
+
+            # upload any movies for the new versions:
+            for version_entity, (_, uploaded_movie_path, _) in zip(version_entities, chunk):
+                if not uploaded_movie_path:
+                    continue
+                try:
+                    self._shotgun.upload("Version", 
+                                        version_entity['id'], 
+                                        uploaded_movie_path, 
+                                        "sg_uploaded_movie" )
+                except Exception, e:
+                    self._app.log_error("Failed to upload movie for Shotgun Version entity %d!: %s" 
+                                        % (version_entity["id"], e))
+
+    def __record_failure(self, kind, change_id, stage, error, depot_path="", revision=0):
+        """
+        Record work that failed so that it can be retried later.
+        
+        :param kind:        The kind of work item, WorkQueue.KIND_CHANGE or WorkQueue.KIND_FILE
+        :param change_id:   The id of the change the work is for
+        :param stage:       The stage that failed
+        :param error:       The error that caused the failure
+        :param depot_path:  The depot path of the file, for file items
+        :param revision:    The revision of the file, for file items
+        """
+        if self.__failures is not None:
+            # currently retrying work so let the caller deal with the failure:
+            self.__failures.append({"kind":kind, "change":int(change_id), "stage":stage, "error":str(error), 
+                                    "depot_path":depot_path or "", "revision":int(revision or 0)})
+        elif self.__work_queue:
+            self.__work_queue.add(kind, change_id, stage, error, depot_path, revision)
+
     def __validate_depot_path(self, depot_path, p4):
         """
         Validate that the depot path is a file that Toolkit understands (it's in the same project this
@@ -616,24 +1890,15 @@ class ShotgunSync(object):
         :returns (Boolean, Context):  True/False if the depot path is a valid Toolkit path, together
                                       with a context created from the path if it is.
         """
-        # find the depot root and tk instance for the depot path:
-        details = self.__find_file_details(depot_path, p4)
-        if not details:
-            # the path is not under a Toolkit storage
+        project_path = self.__get_project_relative_path(depot_path, p4)
+        if not project_path:
             return (False, None)
-        depot_project_root, tk = details
-        
-        # check that this tk instance is for the same project we're running in:
-        if tk.pipeline_configuration.get_project_id() != self._app.context.project["id"]:
-            # it isn't!
-            return (False, None)     
+        tk, depot_root_relative_path = project_path
         
         # Check all data roots to see if this is recognized by the Toolkit instance.  If no valid 
         # template can be found then Toolkit won't understand the file.
+        # (note, this logic is repeated in the path resolver processes)
         template = None
-        depot_root_relative_path = depot_path[len(depot_project_root):].lstrip("\\/")
-        # make sure we use the unquoted version of the depot path:
-        depot_root_relative_path = urllib.unquote(depot_root_relative_path)
         for data_root in tk.roots.values():
             proxy_local_path = os.path.join(data_root, depot_root_relative_path)
             try:
@@ -652,41 +1917,51 @@ class ShotgunSync(object):
         # - maybe be able to set the project root and then set it to depot_project_root?
         # - this would also allow template_from_path to work on depot paths...        
         context = self._app.sgtk.context_from_path(proxy_local_path)
-                
-        # if we don't have a task but do have a step then try to determine the task from the step:
+        
+        return (True, self.__fill_task_from_step(context))
+
+    def __get_project_relative_path(self, depot_path, p4):
+        """
+        Find the tk instance for the depot path and the path relative to the depot project root,
+        as long as the path is in the same project this command is running in.
+        
+        :param depot_path:      The depot path to check
+        :param p4:              The Perforce connection to use
+        :returns (Sgtk, str):   Tuple containing (sgtk instance, unquoted project root relative 
+                                path) or None if the path isn't in this project
+        """
+        # find the depot root and tk instance for the depot path:
+        details = self.__find_file_details(depot_path, p4)
+        if not details:
+            # the path is not under a Toolkit storage
+            return None
+        depot_project_root, tk = details
+        
+        # check that this tk instance is for the same project we're running in:
+        if tk.pipeline_configuration.get_project_id() != self._app.context.project["id"]:
+            # it isn't!
+            return None
+        
+        depot_root_relative_path = depot_path[len(depot_project_root):].lstrip("\\/")
+        # make sure we use the unquoted version of the depot path:
+        return (tk, urllib.unquote(depot_root_relative_path))
+
+    def __fill_task_from_step(self, context):
+        """
+        If the context doesn't have a task but does have a step then try to determine the task
+        from the step.
+        
+        :param context:     The context to check
+        :returns Context:   The context with the task filled in if it could be found
+        """
         # (TODO) - this logic should be moved to a hook (probably in core!) as it won't work if 
         # there are Multiple tasks on the same entity that use the same Step!
         if context and not context.task:
             if context.entity and context.step:
-                sg_res = self._app.shotgun.find("Task", [["step", "is", context.step], ["entity", "is", context.entity]])
+                sg_res = self._shotgun.find("Task", [["step", "is", context.step], ["entity", "is", context.entity]])
                 if sg_res and len(sg_res) == 1:
                     context = self._app.sgtk.context_from_entity(sg_res[0]["type"], sg_res[0]["id"])
-        
-        return (True, context)        
-
-    def __find_publish_entity(self, depot_path, revision):
-        """
-        Find the publish entity for a specific revision of a depot path
-        
-        :param depot_path:    The depot path to check
-        :param revision:      The revision to check
-        :returns dict:        A Shotgun entity dictionary for a PublishedFile
-                              entity if found, otherwise None
-        """
-        pf_entity_type = sgtk.util.get_published_file_entity_type(self._app.sgtk)
-        # (TODO) - improve this filter so that it returns less stuff
-        # Unfortunately we can't currently filter on path!
-        filters = [["project", "is", self._app.context.project],
-                   ["version_number", "is", int(revision)]]
-        sg_res = self._app.shotgun.find(pf_entity_type, filters, ["id", "path", "version"])
-        sg_published_file = None
-        for sg_entity in sg_res:
-            url = sg_entity.get("path", {}).get("url")
-            if url:
-                path_and_version = p4_fw.util.depot_path_from_url(url)
-                if path_and_version and path_and_version[0] == depot_path:
-                    # found it!
-                    return {"type":sg_entity["type"], "id":sg_entity["id"]}
+        return context
 
     def __find_file_details(self, depot_path, p4):
         """
@@ -696,11 +1971,13 @@ class ShotgunSync(object):
         :param depot_path:        Depot path to check
         :param p4:                Perforce connection to use
         :returns (str, Sgtk):     Tuple containing (depot project root, sgtk instance)
+        :raises P4Exception:      If Perforce couldn't be queried, in which case nothing is
+                                  cached for the path
         """
         # first, check the cache to see if we found this information previously:
-        if depot_path in self.__depot_path_details_cache:
-            return self.__depot_path_details_cache.get(depot_path)
-        self.__depot_path_details_cache[depot_path] = None
+        found, res = self.__depot_path_details_cache.lookup(depot_path)
+        if found:
+            return res
         
         self._app.log_debug("Looking for file details for: '%s'" % depot_path)        
         
@@ -710,6 +1987,7 @@ class ShotgunSync(object):
             # didn't find a project root so this file is probably not
             # within a Toolkit data directory!
             self._app.log_debug(" > No depot root found, depot path is not contained in project storage!")
+            self.__depot_path_details_cache.set(depot_path, None)
             return
         self._app.log_debug(" > Depot project root found: '%s'" % depot_project_root)
         
@@ -719,6 +1997,7 @@ class ShotgunSync(object):
             # didn't find a matching pipeline configuration location!
             self._app.log_error("Failed to locate pipeline configuration for depot project root '%s'" 
                                 % depot_project_root)
+            self.__depot_path_details_cache.set(depot_path, None)
             return
         self._app.log_debug(" > Local PC root found: '%s'" % local_pc_root)
         
@@ -733,10 +2012,10 @@ class ShotgunSync(object):
                 self._app.log_error(" > Failed to create TK instance for PC root '%s'" % local_pc_root)
                 # this shouldn't happen so raise this error:
                 raise    
-            self.__pc_tk_instances[local_pc_root] = tk
+            self.__pc_tk_instances.set(local_pc_root, tk)
 
         res = (depot_project_root, tk)
-        self.__depot_path_details_cache[depot_path] = res
+        self.__depot_path_details_cache.set(depot_path, res)
         
         return res
 
@@ -771,32 +2050,56 @@ class ShotgunSync(object):
         :returns str:         The depot-relative project root
         """
         # first, check to see if depot_path is under a known project root:
-        for pr in self.__project_roots:
+        for pr in self.__project_roots.keys():
             if depot_path.startswith(pr):
                 return pr
         
-        # start search from project root:
-        project_root = depot_path
+        # start search from the directory containing the file:
+        return self.__get_directory_project_root(depot_path[:depot_path.rfind("/")], p4)
+    
+    def __get_directory_project_root(self, directory, p4):
+        """
+        Find the depot-relative project root for the specified depot directory.  The result
+        is cached for the directory and every parent directory that had to be checked, 
+        including when no root is found, so each directory is only checked once.
         
-        while len(project_root):
-            project_root = project_root[:project_root.rfind("/") or 0].rstrip("/")
-            if not project_root:
+        :param directory:    The depot directory to find the project root for
+        :param p4:           The Perforce connection to use
+        :returns str:        The depot-relative project root or None if the directory isn't
+                             within a project
+        :raises P4Exception: If Perforce couldn't be queried, in which case nothing is cached
+        """
+        project_root = None
+        checked_directories = []
+        directory = directory.rstrip("/")
+        while directory:
+            found, root = self.__directory_project_roots.lookup(directory)
+            if found:
+                project_root = root
                 break
+            checked_directories.append(directory)
             
-            tank_configs_path = "%s/%s" % (project_root, ShotgunSync.CONFIG_BACK_MAPPING_FILE_LOCATION)
+            tank_configs_path = "%s/%s" % (directory, ShotgunSync.CONFIG_BACK_MAPPING_FILE_LOCATION)
             try:
                 # see if this file exists in the depot:
                 p4_res = p4.run_files(tank_configs_path)
                 if p4_res:
                     # it does - win!
+                    project_root = directory
                     break
             except P4Exception:
-                # ignore perforce exceptions!
-                pass
+                if p4.errors:
+                    # Perforce couldn't be queried so we don't know if the file exists:
+                    raise
+                # otherwise the file doesn't exist which is reported as a warning
+            
+            directory = directory[:directory.rfind("/") or 0].rstrip("/")
         
-        # cache project root for next time:
+        # cache the result for all directories checked for next time:
+        for checked_directory in checked_directories:
+            self.__directory_project_roots.set(checked_directory, project_root)
         if project_root:
-            self.__project_roots.add(project_root)
+            self.__project_roots.set(project_root, True)
         
         return project_root
     
@@ -807,27 +2110,31 @@ class ShotgunSync(object):
         :param project_root:    The depot relative project root
         :param p4:              The Perforce connection to use
         :returns str:           The local pipeline configuration root directory
+        :raises P4Exception:    If Perforce couldn't be queried, in which case nothing is cached
         """
         # first, check to see if info is in cache:
-        pc_root = self.__project_pc_roots.get(project_root)
-        if pc_root != None:
+        found, pc_root = self.__project_pc_roots.lookup(project_root)
+        if found:
             return pc_root
-        self.__project_pc_roots[project_root] = ""
         
         # check that the tank_configs.yml file is in the correct place:
         tank_configs_path = "%s/%s" % (project_root, ShotgunSync.CONFIG_BACK_MAPPING_FILE_LOCATION)        
         try:
             p4.run_files(tank_configs_path)
         except P4Exception, e:
+            if p4.errors:
+                raise
             # bad - file not found!
             self._app.log_error("Configuration file '%s' does not exist in the Perforce depot: %s" 
-                           % (tank_configs_path, p4.errors[0] if p4.errors else e))
+                           % (tank_configs_path, p4.warnings[0] if p4.warnings else e))
+            self.__project_pc_roots.set(project_root, None)
             return None
 
         # read the pc root path from the config file:
         try:
             p4_res = p4.run_print(tank_configs_path)
             if not p4_res:
+                self.__project_pc_roots.set(project_root, None)
                 return None
             
             # [{'rev': '1', ...}, "- {darwin: /toolkit_perforce/shotgun/zombie_racer_5, ..."]
@@ -842,14 +2149,18 @@ class ShotgunSync(object):
             local_pc_root = config[0][sys.platform]
 
         except P4Exception, e:
-            self._app.log_error("Failed to determine project root: %s" % (p4.errors[0] if p4.errors else e))
+            if p4.errors:
+                raise
+            self._app.log_error("Failed to determine project root: %s" % (p4.warnings[0] if p4.warnings else e))
+            self.__project_pc_roots.set(project_root, None)
             return None
         except Exception, e:
             self._app.log_error("Failed to determine project root: %s" % e)
+            self.__project_pc_roots.set(project_root, None)
             return None
         
         # cache in case we need it again:
-        self.__project_pc_roots[project_root] = local_pc_root
+        self.__project_pc_roots.set(project_root, local_pc_root)
         
         return local_pc_root 
             
\ No newline at end of file
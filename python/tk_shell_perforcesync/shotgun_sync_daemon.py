@@ -22,6 +22,12 @@ p4_fw = sgtk.platform.get_framework("tk-framework-perforce")
 from P4 import P4Exception
 
 from .shotgun_sync import ShotgunSync
+from .change_claim import ChangeClaim
+from .counter_manager import CounterManager
+from .change_lookahead import ChangeLookahead
+from .change_lease import ChangeLeaseManager, P4CounterLeaseBackend, LocalLeaseBackend
+from .change_worker_pool import ChangeWorkerPool, ConcurrencyController
+from .util import get_shared_cache_location
 
 class ShotgunSyncDaemon(object):
     """
@@ -30,6 +36,9 @@ class ShotgunSyncDaemon(object):
     """
     P4_COUNTER_BASE_NAME = "tk_perforcesync_project_"
     
+    # interval in seconds between logging cache statistics:
+    CACHE_STATS_INTERVAL = 3600
+    
     def __init__(self, app, start_change=None, p4_user=None, p4_pass=None):
         """
         Construction
@@ -50,12 +59,74 @@ class ShotgunSyncDaemon(object):
         
         self._p4_counter_name = "%s%d" % (ShotgunSyncDaemon.P4_COUNTER_BASE_NAME, self.__app.context.project["id"])
         self._p4_sync = ShotgunSync(self.__app, self.__p4_user, self.__p4_pass)
+        self._change_claim = ChangeClaim(self.__app, self._p4_counter_name)
+        self._counter = CounterManager(self.__app, 
+                                       self._p4_counter_name, 
+                                       self.__app.get_setting("counter_flush_interval"),
+                                       self.__app.get_setting("counter_flush_changes"))
+        
+        # changes are described in blocks and kept until they're needed:
+        self._lookahead = ChangeLookahead(self.__app, 
+                                          self.__p4_user, 
+                                          self.__p4_pass,
+                                          self.__app.get_setting("describe_block_size"),
+                                          self.__app.get_setting("prefetch_changes"),
+                                          self._p4_sync.is_change_known_to_be_foreign)
+        
+        # when running in lease mode, each daemon works through its own range of changes:
+        self._lease_manager = None
+        self.__lease = None
+        if self.__app.get_setting("coordination_mode") == "lease":
+            if self.__app.get_setting("lease_backend") == "local":
+                backend = LocalLeaseBackend(get_shared_cache_location(self.__app))
+            else:
+                backend = P4CounterLeaseBackend()
+            self._lease_manager = ChangeLeaseManager(self.__app, 
+                                                     self._p4_counter_name, 
+                                                     backend,
+                                                     self.__app.get_setting("lease_range_size"),
+                                                     self.__app.get_setting("lease_ttl"))
+        
+        # changes can be processed by a pool of workers whose size is adjusted as needed:
+        self._worker_pool = None
+        self._concurrency_controller = None
+        if not self._lease_manager and self.__app.get_setting("max_change_workers") > 1:
+            self._concurrency_controller = ConcurrencyController(self.__app,
+                                                                 self.__app.get_setting("min_change_workers"),
+                                                                 self.__app.get_setting("max_change_workers"))
+            self._worker_pool = ChangeWorkerPool(self.__app, self._p4_sync, self.__p4_user, self.__p4_pass,
+                                                 self._process_claimed_change)
+            self._worker_pool.resize(self._concurrency_controller.min_workers)
+        self.__next_change = 0
+        self.__in_flight_changes = set()
+        self.__last_dispatched_change = 0
+        self.__last_control_time = 0
         
     def run(self):
         """
         Run continuous daemon
         """
+        try:
+            self.__run()
+        finally:
+            # stop the background threads and disconnect their Perforce connections:
+            self.close()
+
+    def close(self):
+        """
+        Stop the change workers and any background change prefetch and disconnect their
+        Perforce connections.
+        """
+        self._lookahead.close()
+        if self._worker_pool:
+            self._worker_pool.resize(0)
+
+    def __run(self):
+        """
+        Check for and process new changes until the daemon is stopped
+        """
         start_change = self.__start_change
+        last_cache_stats_time = time.time()
         while True:
             self.__app.log_debug("Checking for new Perforce changes to sync with Shotgun...")
 
@@ -68,19 +139,41 @@ class ShotgunSyncDaemon(object):
             except Exception, e:
                 self.__app.log_exception("Unhandled exception when connecting to Perforce!")
             else:
-                res = 1
-                while res:
-                    res = self.__process_next_change(p4, start_change)
-                    if isinstance(res, int):
-                        # processed a change so move to the next one:
-                        start_change = res+1
-                    else:
-                        # didn't process anything
-                        break
+                if self._lease_manager:
+                    # process changes in our leased ranges until there's nothing left to do:
+                    while self.__process_next_leased_change(p4, start_change):
+                        pass
+                elif self._worker_pool:
+                    # hand changes to the workers until there's nothing left to do:
+                    self.__dispatch_changes(p4, start_change)
+                else:
+                    res = 1
+                    while res:
+                        res = self.__process_next_change(p4, start_change)
+                        if isinstance(res, int):
+                            # processed a change so move to the next one:
+                            start_change = res+1
+                        else:
+                            # didn't process anything
+                            break
+                    
+                    # make sure nothing is left in the write buffer and the counter is
+                    # up to date whilst we wait for new changes:
+                    self.__flush_writes(p4)
+                    self._counter.flush(p4)
+
+                if not self._lease_manager:
+                    # claims for changes the counter has moved past are no longer needed:
+                    self._change_claim.release(p4, self._counter.written_value)
             finally:
                 if p4:
                     p4.disconnect()
 
+            # periodically report how the caches are doing:
+            if time.time() - last_cache_stats_time > ShotgunSyncDaemon.CACHE_STATS_INTERVAL:
+                self._p4_sync.log_cache_stats()
+                last_cache_stats_time = time.time()
+
             # didn't do anything so sleep for a bit:
             self.__app.log_debug("No new changes found - sleeping for %d seconds" % self._interval)
             time.sleep(self._interval)
@@ -90,15 +183,17 @@ class ShotgunSyncDaemon(object):
         Attempt to register a new 'Revision' entity in Shotgun for the next 
         submitted Perforce change that needs to be processed.
 
-        Because neither Perforce nor Shotgun allow this to happen in an atomic way, we
-        use both to ensure that a change is only processed by a single daemon.
+        The change is first claimed using an atomic Perforce counter compare-and-set so that
+        only a single daemon ever creates the Revision entity for it.
         
         :param p4:              The Perforce connection object to use
         :param start_change:    Start looking for the next submitted change from this is or the value of
                                 the Perforce counter, whichever is highest.
         """
-        # get the current counter value
-        p4_counter = self.__retrieve_counter(p4)
+        # get the current counter value - this is cached so doesn't usually query Perforce:
+        p4_counter = self._counter.get(p4)
+        if p4_counter is None:
+            return
         
         # Get the next submitted change starting from either the counter+1 or the start
         # change, whichever is highest.        
@@ -106,105 +201,290 @@ class ShotgunSyncDaemon(object):
         if not p4_change:
             return
 
-        change_id = int(p4_change["change"])
+        change_id = p4_change.change
         
         # validate that this change is in fact in this project:
-        if not self._p4_sync.is_change_in_context(p4, p4_change):
+        try:
+            in_context = self._p4_sync.is_change_in_context(p4, p4_change)
+        except P4Exception, e:
+            # try again next time:
+            self.__app.log_error("Failed to determine if change %d is in this project: %s" 
+                                 % (change_id, p4.errors[0] if p4.errors else e))
+            return
+        if not in_context:
             # nothing to do so skip
             return change_id
         
-        # next, create this change in Shotgun in an atomic way:
-        sg_change_entity = self._p4_sync.create_sg_entity_for_change(p4_change)
+        # next, claim the change so that no other daemon will process it:
+        claimed = self.__claim_change(p4, change_id)
+        if claimed is None:
+            # another daemon owns this change so skip it
+            return change_id
+        
+        # we own the change so create it in Shotgun - if writes are buffered then the 
+        # counter is only updated once they have been written:
+        if claimed and self._p4_sync.write_buffer is not None:
+            self._p4_sync.queue_change(p4, p4_change)
+            if self._p4_sync.write_buffer.is_due():
+                self.__flush_writes(p4)
+            return change_id
+        
+        sg_change_entity = self._p4_sync.create_sg_entity_for_change(p4_change, claimed=claimed)
         if sg_change_entity:
             # As we were successful, update Perforce to tell it we 
             # have processed this change.  This only happens if this process
             # has correctly created a new Revision entity for this change in
-            # Shotgun.
-            self.__update_counter(p4, change_id)
+            # Shotgun.  Earlier changes may still be buffered so these are written 
+            # first so that the counter never moves past them:
+            self.__flush_writes(p4)
+            self._counter.advance(p4, change_id)
         
             # finally, process the change contents:
             self._p4_sync.sync_change_contents(p4, p4_change, sg_change_entity)
         
         return change_id
     
-    def __find_next_submitted_change(self, p4, start_change):
+    def _process_claimed_change(self, p4_sync, p4, p4_change):
+        """
+        Process a single change in a worker thread - the change is claimed and then created
+        and synced in Shotgun if it's in this project.  The counter is updated separately
+        once all previous changes have also been processed.
+        
+        :param p4_sync:     The ShotgunSync instance shared by the workers
+        :param p4:          The Perforce connection owned by the worker
+        :param p4_change:   The P4Change to process
+        """
+        try:
+            if not p4_sync.is_change_in_context(p4, p4_change):
+                return
+        except P4Exception, e:
+            # the counter will move past the change so make sure it gets retried:
+            p4_sync.record_change_failure(p4_change.change, e)
+            raise
+        claimed = self._change_claim.claim(p4, p4_change.change)
+        if not claimed and not self.__is_recoverable(p4, p4_change.change):
+            return
+        
+        # we own the change now so nothing else will process it if this fails:
+        try:
+            sg_change_entity = p4_sync.create_sg_entity_for_change(p4_change, claimed=claimed)
+            if sg_change_entity:
+                p4_sync.sync_change_contents(p4, p4_change, sg_change_entity)
+        except Exception, e:
+            p4_sync.record_change_failure(p4_change.change, e)
+            raise
+    
+    def __dispatch_changes(self, p4, start_change=0):
+        """
+        Find new changes and hand them to the worker pool, adjusting the number of workers
+        as needed, until all submitted changes have been processed.  The counter is updated
+        to the highest change for which it and all previous changes have been processed.
+        
+        :param p4:              The Perforce connection object to use
+        :param start_change:    Changes before this will never be processed
+        """
+        counter = self._counter.get(p4) or 0
+        self.__next_change = max(self.__next_change, start_change or 0, counter + 1)
+        
+        while True:
+            # keep enough changes queued that no worker is left waiting:
+            no_more_changes = False
+            while len(self.__in_flight_changes) < len(self._worker_pool) * 2:
+                p4_change = self.__find_next_submitted_change(p4, self.__next_change)
+                if not p4_change:
+                    no_more_changes = True
+                    break
+                self._worker_pool.submit(p4_change)
+                self.__in_flight_changes.add(p4_change.change)
+                self.__last_dispatched_change = p4_change.change
+                self.__next_change = p4_change.change + 1
+            
+            if no_more_changes and not self.__in_flight_changes:
+                self._counter.flush(p4)
+                return
+            
+            result = self._worker_pool.get_result(1.0)
+            while result:
+                change_id, latency, error = result
+                self._concurrency_controller.record(latency, error)
+                if change_id is not None:
+                    self.__in_flight_changes.discard(change_id)
+                result = self._worker_pool.get_result(0)
+            
+            # everything up to the oldest change still being processed is done:
+            if self.__in_flight_changes:
+                completed_change = min(self.__in_flight_changes) - 1
+            else:
+                completed_change = self.__last_dispatched_change
+            if completed_change > counter:
+                self._counter.advance(p4, completed_change)
+                counter = completed_change
+            
+            # periodically decide how many workers should be running:
+            now = time.time()
+            if now - self.__last_control_time >= self.__app.get_setting("concurrency_control_interval"):
+                self.__last_control_time = now
+                head_change = self.__get_head_change(p4)
+                if head_change is not None:
+                    self._worker_pool.resize(self._concurrency_controller.decide(len(self._worker_pool), 
+                                                                                 max(0, head_change - counter),
+                                                                                 self._p4_sync.shotgun.error_count))
+    
+    def __process_next_leased_change(self, p4, start_change=0):
+        """
+        Process the next submitted change in the range of changes leased by this daemon,
+        acquiring a new lease if needed.  As no other daemon will process changes in the
+        range, the changes don't need to be claimed individually.
+        
+        :param p4:              The Perforce connection object to use
+        :param start_change:    Changes before this will never be processed
+        :returns bool:          True if progress was made and this should be called again
+        """
+        try:
+            if not self.__lease:
+                head_change = self.__get_head_change(p4)
+                if head_change is None:
+                    return False
+                # other daemons update the counter as they complete leases so always re-read it:
+                min_change = max(start_change or 0, (self._counter.get(p4, refresh=True) or 0) + 1)
+                self.__lease = self._lease_manager.acquire(p4, head_change, min_change)
+                if not self.__lease:
+                    return False
+            lease = self.__lease
+            
+            p4_change = self.__find_next_submitted_change(p4, lease.progress + 1, lease.end_change)
+            if p4_change is False:
+                # failed to query Perforce so try again later
+                return False
+            
+            if not p4_change:
+                # if the whole range has been submitted then we're done with this lease:
+                head_change = self.__get_head_change(p4)
+                if head_change is not None and head_change >= lease.end_change:
+                    lease.progress = lease.end_change
+                    self._lease_manager.complete(p4, lease)
+                    self.__lease = None
+                    return True
+                
+                # otherwise keep hold of it until more changes are submitted:
+                if not self._lease_manager.heartbeat(p4, lease, force=False):
+                    self.__lease = None
+                return False
+            
+            change_id = p4_change.change
+            try:
+                in_context = self._p4_sync.is_change_in_context(p4, p4_change)
+            except P4Exception, e:
+                # try again next time:
+                self.__app.log_error("Failed to determine if change %d is in this project: %s" 
+                                     % (change_id, p4.errors[0] if p4.errors else e))
+                return False
+            if in_context:
+                # if the lease was taken over from another daemon then it may have already
+                # created the Revision entity so let the existence check handle this:
+                sg_change_entity = self._p4_sync.create_sg_entity_for_change(p4_change, 
+                                                                             claimed=not lease.taken_over)
+                if sg_change_entity:
+                    self._p4_sync.sync_change_contents(p4, p4_change, sg_change_entity)
+            
+            lease.progress = change_id
+            if not self._lease_manager.heartbeat(p4, lease, force=False):
+                self.__lease = None
+            return True
+        
+        except TankError, e:
+            self.__app.log_error("Failed to process leased changes: %s" % e)
+            return False
+
+    def __get_head_change(self, p4):
+        """
+        Return the most recently submitted change.
+        
+        :param p4:      The Perforce connection to use
+        :returns int:   The most recent submitted change id, 0 if nothing has been submitted 
+                        or None if Perforce couldn't be queried
+        """
+        try:
+            # returns: [{'status': 'submitted', 'changeType': 'public', 'change': '36', ...}]            
+            p4_res = p4.run_changes("-m", "1", "-s", "submitted")
+            return int(p4_res[0]["change"]) if p4_res else 0
+        except P4Exception, e:
+            self.__app.log_error("Failed to find the most recent change: %s" % (p4.errors[0] if p4.errors else e))
+        except Exception, e:
+            self.__app.log_error("Failed to find the most recent change: %s" % e)
+    
+    def __find_next_submitted_change(self, p4, start_change, max_change=None):
         """
         Find the next submitted change from Perforce with a change id >= start_change.
         
         :param p4:              The Perforce connection to use
         :param start_change:    Minimum change to look for new changes from
+        :param max_change:      Optional maximum change to look for new changes up to
+        :returns:               The change if found, None if there is no change or False 
+                                if Perforce couldn't be queried
         """
         self.__app.log_debug("Looking for the next change submitted to Perforce...")        
         try:
-            # get highest submitted change from perforce:
-            # returns: [{'status': 'submitted', 'changeType': 'public', 'change': '36', ...}]            
-            p4_res = p4.run_changes("-m", "1", "-s", "submitted")
-            if not p4_res:
-                # nothing submitted!
-                return
-            end_change =  int(p4_res[0]["change"])
-            if end_change < start_change:
-                # nothing new submitted!
-                self.__app.log_debug(" > No new changes found!")
-                return
-            
-            # Find the next submitted change, skipping any pending or shelved changes:
             # Perforce always increments the submitted change id even if there are previous
             # shelved or pending changes so it's safe to assume that they are sequentially 
-            # ordered
-            #
-            # (TODO) - is there an easier way to determine this?
-            block_size = 10
-            for block_start in range(start_change, end_change+1, block_size):
-                block_end = min(block_start + block_size - 1, end_change)
-                
-                p4_res = p4.run_describe(range(block_start, block_end + 1))
-                changes_by_change = dict([(r["change"], r) for r in p4_res if "change" in r])
-                
-                for change_num in range(block_start, block_end + 1):
-                    change = changes_by_change.get(str(change_num))
-                    if not change or change.get("status") != "submitted":
-                        continue
-                
-                    # this is the next submitted change
-                    self.__app.log_debug(" > Found change %s" % change)                    
-                    return change
+            # ordered.  Changes are described in blocks so the lookahead buffer keeps the
+            # rest of the block for the next call:
+            change = self._lookahead.find_next(p4, start_change, max_change)
+            if not change:
+                self.__app.log_debug(" > No new changes found!")
+                return
+            self.__app.log_debug(" > Found change %s" % change)
+            return change
             
         except P4Exception, e:
             self.__app.log_error("Failed to find next change to process: %s" % p4.errors[0] if p4.errors else e)
+            return False
         except Exception, e:
             self.__app.log_error("Failed to find next change to process: %s" % e)
+            return False
     
-    def __retrieve_counter(self, p4):
+    def __flush_writes(self, p4):
         """
-        Retrieve the perforce counter for this project
+        Write all buffered Shotgun requests and then update the Perforce counter to the
+        most recent change that was written.
         
         :param p4:    The Perforce connection to use
         """
-        try:
-            p4_res = p4.run_counter(self._p4_counter_name)
-            return int(p4_res[0]["value"]) if p4_res else 0            
-        except P4Exception, e:
-            self.__app.log_error("Failed to retrieve Perforce counter '%s' - %s" 
-                           % (self._p4_counter_name, (p4.errors[0] if p4.errors else e)))
-        except Exception, e:
-            self.__app.log_error("Failed to retrieve Perforce counter '%s' - %s" % (self._p4_counter_name, e))                    
+        written_change_ids = self._p4_sync.flush_writes()
+        if written_change_ids:
+            self._counter.advance(p4, max(written_change_ids))
     
-    def __update_counter(self, p4, change_id):
+    def __claim_change(self, p4, change_id):
         """
-        Update the perforce counter to the specified change id.
+        Claim a change so that no other daemon will process it.  If the change has already
+        been claimed but is in the counter's recovery window then it may have been claimed
+        by this daemon before it was restarted, so it's still processed but the existence
+        of the Revision entity in Shotgun is checked first.
         
-        :param p4:         The perforce connection to use
-        :param change_id:  The change id to update the counter to
-        """ 
-        self.__app.log_debug("Updating the Perforce counter '%s' to %s" % (self._p4_counter_name, change_id))                        
-        try:
-            p4.run_counter(self._p4_counter_name, str(change_id))
-        except P4Exception, e:
-            self.__app.log_error("Failed to update Perforce counter '%s' - %s" 
-                           % (self._p4_counter_name, (p4.errors[0] if p4.errors else e)))
-        except Exception, e:
-            self.__app.log_error("Failed to update Perforce counter '%s' - %s" % (self._p4_counter_name, e))
-            
-            
-            
\ No newline at end of file
+        :param p4:          The Perforce connection to use
+        :param change_id:   The id of the change to claim
+        :returns:           True if the change was claimed, False if it should be processed
+                            without being claimed or None if it should be skipped
+        """
+        if self._change_claim.claim(p4, change_id):
+            return True
+        if self.__is_recoverable(p4, change_id):
+            self.__app.log_debug("Change %d was claimed by this daemon but may not have been synced - checking "
+                                 "Shotgun" % change_id)
+            return False
+        # another daemon is processing changes so the cached counter is out of date:
+        self._counter.invalidate(p4)
+        return None
+
+    def __is_recoverable(self, p4, change_id):
+        """
+        Determine if a change that has already been claimed was claimed by this daemon 
+        before it was restarted, so it may not have been synced.  Changes claimed by other
+        daemons are never processed again, even if they are in the counter's recovery window.
+
+        :param p4:          The Perforce connection to use
+        :param change_id:   The id of the change to check
+        :returns:           True if the change should be processed without being claimed
+        """
+        return (self._counter.in_recovery_window(change_id) 
+                and self._change_claim.is_own_claim(p4, change_id))
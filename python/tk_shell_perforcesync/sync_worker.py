@@ -0,0 +1,132 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Resident sync worker that keeps a warm ShotgunSync (Perforce connection, tk instances and
+caches) open behind a local UNIX socket so that one-shot syncs don't pay the start-up cost
+"""
+
+import os
+import json
+import SocketServer
+
+import sgtk
+from sgtk import TankError
+
+p4_fw = sgtk.platform.get_framework("tk-framework-perforce")
+
+from .shotgun_sync import ShotgunSync
+from .sync_worker_client import SyncWorkerClient
+from .util import get_shared_cache_location
+
+def get_worker_socket_path(app):
+    """
+    Return the path of the socket that the sync worker for the app's project listens on.
+
+    :param app:     The app bundle to return the socket path for
+    :returns str:   The path of the UNIX socket
+    """
+    return os.path.join(get_shared_cache_location(app),
+                        "sync_worker_%d.sock" % app.context.project["id"])
+
+class SyncWorker(object):
+    """
+    Serve sync requests sent by a SyncWorkerClient.  Requests are handled one at a time
+    using the same ShotgunSync instance and Perforce connection.
+    """
+
+    def __init__(self, app, p4_user=None, p4_pass=None):
+        """
+        Construction
+
+        :param app:            The app bundle that constructed this object
+        :param p4_user:        The Perforce user that the command should be run under
+        :param p4_pass:        The Perforce password that the command should be run under
+        """
+        self.__app = app
+        self.__p4_user = p4_user
+        self.__p4_pass = p4_pass
+        self.__p4 = None
+
+        self.__socket_path = get_worker_socket_path(self.__app)
+        self.__p4_sync = ShotgunSync(self.__app, self.__p4_user, self.__p4_pass)
+
+    def run(self):
+        """
+        Run the worker until it's interrupted
+        """
+        if SyncWorkerClient(self.__socket_path).is_available():
+            raise TankError("A sync worker is already running for this project on '%s'" % self.__socket_path)
+        if os.path.exists(self.__socket_path):
+            # left behind by a worker that didn't shut down cleanly:
+            os.remove(self.__socket_path)
+
+        worker = self
+        class _RequestHandler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                response = worker._handle_request(self.rfile.readline())
+                self.wfile.write(json.dumps(response) + "\n")
+
+        server = SocketServer.UnixStreamServer(self.__socket_path, _RequestHandler)
+        self.__app.log_info("Sync worker listening on '%s'" % self.__socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            if os.path.exists(self.__socket_path):
+                os.remove(self.__socket_path)
+            if self.__p4:
+                self.__p4.disconnect()
+
+    def _handle_request(self, request_str):
+        """
+        Handle a single request.
+
+        :param request_str: The JSON encoded request
+        :returns dict:      The response to send back to the client
+        """
+        try:
+            request = json.loads(request_str)
+        except ValueError, e:
+            return {"status":"error", "message":"Invalid request: %s" % e}
+
+        command = request.get("command")
+        if command != "sync_changes":
+            return {"status":"error", "message":"Unknown command '%s'" % command}
+
+        try:
+            start_change = int(request["start"])
+            end_change = max(start_change, int(request.get("end") or start_change))
+        except (KeyError, TypeError, ValueError), e:
+            return {"status":"error", "message":"Invalid change range: %s" % e}
+
+        p4 = self.__get_connection()
+        if not p4:
+            return {"status":"error", "message":"Failed to connect to Perforce"}
+
+        try:
+            self.__p4_sync.sync_changes(start_change, end_change, p4)
+        except Exception, e:
+            self.__app.log_exception("Failed to sync changes %d - %d" % (start_change, end_change))
+            return {"status":"error", "message":str(e)}
+        return {"status":"ok"}
+
+    def __get_connection(self):
+        """
+        Return the Perforce connection used by the worker, re-connecting if needed.
+        """
+        if self.__p4 and self.__p4.connected():
+            return self.__p4
+        try:
+            self.__p4 = p4_fw.connection.connect(False, self.__p4_user, self.__p4_pass, "")
+        except Exception, e:
+            self.__app.log_error("Failed to connect to Perforce server: %s" % e)
+            self.__p4 = None
+        return self.__p4
@@ -0,0 +1,139 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Thin client used to forward sync requests to a resident sync worker (see SyncWorker).
+
+This module deliberately only depends on the standard library so that it can also be
+run directly as a script without starting Toolkit:
+
+    python sync_worker_client.py --socket /path/to/worker.sock -s 1234 [-e 1240]
+
+The script exits with 0 if the worker synced the changes, 1 if the sync failed and 2 if
+no worker is running, in which case the caller should fall back to running the
+'sync_perforce' command.
+"""
+
+import os
+import sys
+import json
+import errno
+import socket
+import optparse
+
+class SyncWorkerUnavailable(Exception):
+    """
+    Raised when there is no resident sync worker listening on the socket
+    """
+
+class SyncWorkerClient(object):
+    """
+    Client for a resident sync worker listening on a local UNIX socket
+    """
+
+    def __init__(self, socket_path):
+        """
+        Construction
+
+        :param socket_path: The path of the UNIX socket the worker is listening on
+        """
+        self.__socket_path = socket_path
+
+    def is_available(self):
+        """
+        Determine if a worker is listening on the socket.
+
+        :returns bool:  True if a worker is running, otherwise False
+        """
+        try:
+            self.__connect().close()
+            return True
+        except SyncWorkerUnavailable:
+            return False
+
+    def sync_changes(self, start_change, end_change):
+        """
+        Ask the worker to sync a range of changes and wait for it to finish.
+
+        :param start_change:    The first change to sync
+        :param end_change:      The last change to sync
+        :returns dict:          The response from the worker, e.g. {"status":"ok"}
+        :raises:                SyncWorkerUnavailable if no worker is running
+        """
+        return self.send({"command":"sync_changes", "start":start_change, "end":end_change})
+
+    def send(self, request):
+        """
+        Send a request to the worker and return its response.
+
+        :param request:     The request dictionary to send
+        :returns dict:      The response from the worker
+        :raises:            SyncWorkerUnavailable if no worker is running
+        """
+        sock = self.__connect()
+        try:
+            sock.sendall(json.dumps(request) + "\n")
+            response = ""
+            while not response.endswith("\n"):
+                data = sock.recv(4096)
+                if not data:
+                    break
+                response += data
+        finally:
+            sock.close()
+
+        if not response:
+            return {"status":"error", "message":"Worker closed the connection without responding"}
+        return json.loads(response)
+
+    def __connect(self):
+        """
+        Connect to the worker socket.
+        """
+        if not hasattr(socket, "AF_UNIX") or not os.path.exists(self.__socket_path):
+            raise SyncWorkerUnavailable("No sync worker is listening on '%s'" % self.__socket_path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.__socket_path)
+        except socket.error, e:
+            sock.close()
+            if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                # stale socket file left behind by a worker that is no longer running
+                raise SyncWorkerUnavailable("No sync worker is listening on '%s'" % self.__socket_path)
+            raise
+        return sock
+
+def main(argv):
+    """
+    Run the client from the command line.
+    """
+    parser = optparse.OptionParser()
+    parser.add_option("--socket", help="Path of the socket the sync worker is listening on", type="str")
+    parser.add_option("-s", "--start", help="Start change to sync", type="int")
+    parser.add_option("-e", "--end", help="End change to sync (optional)", type="int")
+    options, _ = parser.parse_args(argv)
+    if not options.socket or options.start is None:
+        parser.error("Must specify the worker socket and at least a start change to sync!")
+
+    end_change = max(options.start, options.end) if options.end is not None else options.start
+    try:
+        response = SyncWorkerClient(options.socket).sync_changes(options.start, end_change)
+    except SyncWorkerUnavailable, e:
+        sys.stderr.write("%s\n" % e)
+        return 2
+
+    if response.get("status") != "ok":
+        sys.stderr.write("Sync failed: %s\n" % response.get("message", "unknown error"))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,82 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Miscellaneous utility functions used by the Perforce sync
+"""
+
+import os
+import errno
+import tempfile
+
+def get_cache_location(app):
+    """
+    Return a directory on disk that the app can use to store cache data, creating it
+    if needed.  The app's own cache location is used where the core supports it,
+    otherwise a directory under the system temp location is used instead.
+
+    :param app:     The app bundle to return the cache location for
+    :returns str:   The path to the cache directory
+    """
+    cache_location = getattr(app, "cache_location", None)
+    if not cache_location:
+        cache_location = os.path.join(tempfile.gettempdir(), "tk_shell_perforcesync",
+                                      "project_%d" % app.context.project["id"])
+    ensure_folder_exists(cache_location)
+    return cache_location
+
+def get_shared_cache_location(app):
+    """
+    Return a directory on disk that is shared by all instances of the app running on this
+    machine, regardless of the project they are running for, creating it if needed.
+
+    :param app:     The app bundle to return the shared cache location for
+    :returns str:   The path to the shared cache directory
+    """
+    shared_location = app.get_setting("shared_cache_location")
+    if not shared_location:
+        shared_location = os.path.join(tempfile.gettempdir(), "tk_shell_perforcesync", "shared")
+    shared_location = os.path.expanduser(os.path.expandvars(shared_location))
+    ensure_folder_exists(shared_location)
+    return shared_location
+
+def is_process_running(pid):
+    """
+    Determine if a process is running on this machine.
+
+    :param pid:     The id of the process to check
+    :returns bool:  True if the process is running
+    """
+    if os.name == "nt":
+        import ctypes
+        # PROCESS_QUERY_LIMITED_INFORMATION:
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        # the process exists but is owned by another user:
+        return e.errno == errno.EPERM
+    return True
+
+def ensure_folder_exists(path):
+    """
+    Make sure the specified folder exists, creating it if needed.
+
+    :param path:    The folder to create
+    """
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
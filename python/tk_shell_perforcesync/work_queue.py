@@ -0,0 +1,210 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Durable local queue of work that failed during a sync and needs to be retried
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+from .util import get_cache_location
+
+class WorkQueue(object):
+    """
+    SQLite backed queue of failed work items.  Each item is either for a whole change or
+    for a single file revision within a change, together with the stage that failed:
+
+    - 'contents':   Syncing the contents of the change (including creating/updating the
+                    Revision entity)
+    - 'publish':    Registering the publish for a file revision
+    - 'versions':   Creating the review Version for a file revision
+
+    Items are retried with exponential backoff and moved to the dead-letter list once they
+    have failed too many times.  Dead items are kept until they are replayed.
+    """
+
+    KIND_CHANGE = "change"
+    KIND_FILE = "file"
+
+    STAGE_CONTENTS = "contents"
+    STAGE_PUBLISH = "publish"
+    STAGE_VERSIONS = "versions"
+
+    STATE_PENDING = "pending"
+    STATE_DEAD = "dead"
+
+    QUEUE_FILE_NAME = "work_queue.db"
+
+    def __init__(self, app, max_attempts, base_delay, max_delay):
+        """
+        Construction
+
+        :param app:             The app bundle that constructed this object
+        :param max_attempts:    The number of attempts after which an item is considered dead
+        :param base_delay:      Delay in seconds before the first retry, doubled for each
+                                subsequent attempt
+        :param max_delay:       Maximum delay in seconds between retries
+        """
+        self.__app = app
+        self.__max_attempts = max_attempts
+        self.__base_delay = base_delay
+        self.__max_delay = max_delay
+
+        self.__path = os.path.join(get_cache_location(self.__app), WorkQueue.QUEUE_FILE_NAME)
+
+        # sqlite connections can't be shared between threads:
+        self.__local = threading.local()
+
+    def add(self, kind, change_id, stage, error, depot_path="", revision=0):
+        """
+        Add a failed work item to the queue.  If the same item is already queued then it's
+        left as it is.
+
+        :param kind:        The kind of item, KIND_CHANGE or KIND_FILE
+        :param change_id:   The id of the change the work is for
+        :param stage:       The stage that failed, e.g. STAGE_PUBLISH
+        :param error:       Description of the error
+        :param depot_path:  The depot path of the file, for file items
+        :param revision:    The revision of the file, for file items
+        """
+        now = time.time()
+        try:
+            connection = self.__connection()
+            with connection:
+                connection.execute("INSERT OR IGNORE INTO work_items "
+                                   "(kind, change, stage, depot_path, revision, attempts, next_attempt, "
+                                   " last_error, state, created, updated) "
+                                   "VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?, ?, ?)",
+                                   (kind, int(change_id), stage, depot_path or "", int(revision or 0),
+                                    now + self.__base_delay, str(error), WorkQueue.STATE_PENDING, now, now))
+        except sqlite3.Error, e:
+            self.__app.log_error("Failed to add work item for change %s to the retry queue '%s': %s"
+                                 % (change_id, self.__path, e))
+
+    def due(self, limit=100):
+        """
+        Return the pending items that are due to be retried.
+
+        :param limit:   The maximum number of items to return
+        :returns list:  List of item dictionaries, oldest change first
+        """
+        return self.__query("SELECT * FROM work_items WHERE state = ? AND next_attempt <= ? "
+                            "ORDER BY change, id LIMIT ?", (WorkQueue.STATE_PENDING, time.time(), limit))
+
+    def items(self, state=None):
+        """
+        Return all items in the queue, optionally filtered by state.
+
+        :param state:   Only return items in this state, e.g. STATE_DEAD
+        :returns list:  List of item dictionaries
+        """
+        if state:
+            return self.__query("SELECT * FROM work_items WHERE state = ? ORDER BY change, id", (state,))
+        return self.__query("SELECT * FROM work_items ORDER BY change, id", ())
+
+    def succeeded(self, item_id):
+        """
+        Remove an item from the queue once it's been successfully retried.
+
+        :param item_id: The id of the item
+        """
+        self.__execute("DELETE FROM work_items WHERE id = ?", (item_id,))
+
+    def failed(self, item, error):
+        """
+        Record that retrying an item failed again.  The item is scheduled for another
+        attempt with an increasing delay or moved to the dead-letter list.
+
+        :param item:    The item dictionary
+        :param error:   Description of the error
+        """
+        attempts = item["attempts"] + 1
+        now = time.time()
+        if attempts >= self.__max_attempts:
+            self.__app.log_error("Giving up on %s item %d for change %d after %d attempts: %s"
+                                 % (item["stage"], item["id"], item["change"], attempts, error))
+            state = WorkQueue.STATE_DEAD
+            next_attempt = now
+        else:
+            state = WorkQueue.STATE_PENDING
+            next_attempt = now + min(self.__max_delay, self.__base_delay * (2 ** attempts))
+        self.__execute("UPDATE work_items SET attempts = ?, next_attempt = ?, last_error = ?, state = ?, "
+                       "updated = ? WHERE id = ?", (attempts, next_attempt, str(error), state, now, item["id"]))
+
+    def replay(self, item_ids=None):
+        """
+        Move dead items back to the pending state so that they are retried straight away.
+
+        :param item_ids:    The ids of the items to replay, or None to replay all dead items
+        :returns int:       The number of items replayed
+        """
+        sql = ("UPDATE work_items SET state = ?, attempts = 0, next_attempt = ?, updated = ? "
+               "WHERE state = ?")
+        now = time.time()
+        params = [WorkQueue.STATE_PENDING, now, now, WorkQueue.STATE_DEAD]
+        if item_ids is not None:
+            if not item_ids:
+                return 0
+            sql += " AND id IN (%s)" % ",".join("?" * len(item_ids))
+            params.extend(item_ids)
+        return self.__execute(sql, params)
+
+    def __query(self, sql, params):
+        """
+        Run a query and return the rows as a list of dictionaries.
+        """
+        try:
+            cursor = self.__connection().execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        except sqlite3.Error, e:
+            self.__app.log_error("Failed to query the retry queue '%s': %s" % (self.__path, e))
+            return []
+
+    def __execute(self, sql, params):
+        """
+        Run a statement in its own transaction and return the number of rows changed.
+        """
+        try:
+            connection = self.__connection()
+            with connection:
+                return connection.execute(sql, params).rowcount
+        except sqlite3.Error, e:
+            self.__app.log_error("Failed to update the retry queue '%s': %s" % (self.__path, e))
+            return 0
+
+    def __connection(self):
+        """
+        Return the connection to the queue for the current thread, creating it if needed.
+        """
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.__path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS work_items ("
+                                   "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                   "kind TEXT NOT NULL, "
+                                   "change INTEGER NOT NULL, "
+                                   "stage TEXT NOT NULL, "
+                                   "depot_path TEXT NOT NULL, "
+                                   "revision INTEGER NOT NULL, "
+                                   "attempts INTEGER NOT NULL, "
+                                   "next_attempt REAL NOT NULL, "
+                                   "last_error TEXT, "
+                                   "state TEXT NOT NULL, "
+                                   "created REAL NOT NULL, "
+                                   "updated REAL NOT NULL, "
+                                   "UNIQUE (kind, change, stage, depot_path, revision))")
+            self.__local.connection = connection
+        return connection
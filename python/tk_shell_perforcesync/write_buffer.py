@@ -0,0 +1,168 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Write-behind buffer that groups the Shotgun writes for consecutive changes into a single
+batch request
+"""
+
+import time
+
+class ShotgunWriteBuffer(object):
+    """
+    Collect the batch requests for several changes and send them to Shotgun together once
+    enough requests have been collected or the oldest request has waited long enough.
+
+    The requests for each change are kept together - Shotgun runs a batch in a single
+    transaction so if the combined batch fails then each change is sent on its own so that
+    one bad change doesn't prevent the others from being written.
+    """
+
+    def __init__(self, app, shotgun, max_requests, max_age):
+        """
+        Construction
+
+        :param app:             The app bundle that constructed this object
+        :param shotgun:         The Shotgun connection to send the requests with
+        :param max_requests:    The number of buffered requests at which the buffer is due
+                                to be flushed
+        :param max_age:         Time in seconds after which the buffer is due to be flushed
+        """
+        self.__app = app
+        self.__shotgun = shotgun
+        self.__max_requests = max(1, max_requests)
+        self.__max_age = max_age
+
+        self.__changes = []
+        self.__num_requests = 0
+        self.__oldest_time = None
+        self.__created_entities = {}
+        self.__failed_requests = {}
+
+    def __len__(self):
+        """
+        The number of buffered requests
+        """
+        return self.__num_requests
+
+    @property
+    def change_ids(self):
+        """
+        The ids of the changes that currently have buffered requests
+        """
+        return [change_id for change_id, _ in self.__changes]
+
+    @property
+    def created_entities(self):
+        """
+        Dictionary of {change id:list of entities} created for each change written by the 
+        last flush
+        """
+        return self.__created_entities
+
+    @property
+    def failed_requests(self):
+        """
+        Dictionary of {change id:list of requests} for each change that failed to be written
+        by the last flush so that they can be added again once the cause has been fixed
+        """
+        return self.__failed_requests
+
+    def add(self, change_id, requests):
+        """
+        Add the batch requests for a change to the buffer.
+
+        :param change_id:   The id of the change the requests are for
+        :param requests:    List of Shotgun batch requests
+        """
+        if not requests:
+            return
+        if self.__oldest_time is None:
+            self.__oldest_time = time.time()
+        self.__changes.append((change_id, list(requests)))
+        self.__num_requests += len(requests)
+
+    def discard(self, change_ids):
+        """
+        Remove the buffered requests for the specified changes without writing them.
+
+        :param change_ids:  The ids of the changes to remove
+        """
+        change_ids = set(change_ids)
+        self.__changes = [(change_id, requests) for change_id, requests in self.__changes 
+                          if change_id not in change_ids]
+        self.__num_requests = sum(len(requests) for _, requests in self.__changes)
+        if not self.__changes:
+            self.__oldest_time = None
+
+    def is_due(self):
+        """
+        Determine if the buffer should be flushed.
+
+        :returns bool:  True if enough requests have been collected or the oldest request
+                        has waited long enough
+        """
+        if not self.__changes:
+            return False
+        return (self.__num_requests >= self.__max_requests
+                or time.time() - self.__oldest_time >= self.__max_age)
+
+    def flush(self):
+        """
+        Send all buffered requests to Shotgun.
+
+        :returns tuple:     (list of change ids that were written,
+                             list of (change id, error) tuples for changes that failed)
+        """
+        changes = self.__changes
+        self.__changes = []
+        self.__num_requests = 0
+        self.__oldest_time = None
+        self.__created_entities = {}
+        self.__failed_requests = {}
+        if not changes:
+            return ([], [])
+
+        all_requests = []
+        for _, requests in changes:
+            all_requests.extend(requests)
+        self.__app.log_debug("Writing %d buffered request(s) for %d change(s) to Shotgun..."
+                             % (len(all_requests), len(changes)))
+        try:
+            results = self.__shotgun.batch(all_requests)
+            # the results are in the same order as the requests:
+            for change_id, requests in changes:
+                self.__record_results(change_id, requests, results[:len(requests)])
+                results = results[len(requests):]
+            return ([change_id for change_id, _ in changes], [])
+        except Exception, e:
+            if len(changes) == 1:
+                self.__failed_requests[changes[0][0]] = changes[0][1]
+                return ([], [(changes[0][0], e)])
+            self.__app.log_warning("Failed to write buffered requests for %d changes (%s) - "
+                                   "writing each change separately" % (len(changes), e))
+
+        written = []
+        failed = []
+        for change_id, requests in changes:
+            try:
+                self.__record_results(change_id, requests, self.__shotgun.batch(requests))
+                written.append(change_id)
+            except Exception, e:
+                self.__failed_requests[change_id] = requests
+                failed.append((change_id, e))
+        return (written, failed)
+
+    def __record_results(self, change_id, requests, results):
+        """
+        Keep the entities created by the requests written for a change.
+        """
+        self.__created_entities[change_id] = [result for request, result in zip(requests, results or [])
+                                              if request["request_type"] == "create" and result]
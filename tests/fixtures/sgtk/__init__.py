@@ -0,0 +1,231 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Minimal stand-in for the Toolkit core API and the Perforce framework used by the tests.
+Everything that the sync calls is implemented in memory and counted so that tests can
+check how the API was used.
+"""
+
+import re
+import json
+import threading
+
+class TankError(Exception):
+    """
+    Stand-in for sgtk.TankError
+    """
+
+def _count(calls, name):
+    calls[name] = calls.get(name, 0) + 1
+
+# ------------------------------------------------------------------------------------------
+# contexts
+
+class Context(object):
+    """
+    A context with just the fields used by the sync
+    """
+
+    def __init__(self, project=None, entity=None, step=None, task=None):
+        self.project = project
+        self.entity = entity
+        self.step = step
+        self.task = task
+
+    def to_dict(self):
+        return {"project":self.project, "entity":self.entity, "step":self.step, "task":self.task}
+
+    def __eq__(self, other):
+        return isinstance(other, Context) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "<Context %r>" % self.to_dict()
+
+class _ContextModule(object):
+    Context = Context
+
+    @staticmethod
+    def serialize(context):
+        return json.dumps(context.to_dict())
+
+    @staticmethod
+    def deserialize(data):
+        return Context(**dict((str(k), v) for k, v in json.loads(data).iteritems()))
+
+context = _ContextModule()
+
+# ------------------------------------------------------------------------------------------
+# tk instances
+
+class PipelineConfiguration(object):
+
+    def __init__(self, path, project_id):
+        self.__path = path
+        self.__project_id = project_id
+
+    def get_path(self):
+        return self.__path
+
+    def get_project_id(self):
+        return self.__project_id
+
+class Sgtk(object):
+    """
+    A tk instance for a single project.  Paths with one of the template extensions are
+    recognised by the templates.
+    """
+
+    TEMPLATE_PATTERN = r"\.(ma|mb|nk|exr)$"
+
+    def __init__(self, pc_path, project, shotgun, roots=None):
+        self.pipeline_configuration = PipelineConfiguration(pc_path, project["id"])
+        self.project = project
+        self.shotgun = shotgun
+        self.roots = roots or {"primary":"/mnt/projects/%s" % project.get("name", project["id"])}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def template_from_path(self, path):
+        with self.lock:
+            _count(self.calls, "template_from_path")
+        return "template" if re.search(Sgtk.TEMPLATE_PATTERN, path) else None
+
+    def context_from_path(self, path):
+        with self.lock:
+            _count(self.calls, "context_from_path")
+        match = re.search(r"/assets/([^/]+)/", path)
+        entity = {"type":"Asset", "id":abs(hash(match.group(1))) % 1000, "name":match.group(1)} if match else None
+        return Context(self.project, entity)
+
+    def context_from_entity(self, entity_type, entity_id):
+        with self.lock:
+            _count(self.calls, "context_from_entity")
+        return Context(self.project, {"type":entity_type, "id":entity_id})
+
+# tk instances returned by sgtk_from_path, keyed by pipeline configuration path:
+tk_instances = {}
+
+def sgtk_from_path(path):
+    tk = tk_instances.get(path)
+    if not tk:
+        raise TankError("No pipeline configuration found at '%s'" % path)
+    return tk
+
+# ------------------------------------------------------------------------------------------
+# util
+
+class _UtilModule(object):
+
+    @staticmethod
+    def get_published_file_entity_type(tk):
+        return "PublishedFile"
+
+    @staticmethod
+    def register_publish(tk, context, path, name, version_number, **kwargs):
+        data = {"code":name, "name":name, "version_number":version_number, "path":{"url":path},
+                "project":context.project, "entity":context.entity, "task":context.task,
+                "description":kwargs.get("comment"), "created_by":kwargs.get("created_by")}
+        data.update(kwargs.get("sg_fields") or {})
+        return tk.shotgun.create("PublishedFile", data)
+
+util = _UtilModule()
+
+# ------------------------------------------------------------------------------------------
+# the Perforce framework
+
+class _Connection(object):
+
+    def __init__(self):
+        # function that returns a new Perforce connection:
+        self.factory = None
+
+    def connect(self, allow_ui, user, password, workspace):
+        return self.factory()
+
+class _FrameworkUtil(object):
+
+    @staticmethod
+    def url_from_depot_path(depot_path, revision):
+        return "perforce:%s#%d" % (depot_path, revision)
+
+    @staticmethod
+    def depot_path_from_url(url):
+        path, _, revision = url[len("perforce:"):].partition("#")
+        return (path, int(revision) if revision else None)
+
+    @staticmethod
+    def get_depot_file_details(p4, depot_paths):
+        p4_res = p4.run_fstat(*depot_paths)
+        details = dict((path, None) for path in depot_paths)
+        for path, res in zip(depot_paths, p4_res):
+            details[path] = res
+        return details
+
+class PerforceFramework(object):
+    """
+    The tk-framework-perforce framework.  Publish and review data is looked up by
+    (depot path, revision).
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.connection = _Connection()
+        self.util = _FrameworkUtil()
+        self.publish_data = {}
+        self.review_data = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def get_shotgun_user(self, perforce_user):
+        with self.lock:
+            _count(self.calls, "get_shotgun_user")
+        return {"type":"HumanUser", "id":abs(hash(perforce_user)) % 1000, "name":perforce_user}
+
+    def load_publish_data(self, depot_path, sg_user, client, revision, p4):
+        with self.lock:
+            _count(self.calls, "load_publish_data")
+        data = self.publish_data.get((depot_path, revision))
+        return {"data":dict(data), "temp_files":[]} if data is not None else None
+
+    def load_publish_review_data(self, depot_path, sg_user, client, revision, p4):
+        with self.lock:
+            _count(self.calls, "load_publish_review_data")
+        data = self.review_data.get((depot_path, revision))
+        return {"data":dict(data), "temp_files":[]} if data is not None else None
+
+framework = PerforceFramework()
+
+# ------------------------------------------------------------------------------------------
+# platform
+
+class _Constants(object):
+    CONFIG_BACK_MAPPING_FILE = "tank_configs.yml"
+
+class _PlatformModule(object):
+    constants = _Constants()
+
+    @staticmethod
+    def get_framework(name):
+        return framework
+
+platform = _PlatformModule()
+
+def reset():
+    """
+    Reset all state held by this module between tests
+    """
+    tk_instances.clear()
+    framework.reset()
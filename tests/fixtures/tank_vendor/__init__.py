@@ -0,0 +1,36 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Minimal stand-in for the tank_vendor package used by the tests
+"""
+
+class _Yaml(object):
+    """
+    Loader for the single form of yaml read by the sync - the tank_configs.yml back mapping
+    file, e.g. "- {linux2: /path/to/pc, darwin: '/path/to/pc'}"
+    """
+
+    @staticmethod
+    def load(contents):
+        configs = []
+        for line in contents.splitlines():
+            line = line.strip()
+            if not line.startswith("-"):
+                continue
+            mapping = {}
+            for item in line[1:].strip().strip("{}").split(","):
+                if ":" in item:
+                    key, value = item.split(":", 1)
+                    mapping[key.strip()] = value.strip().strip("'\"")
+            configs.append(mapping)
+        return configs
+
+yaml = _Yaml()
@@ -0,0 +1,587 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Fake Perforce server, Shotgun site and app used by the tests.  The fakes keep everything
+in memory and count every call made to them so that tests can check both the results of
+a sync and the round trips it needed.
+
+Run the tests from the root of the repository with:
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import re
+import sys
+import copy
+import time
+import shutil
+import fnmatch
+import tempfile
+import threading
+import unittest
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _path in [os.path.join(_root, "tests", "fixtures"), os.path.join(_root, "python")]:
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
+
+import sgtk
+from P4 import P4Exception
+
+import tk_shell_perforcesync
+from tk_shell_perforcesync import shotgun_scheduler
+from tk_shell_perforcesync import shotgun_sync_daemon
+from tk_shell_perforcesync.schema_cache import SchemaCache
+
+def _count(calls, name):
+    calls[name] = calls.get(name, 0) + 1
+
+def _common_directory(paths):
+    """
+    Return the deepest directory containing all paths, as returned by 'p4 describe'.
+    """
+    prefix = os.path.commonprefix(paths)
+    return prefix[:prefix.rfind("/")] if "/" in prefix else ""
+
+class FakePerforceServer(object):
+    """
+    In-memory Perforce server shared by all connections made to it.  Submitted files are
+    described as (depot path, action, digest) tuples, revisions are allocated in order.
+    """
+
+    def __init__(self, port="perforce:1666"):
+        self.port = port
+        self.changes = {}
+        self.files = {}
+        self.counters = {}
+        self.contents = {}
+        self.lock = threading.RLock()
+        # functions f(command, args) that return an error message to fail a command with:
+        self.failures = []
+        self.head_change = 0
+
+    def submit(self, change_id, files, user="artist", client="artist_ws", desc=None, time=1382901628,
+               status="submitted"):
+        """
+        Add a change to the server.
+
+        :param files:   List of (depot path, action[, digest[, source path]]) tuples
+        """
+        records = []
+        for entry in files:
+            depot_path, action = entry[0], entry[1]
+            digest = entry[2] if len(entry) > 2 else "D%s" % abs(hash((depot_path, change_id)))
+            source = entry[3] if len(entry) > 3 else None
+            revisions = self.files.setdefault(depot_path, [])
+            revision = len(revisions) + 1
+            if status == "submitted":
+                revisions.append((revision, change_id, action, digest))
+            records.append((depot_path, revision, action, digest, source))
+        self.changes[change_id] = {"status":status, "user":user, "client":client, "time":time,
+                                   "desc":desc or "change %d" % change_id, "files":records}
+        if status == "submitted":
+            self.head_change = max(self.head_change, change_id)
+
+    def add_file(self, depot_path, contents):
+        """
+        Add a file that can be printed, e.g. a tank_configs.yml back mapping file.
+        """
+        self.contents[depot_path] = contents
+        self.files.setdefault(depot_path, [(1, 0, "add", "")])
+
+    def add_project(self, depot_root, pc_path, project, shotgun):
+        """
+        Add a Toolkit project root to the depot together with its tk instance.
+        """
+        self.add_file("%s/tank/config/tank_configs.yml" % depot_root, "- {%s: %s}" % (sys.platform, pc_path))
+        tk = sgtk.Sgtk(pc_path, project, shotgun)
+        sgtk.tk_instances[pc_path] = tk
+        return tk
+
+    def connect(self):
+        return FakeP4(self)
+
+class FakeP4(object):
+    """
+    A connection to a FakePerforceServer.  All commands run are counted in 'calls'.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.port = server.port
+        self.errors = []
+        self.warnings = []
+        self.calls = {}
+        self.is_connected = True
+
+    @property
+    def count(self):
+        return sum(self.calls.values())
+
+    def connected(self):
+        return self.is_connected
+
+    def disconnect(self):
+        self.is_connected = False
+
+    def __start(self, command, args):
+        _count(self.calls, command)
+        self.errors = []
+        self.warnings = []
+        for failure in self.server.failures:
+            error = failure(command, args)
+            if error:
+                self.errors = [error]
+                raise P4Exception(error)
+
+    def __fail(self, message, warning=False):
+        if warning:
+            self.warnings = [message]
+        else:
+            self.errors = [message]
+        raise P4Exception(message)
+
+    # ------------------------------------------------------------------------------------------
+    # changes and files
+
+    def run_describe(self, *args):
+        self.__start("describe", args)
+        change_ids = []
+        for arg in args:
+            if isinstance(arg, (list, tuple)):
+                change_ids.extend(int(a) for a in arg)
+            elif str(arg).isdigit():
+                change_ids.append(int(arg))
+        results = []
+        with self.server.lock:
+            for change_id in change_ids:
+                change = self.server.changes.get(change_id)
+                if not change:
+                    continue
+                res = {"change":str(change_id), "status":change["status"], "user":change["user"],
+                       "client":change["client"], "time":str(change["time"]), "desc":change["desc"],
+                       "changeType":"public"}
+                if change["status"] == "submitted" and change["files"]:
+                    files = change["files"]
+                    res["path"] = "%s/..." % _common_directory([f[0] for f in files])
+                    res["depotFile"] = [f[0] for f in files]
+                    res["rev"] = [str(f[1]) for f in files]
+                    res["action"] = [f[2] for f in files]
+                    res["digest"] = [f[3] for f in files]
+                    res["type"] = ["text" for f in files]
+                    res["fileSize"] = ["100" for f in files]
+                results.append(res)
+        return results
+
+    def run_changes(self, *args):
+        self.__start("changes", args)
+        with self.server.lock:
+            head = self.server.head_change
+        return [{"change":str(head), "status":"submitted"}] if head else []
+
+    def run_fstat(self, *args):
+        self.__start("fstat", args)
+        args = list(args)
+        with self.server.lock:
+            if "-e" in args:
+                change = self.server.changes.get(int(args[args.index("-e") + 1]))
+                if not change:
+                    return []
+                return [{"depotFile":f[0], "headRev":str(f[1]), "headModTime":str(change["time"])}
+                        for f in change["files"] if f[2] not in ("delete", "move/delete", "purge", "archive")]
+            results = []
+            for spec in args:
+                depot_path, _, change_id = spec.partition("@")
+                revisions = [r for r in self.server.files.get(depot_path, [])
+                             if not change_id or r[1] <= int(change_id)]
+                results.append({"depotFile":depot_path, "headRev":str(revisions[-1][0])} if revisions else {})
+            return results
+
+    def run_files(self, *args):
+        self.__start("files", args)
+        results = []
+        with self.server.lock:
+            for depot_path in args:
+                revisions = self.server.files.get(depot_path)
+                if revisions:
+                    results.append({"depotFile":depot_path, "rev":str(revisions[-1][0])})
+        if not results:
+            self.__fail("%s - no such file(s)." % " ".join(args), warning=True)
+        return results
+
+    def run_print(self, depot_path):
+        self.__start("print", (depot_path,))
+        with self.server.lock:
+            if depot_path not in self.server.contents:
+                self.__fail("%s - no such file(s)." % depot_path, warning=True)
+            return [{"depotFile":depot_path, "rev":"1"}, self.server.contents[depot_path]]
+
+    # ------------------------------------------------------------------------------------------
+    # counters
+
+    def run_counter(self, *args):
+        self.__start("counter", args)
+        counters = self.server.counters
+        with self.server.lock:
+            if args[0] == "-i":
+                value = str(int(counters.get(args[1], "0")) + 1)
+                counters[args[1]] = value
+                return [{"counter":args[1], "value":value}]
+            if args[0] == "-d":
+                counters.pop(args[1], None)
+                return []
+            if args[0].startswith("--from="):
+                old_value, new_value, name = args[0][len("--from="):], args[1][len("--to="):], args[2]
+                if counters.get(name, "0") != old_value:
+                    self.__fail("Counter '%s' value is '%s' not '%s'." % (name, counters.get(name, "0"), old_value))
+                counters[name] = new_value
+                return [{"counter":name, "value":new_value}]
+            if len(args) == 2:
+                counters[args[0]] = str(args[1])
+                return [{"counter":args[0], "value":str(args[1])}]
+            return [{"counter":args[0], "value":counters.get(args[0], "0")}]
+
+    def run_counters(self, *args):
+        self.__start("counters", args)
+        pattern = args[args.index("-e") + 1] if "-e" in args else "*"
+        with self.server.lock:
+            return [{"counter":name, "value":value} for name, value in sorted(self.server.counters.iteritems())
+                    if fnmatch.fnmatchcase(name, pattern)]
+
+class FakeShotgun(object):
+    """
+    In-memory Shotgun site.  All requests are counted in 'calls' and kept in order in
+    'requests' as (method, args) tuples.  'fail' can be set to a function f(method, args)
+    that raises to make a request fail.
+    """
+
+    def __init__(self):
+        self.base_url = "https://test.shotgunstudio.com"
+        self.entities = {}
+        self.next_id = 1000
+        self.calls = {}
+        self.requests = []
+        self.fail = None
+        self.lock = threading.RLock()
+        self.schema = {
+            "Revision":{"published_files":{"data_type":{"value":"multi_entity"},
+                                           "properties":{"valid_types":{"value":["PublishedFile"]}}},
+                        "sg_workspace":{"data_type":{"value":"text"}}},
+            "PublishedFile":{"sg_depot_path":{"data_type":{"value":"text"}}},
+            "Version":{}}
+
+    @property
+    def count(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def __start(self, method, args):
+        with self.lock:
+            _count(self.calls, method)
+            self.requests.append((method, args))
+        if self.fail:
+            self.fail(method, args)
+
+    def finds(self, entity_type):
+        """
+        The number of find requests made for the specified entity type.
+        """
+        with self.lock:
+            return len([r for r in self.requests if r[0] in ("find", "find_one") and r[1][0] == entity_type])
+
+    def all(self, entity_type):
+        with self.lock:
+            return sorted(self.entities.get(entity_type, {}).values(), key=lambda e: e["id"])
+
+    # ------------------------------------------------------------------------------------------
+    # reads
+
+    def find(self, entity_type, filters, fields=None, order=None, filter_operator=None, limit=0, **kwargs):
+        self.__start("find", (entity_type, filters))
+        return self.__find(entity_type, filters, fields, order, limit)
+
+    def find_one(self, entity_type, filters, fields=None, order=None, **kwargs):
+        self.__start("find_one", (entity_type, filters))
+        res = self.__find(entity_type, filters, fields, order, 1)
+        return res[0] if res else None
+
+    def schema_field_read(self, entity_type, field_name=None):
+        self.__start("schema_field_read", (entity_type,))
+        return copy.deepcopy(self.schema.get(entity_type, {}))
+
+    # ------------------------------------------------------------------------------------------
+    # writes
+
+    def create(self, entity_type, data, return_fields=None):
+        self.__start("create", (entity_type, data))
+        with self.lock:
+            return self.__create(entity_type, data)
+
+    def update(self, entity_type, entity_id, data):
+        self.__start("update", (entity_type, entity_id, data))
+        with self.lock:
+            return self.__update(entity_type, entity_id, data)
+
+    def delete(self, entity_type, entity_id):
+        self.__start("delete", (entity_type, entity_id))
+        with self.lock:
+            return self.entities.get(entity_type, {}).pop(entity_id, None) is not None
+
+    def batch(self, requests):
+        self.__start("batch", (requests,))
+        with self.lock:
+            # batches are a single transaction:
+            backup = (copy.deepcopy(self.entities), self.next_id)
+            try:
+                results = []
+                for request in requests:
+                    if request.get("fail"):
+                        raise Exception("Batch request failed")
+                    if request["request_type"] == "create":
+                        results.append(self.__create(request["entity_type"], request["data"]))
+                    elif request["request_type"] == "update":
+                        results.append(self.__update(request["entity_type"], request["entity_id"], request["data"]))
+                    elif request["request_type"] == "delete":
+                        results.append(self.entities.get(request["entity_type"], {})
+                                       .pop(request["entity_id"], None) is not None)
+                return results
+            except:
+                self.entities, self.next_id = backup
+                raise
+
+    def upload(self, entity_type, entity_id, path, field_name=None, **kwargs):
+        self.__start("upload", (entity_type, entity_id, path))
+        return 1
+
+    def __create(self, entity_type, data):
+        self.__check_fields("create", entity_type, data)
+        self.next_id += 1
+        entity = dict(copy.deepcopy(data), type=entity_type, id=self.next_id)
+        self.entities.setdefault(entity_type, {})[entity["id"]] = entity
+        return copy.deepcopy(entity)
+
+    def __update(self, entity_type, entity_id, data):
+        self.__check_fields("update", entity_type, data)
+        entity = self.entities[entity_type][entity_id]
+        entity.update(copy.deepcopy(data))
+        return copy.deepcopy(entity)
+
+    def __check_fields(self, method, entity_type, data):
+        """
+        Fail writes to custom fields that aren't in the schema of the entity types the sync
+        links published files through.
+        """
+        if entity_type not in ("Revision", "PublishedFile"):
+            return
+        for field in data:
+            if field.startswith("sg_") or field == "published_files":
+                if field not in self.schema.get(entity_type, {}):
+                    raise Exception("API %s() %s.%s field does not exist" % (method, entity_type, field))
+
+    # ------------------------------------------------------------------------------------------
+    # filtering
+
+    def __find(self, entity_type, filters, fields, order, limit):
+        with self.lock:
+            matches = [e for e in self.entities.get(entity_type, {}).values()
+                       if self.__matches(e, {"filter_operator":"all", "filters":filters})]
+            for sort in reversed(order or []):
+                matches.sort(key=lambda e: e.get(sort["field_name"]), reverse=sort.get("direction") == "desc")
+            if not order:
+                matches.sort(key=lambda e: e["id"])
+            if limit:
+                matches = matches[:limit]
+            return [dict([("type", e["type"]), ("id", e["id"])]
+                         + [(f, copy.deepcopy(e.get(f))) for f in (fields or [])]) for e in matches]
+
+    def __matches(self, entity, condition):
+        if isinstance(condition, dict):
+            results = [self.__matches(entity, f) for f in condition["filters"]]
+            return any(results) if condition["filter_operator"] in ("any", "or") else all(results)
+
+        field, operator, value = condition
+        actual = entity.get(field)
+        if isinstance(actual, dict) and "id" in actual:
+            actual = (actual.get("type"), actual["id"])
+            value = (value.get("type"), value["id"]) if isinstance(value, dict) else value
+        if operator == "is":
+            return actual == value
+        if operator == "is_not":
+            return actual != value
+        if operator == "in":
+            return actual in value
+        if operator == "greater_than":
+            return actual > value
+        if operator == "less_than":
+            return actual < value
+        raise ValueError("Unsupported filter operator '%s'" % operator)
+
+def _load_default_settings():
+    """
+    Read the default value of every setting from info.yml.
+    """
+    settings = {}
+    name = setting_type = None
+    with open(os.path.join(_root, "info.yml")) as f:
+        for line in f:
+            match = re.match(r"^    (\w+):\s*$", line)
+            if match:
+                name = match.group(1)
+                continue
+            match = re.match(r"^        type: (\w+)", line)
+            if match:
+                setting_type = match.group(1)
+                continue
+            match = re.match(r"^        default_value: (.*?)\s*$", line)
+            if match and name:
+                value = match.group(1)
+                if setting_type == "int":
+                    value = int(value)
+                elif setting_type == "float":
+                    value = float(value)
+                elif setting_type == "bool":
+                    value = value == "true"
+                else:
+                    value = value.strip("\"'")
+                settings[name] = value
+    return settings
+
+_default_settings = _load_default_settings()
+
+class FakeApp(object):
+    """
+    The app bundle, running in the context of a single project.  Log messages are kept
+    so that tests can check them.
+    """
+
+    def __init__(self, project, tk, shotgun, cache_location, **settings):
+        self.context = sgtk.Context(project)
+        self.sgtk = self.tank = tk
+        self.shotgun = shotgun
+        self.cache_location = os.path.join(cache_location, "project_%d" % project["id"])
+        self.settings = dict(_default_settings)
+        self.settings["shared_cache_location"] = os.path.join(cache_location, "shared")
+        # requests aren't rate limited in the tests:
+        self.settings["shotgun_max_request_rate"] = 0
+        self.settings.update(settings)
+        self.logs = {"debug":[], "info":[], "warning":[], "error":[]}
+
+    def get_setting(self, name, default=None):
+        return self.settings.get(name, default)
+
+    def log_debug(self, msg):
+        self.logs["debug"].append(msg)
+
+    def log_info(self, msg):
+        self.logs["info"].append(msg)
+
+    def log_warning(self, msg):
+        self.logs["warning"].append(msg)
+
+    def log_error(self, msg):
+        self.logs["error"].append(msg)
+
+    def log_exception(self, msg):
+        self.logs["error"].append(msg)
+
+class _StopDaemon(Exception):
+    """
+    Raised to stop the daemon loop once it has run the requested number of cycles
+    """
+
+class _DaemonClock(object):
+    """
+    Replacement for the time module used by the daemon that stops the daemon instead of
+    sleeping once enough cycles have run.
+    """
+
+    def __init__(self, cycles):
+        self.cycles = cycles
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        self.cycles -= 1
+        if self.cycles <= 0:
+            raise _StopDaemon()
+
+def run_daemon_cycles(daemon, cycles=1):
+    """
+    Run the daemon loop for the specified number of cycles, i.e. until it has found no new
+    changes that many times.
+    """
+    clock = _DaemonClock(cycles)
+    shotgun_sync_daemon.time = clock
+    try:
+        daemon.run()
+    except _StopDaemon:
+        pass
+    finally:
+        shotgun_sync_daemon.time = time
+
+class SyncTestCase(unittest.TestCase):
+    """
+    Base class for the tests.  Each test gets a Perforce server containing a single
+    Toolkit project at //depot/proj and an app running for it.
+    """
+
+    PROJECT = {"type":"Project", "id":65, "name":"proj"}
+    DEPOT_ROOT = "//depot/proj"
+
+    def setUp(self):
+        sgtk.reset()
+        shotgun_scheduler._schedulers.clear()
+        SchemaCache._SchemaCache__schemas.clear()
+
+        self.temp_dir = tempfile.mkdtemp(prefix="tk_shell_perforcesync_tests_")
+        self.server = FakePerforceServer()
+        self.shotgun = FakeShotgun()
+        self.tk = self.server.add_project(self.DEPOT_ROOT, "/pc/proj", self.PROJECT, self.shotgun)
+        self.connections = []
+        sgtk.framework.connection.factory = self.connect
+        self.p4 = self.connect()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def connect(self):
+        """
+        Open a new connection to the test server.
+        """
+        p4 = self.server.connect()
+        self.connections.append(p4)
+        return p4
+
+    def make_app(self, project=None, tk=None, **settings):
+        """
+        Create an app running for the test project (or the specified project).
+        """
+        return FakeApp(project or self.PROJECT, tk or self.tk, self.shotgun, self.temp_dir, **settings)
+
+    def path(self, relative_path):
+        """
+        Return the depot path of a file in the test project.
+        """
+        return "%s/%s" % (self.DEPOT_ROOT, relative_path)
+
+    def p4_calls(self, command=None):
+        """
+        The number of Perforce commands run on all connections, optionally just for one command.
+        """
+        return sum((p4.calls.get(command, 0) if command else p4.count) for p4 in self.connections)
+
+    def revisions(self):
+        """
+        Return the codes of all Revision entities in Shotgun, in id order.
+        """
+        return [e["code"] for e in self.shotgun.all("Revision")]
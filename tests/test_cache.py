@@ -0,0 +1,102 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for the bounded caches used by the sync
+"""
+
+import time
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync import cache
+from tk_shell_perforcesync.cache import LruCache
+
+class _Clock(object):
+    """
+    Replacement for the time module used by the cache
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+class TestLruCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = _Clock()
+        cache.time = self.clock
+
+    def tearDown(self):
+        cache.time = time
+
+    def test_least_recently_used_entry_is_evicted(self):
+        lru = LruCache("test", 2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+
+        self.assertEqual(sorted(lru.keys()), ["a", "c"])
+        self.assertEqual(lru.stats()["evictions"], 1)
+
+    def test_entries_expire(self):
+        lru = LruCache("test", 10, ttl=60, negative_ttl=5)
+        lru.set("positive", 1)
+        lru.set("negative", None)
+        self.assertEqual(lru.lookup("negative"), (True, None))
+
+        self.clock.now += 10
+        self.assertEqual(lru.lookup("negative"), (False, None))
+        self.assertEqual(lru.lookup("positive"), (True, 1))
+
+        self.clock.now += 60
+        self.assertEqual(lru.lookup("positive"), (False, None))
+        self.assertEqual(lru.stats()["expirations"], 2)
+
+    def test_stats(self):
+        lru = LruCache("test", 10)
+        lru.set("a", 1)
+        lru.get("a")
+        lru.get("b")
+
+        self.assertEqual(lru.stats(), {"size":1, "hits":1, "misses":1, "evictions":0, "expirations":0})
+        self.assertEqual(lru.format_stats(), "test: 1 entries, 1 hits, 1 misses (50.0% hit rate), "
+                                             "0 evictions, 0 expirations")
+
+class TestSyncCaches(SyncTestCase):
+
+    def test_caches_are_bounded(self):
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False, cache_max_size=2, publish_cache_size=2,
+                                            content_cache_size=2))
+        for change_id in range(10, 15):
+            self.server.submit(change_id, [(self.path("assets/asset_%d/model.ma" % change_id), "add")])
+
+        p4_sync.sync_changes(10, 14, self.p4)
+
+        self.assertEqual(len(self.revisions()), 5)
+        for sync_cache in p4_sync.caches:
+            self.assertTrue(len(sync_cache) <= 2, sync_cache.format_stats())
+
+    def test_cache_stats_are_logged(self):
+        app = self.make_app(use_work_queue=False)
+        p4_sync = ShotgunSync(app)
+
+        p4_sync.log_cache_stats()
+
+        self.assertEqual(len([msg for msg in app.logs["debug"] if msg.startswith("Cache stats")]),
+                         len(p4_sync.caches))
+
+if __name__ == "__main__":
+    unittest.main()
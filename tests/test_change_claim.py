@@ -0,0 +1,223 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for claiming changes and making sure each change only ever gets a single Revision
+entity, whichever process creates it
+"""
+
+import os
+import socket
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase, run_daemon_cycles
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.change_claim import ChangeClaim
+from tk_shell_perforcesync.counter_manager import CounterManager
+from tk_shell_perforcesync.p4_records import P4Change
+from tk_shell_perforcesync.shotgun_sync_daemon import ShotgunSyncDaemon
+
+class TestChangeClaim(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.app = self.make_app(use_work_queue=False)
+        self.counter_name = "%s%d" % (ShotgunSyncDaemon.P4_COUNTER_BASE_NAME, self.PROJECT["id"])
+
+    def test_only_first_claim_succeeds(self):
+        claim = ChangeClaim(self.app, self.counter_name)
+        self.assertTrue(claim.claim(self.p4, 10))
+        self.assertFalse(claim.claim(self.p4, 10))
+        self.assertFalse(ChangeClaim(self.app, self.counter_name).claim(self.connect(), 10))
+
+    def test_claims_are_single_round_trips(self):
+        claim = ChangeClaim(self.app, self.counter_name)
+        claim.claim(self.p4, 10)
+        calls = self.p4.count
+
+        for change_id in [11, 12, 13]:
+            self.assertTrue(claim.claim(self.p4, change_id))
+        self.assertEqual(self.p4.count - calls, 3)
+
+    def test_claims_by_other_daemons_are_seen(self):
+        claim = ChangeClaim(self.app, self.counter_name)
+        other_claim = ChangeClaim(self.app, self.counter_name)
+        claim.claim(self.p4, 10)
+        other_claim.claim(self.p4, 11)
+
+        # the cached value is out of date so the counter is read again:
+        self.assertFalse(claim.claim(self.p4, 11))
+        self.assertTrue(claim.claim(self.p4, 12))
+
+    def test_release_removes_claims_up_to_change(self):
+        claim = ChangeClaim(self.app, self.counter_name)
+        for change_id in [5, 6, 7]:
+            claim.claim(self.p4, change_id)
+        calls = self.p4.count
+
+        self.assertEqual(claim.release(self.p4, 6), 2)
+        self.assertEqual(self.p4.count - calls, 1)
+        self.assertEqual(self.server.counters[claim.counter_name], "7=%s.%d" % (socket.gethostname(), os.getpid()))
+
+        # the remaining claim is released once the counter has moved past it:
+        self.assertEqual(claim.release(self.p4, 7), 1)
+        self.assertEqual(self.server.counters[claim.counter_name], "0")
+        self.assertFalse(claim.claim(self.p4, 7))
+
+    def test_release_does_nothing_without_claims(self):
+        claim = ChangeClaim(self.app, self.counter_name)
+        claim.claim(self.p4, 5)
+        claim.release(self.p4, 5)
+        calls = self.p4.count
+
+        self.assertEqual(claim.release(self.p4, 5), 0)
+        self.assertEqual(claim.release(self.p4, 6), 0)
+        self.assertEqual(self.p4.count, calls)
+
+    def test_claim_records_owner(self):
+        claim = ChangeClaim(self.app, self.counter_name)
+        claim.claim(self.p4, 10)
+
+        self.assertEqual(self.server.counters[claim.counter_name],
+                         "10=%s.%d" % (socket.gethostname(), os.getpid()))
+        self.assertTrue(claim.is_own_claim(self.p4, 10))
+        self.assertFalse(claim.is_own_claim(self.p4, 11))
+
+    def test_claims_by_stopped_processes_are_own_claims(self):
+        claim = ChangeClaim(self.app, self.counter_name)
+        host = socket.gethostname()
+        self.server.counters[claim.counter_name] = "10=%s.999999,11=%s.%d,12=other-host.999999" % (host, host, 
+                                                                                                  os.getppid())
+
+        self.assertEqual([claim.is_own_claim(self.p4, c) for c in [10, 11, 12]], [True, False, False])
+
+class TestCounterManager(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.counter_name = "%s%d" % (ShotgunSyncDaemon.P4_COUNTER_BASE_NAME, self.PROJECT["id"])
+        self.server.counters[self.counter_name] = "5"
+        self.counter = CounterManager(self.make_app(), self.counter_name, 3600, 100)
+        self.counter.get(self.p4)
+
+    def test_counter_is_advanced(self):
+        self.counter.advance(self.p4, 10)
+        self.counter.flush(self.p4)
+
+        self.assertEqual(self.server.counters[self.counter_name], "10")
+
+    def test_counter_is_not_moved_backwards(self):
+        self.counter.advance(self.p4, 10)
+        # another daemon moves the counter further on:
+        self.server.counters[self.counter_name] = "20"
+
+        self.counter.flush(self.p4)
+
+        self.assertEqual(self.server.counters[self.counter_name], "20")
+        self.assertEqual(self.counter.get(self.p4), 20)
+
+class TestSingleRevision(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.server.submit(10, [(self.path("assets/hero/model.ma"), "add")])
+        self.p4_change = P4Change.from_describe(self.p4.run_describe(10)[0])
+
+    def __create_competing_revision(self, method):
+        """
+        Make another process create the Revision for change 10 just before the sync next
+        calls the specified Shotgun method.
+        """
+        def fail(called_method, args):
+            if called_method == method:
+                self.shotgun.fail = None
+                self.shotgun.create("Revision", {"code":"10", "project":self.PROJECT})
+        self.shotgun.fail = fail
+
+    def test_claimed_change_is_created_once(self):
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+        requests = len(self.shotgun.requests)
+
+        self.assertTrue(p4_sync.create_sg_entity_for_change(self.p4_change, claimed=True))
+        self.assertEqual([method for method, _ in self.shotgun.requests[requests:]], ["create"])
+        self.assertEqual(self.revisions(), ["10"])
+
+    def test_unclaimed_change_is_not_created_twice(self):
+        self.shotgun.create("Revision", {"code":"10", "project":self.PROJECT})
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+
+        self.assertEqual(p4_sync.create_sg_entity_for_change(self.p4_change), None)
+        self.assertEqual(self.revisions(), ["10"])
+
+    def test_unclaimed_change_created_concurrently_is_deleted(self):
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+        self.__create_competing_revision("create")
+
+        self.assertEqual(p4_sync.create_sg_entity_for_change(self.p4_change), None)
+        self.assertEqual(self.revisions(), ["10"])
+        self.assertEqual(self.shotgun.calls.get("delete"), 1)
+
+    def test_buffered_changes_are_written_without_checks(self):
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False, write_buffer_size=100))
+        self.assertTrue(p4_sync.queue_change(self.p4, self.p4_change))
+        finds = self.shotgun.finds("Revision")
+
+        self.assertEqual(p4_sync.flush_writes(), [10])
+        self.assertEqual(self.revisions(), ["10"])
+        self.assertEqual(self.shotgun.finds("Revision"), finds)
+
+    def test_daemon_releases_claims(self):
+        self.server.submit(11, [(self.path("assets/hero/rig.ma"), "add")])
+        daemon = ShotgunSyncDaemon(self.make_app(use_work_queue=False, counter_flush_changes=1))
+
+        run_daemon_cycles(daemon)
+
+        self.assertEqual(self.revisions(), ["10", "11"])
+        self.assertEqual(self.server.counters, {daemon._p4_counter_name:"11", 
+                                                daemon._change_claim.counter_name:"0"})
+
+    def __claim_for(self, change_id, pid):
+        claim = ChangeClaim(self.make_app(), "%s%d" % (ShotgunSyncDaemon.P4_COUNTER_BASE_NAME, self.PROJECT["id"]))
+        self.server.counters[claim.counter_name] = "%d=%s.%d" % (change_id, socket.gethostname(), pid)
+
+    def test_daemon_skips_changes_claimed_by_other_daemons(self):
+        self.server.submit(11, [(self.path("assets/hero/rig.ma"), "add")])
+        # another daemon that is still running claimed change 10 but hasn't synced it yet:
+        self.__claim_for(10, os.getppid())
+        daemon = ShotgunSyncDaemon(self.make_app(use_work_queue=False))
+
+        run_daemon_cycles(daemon)
+
+        self.assertEqual(self.revisions(), ["11"])
+
+    def test_daemon_recovers_own_claims(self):
+        self.server.submit(11, [(self.path("assets/hero/rig.ma"), "add")])
+        # claimed by this daemon before it was restarted:
+        self.__claim_for(11, 999999)
+        daemon = ShotgunSyncDaemon(self.make_app(use_work_queue=False, write_buffer_size=100,
+                                                 counter_flush_changes=1))
+        revisions_at_advance = []
+        advance = daemon._counter.advance
+        def record_advance(p4, change_id):
+            revisions_at_advance.append((change_id, self.revisions()))
+            return advance(p4, change_id)
+        daemon._counter.advance = record_advance
+
+        run_daemon_cycles(daemon)
+
+        self.assertEqual(sorted(self.revisions()), ["10", "11"])
+        self.assertEqual(self.server.counters[daemon._p4_counter_name], "11")
+        # the buffered change is written before the counter moves past it:
+        for change_id, revisions in revisions_at_advance:
+            self.assertTrue(str(change_id) in revisions and (change_id < 11 or "10" in revisions))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for classifying changes by directory instead of by file
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.p4_records import P4Change
+
+class TestChangeClassification(SyncTestCase):
+
+    OTHER_PROJECT = {"type":"Project", "id":66, "name":"other"}
+
+    def __classify(self, change_id, project=None, tk=None):
+        """
+        Classify a change with a fresh sync and return the result and the number of
+        Perforce commands it needed.
+        """
+        p4_sync = ShotgunSync(self.make_app(project, tk, use_work_queue=False, use_membership_index=False))
+        p4_change = P4Change.from_describe(self.p4.run_describe(change_id)[0])
+        calls = self.p4.count
+        in_context = p4_sync.is_change_in_context(self.p4, p4_change)
+        return in_context, self.p4.count - calls
+
+    def test_cost_doesnt_depend_on_number_of_files(self):
+        self.server.submit(10, [(self.path("assets/hero/model.ma"), "add")])
+        self.server.submit(11, [(self.path("assets/hero/file_%d.ma" % i), "add") for i in range(50)])
+
+        self.assertEqual(self.__classify(11), self.__classify(10))
+
+    def test_cost_doesnt_depend_on_number_of_directories(self):
+        self.server.submit(10, [(self.path("assets/%s/model.ma" % a), "add") for a in "ab"])
+        self.server.submit(11, [(self.path("assets/%s/model.ma" % a), "add") for a in "abcdefgh"])
+
+        self.assertEqual(self.__classify(11), self.__classify(10))
+
+    def test_partly_managed_changes(self):
+        self.server.submit(10, [(self.path("assets/hero/model.ma"), "add"), ("//depot/unmanaged/notes.txt", "add")])
+        self.server.submit(11, [("//depot/unmanaged/notes.txt", "edit")])
+
+        self.assertTrue(self.__classify(10)[0])
+        self.assertFalse(self.__classify(11)[0])
+
+    def test_changes_spanning_projects(self):
+        other_tk = self.server.add_project("//depot/other", "/pc/other", self.OTHER_PROJECT, self.shotgun)
+        self.server.submit(10, [(self.path("assets/hero/model.ma"), "add"), ("//depot/other/model.ma", "add")])
+
+        self.assertTrue(self.__classify(10)[0])
+        self.assertTrue(self.__classify(10, self.OTHER_PROJECT, other_tk)[0])
+
+if __name__ == "__main__":
+    unittest.main()
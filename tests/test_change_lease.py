@@ -0,0 +1,124 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for leasing ranges of changes to daemons
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase, run_daemon_cycles
+from tk_shell_perforcesync.change_lease import ChangeLeaseManager, P4CounterLeaseBackend, LocalLeaseBackend
+from tk_shell_perforcesync.shotgun_sync_daemon import ShotgunSyncDaemon
+
+COUNTER_NAME = "tk_perforcesync_project_65"
+
+class _RacingBackend(P4CounterLeaseBackend):
+    """
+    Backend where another daemon initialises the next range just after it's first read
+    """
+
+    def __init__(self, server, next_range):
+        self.__server = server
+        self.__next_range = next_range
+
+    def get(self, p4, name):
+        value = P4CounterLeaseBackend.get(self, p4, name)
+        if name.endswith("_next") and self.__next_range is not None:
+            self.__server.counters[name] = str(self.__next_range)
+            self.__next_range = None
+        return value
+
+class TestLeaseBackends(SyncTestCase):
+
+    def __check_compare_and_set(self, backend):
+        self.assertTrue(backend.compare_and_set(self.p4, "lease", "0", "a"))
+        self.assertFalse(backend.compare_and_set(self.p4, "lease", "0", "b"))
+        self.assertTrue(backend.compare_and_set(self.p4, "lease", "a", "b"))
+        self.assertEqual(backend.get(self.p4, "lease"), "b")
+
+    def test_p4_compare_and_set(self):
+        self.__check_compare_and_set(P4CounterLeaseBackend())
+
+    def test_local_compare_and_set(self):
+        self.__check_compare_and_set(LocalLeaseBackend(self.temp_dir))
+
+class TestChangeLeaseManager(SyncTestCase):
+
+    def __manager(self, backend=None, range_size=10, ttl=300):
+        return ChangeLeaseManager(self.make_app(), COUNTER_NAME, backend or P4CounterLeaseBackend(),
+                                  range_size, ttl)
+
+    def test_ranges_are_only_leased_once(self):
+        leases = [self.__manager().acquire(self.p4, 100, 1) for _ in range(3)]
+
+        self.assertEqual([(l.start_change, l.end_change) for l in leases], [(0, 9), (10, 19), (20, 29)])
+        self.assertEqual(leases[0].progress, 0)
+
+    def test_next_range_initialised_by_another_daemon(self):
+        manager = self.__manager(_RacingBackend(self.server, 5))
+
+        lease = manager.acquire(self.p4, 100, 1)
+
+        self.assertEqual(lease.start_change, 50)
+        # the other daemon is responsible for moving the project counter:
+        self.assertEqual(self.server.counters.get(COUNTER_NAME), None)
+
+    def test_first_daemon_moves_counter_to_first_range(self):
+        lease = self.__manager().acquire(self.p4, 100, 35)
+
+        self.assertEqual((lease.start_change, lease.progress), (30, 34))
+        self.assertEqual(self.server.counters[COUNTER_NAME], "29")
+
+    def test_heartbeat_fails_after_take_over(self):
+        manager = self.__manager(ttl=0)
+        lease = manager.acquire(self.p4, 100, 1)
+        lease.progress = 4
+        self.assertTrue(manager.heartbeat(self.p4, lease))
+
+        other_lease = self.__manager(ttl=0).acquire(self.p4, 100, 1)
+        self.assertEqual((other_lease.start_change, other_lease.progress), (0, 4))
+        self.assertTrue(other_lease.taken_over)
+
+        self.assertFalse(manager.heartbeat(self.p4, lease))
+        self.assertEqual(manager.complete(self.p4, lease), None)
+        self.assertTrue(other_lease.state.startswith("2:"))
+
+    def test_counter_moves_to_end_of_completed_ranges(self):
+        manager = self.__manager()
+        leases = [manager.acquire(self.p4, 100, 1) for _ in range(3)]
+
+        # can't move past the first range until it is complete:
+        self.assertEqual(manager.complete(self.p4, leases[1]), None)
+        self.assertEqual(self.server.counters.get(COUNTER_NAME), None)
+
+        self.assertEqual(manager.complete(self.p4, leases[0]), 19)
+        self.assertEqual(self.server.counters[COUNTER_NAME], "19")
+
+        self.assertEqual(manager.complete(self.p4, leases[2]), 29)
+        # only the next range is left:
+        self.assertEqual(sorted(name for name in self.server.counters if "_lease_" in name),
+                         [COUNTER_NAME + "_lease_next"])
+
+    def test_daemon_moves_project_counter(self):
+        for change_id in range(1, 12):
+            self.server.submit(change_id, [(self.path("assets/hero/model.ma"), "edit")])
+        daemon = ShotgunSyncDaemon(self.make_app(coordination_mode="lease", lease_range_size=5,
+                                                 use_work_queue=False))
+
+        run_daemon_cycles(daemon)
+
+        self.assertEqual(self.revisions(), [str(c) for c in range(1, 12)])
+        # changes 10 and 11 are in a range that hasn't been completed:
+        self.assertEqual(self.server.counters[COUNTER_NAME], "9")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for describing changes in blocks, and in the background, before they are needed
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase, run_daemon_cycles
+from tk_shell_perforcesync.change_lookahead import ChangeLookahead
+from tk_shell_perforcesync.shotgun_sync_daemon import ShotgunSyncDaemon
+
+class TestChangeLookahead(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        for change_id in [10, 11, 13, 14]:
+            self.server.submit(change_id, [(self.path("assets/hero/model.ma"), "edit")])
+
+    def __lookahead(self, prefetch=False, block_size=10):
+        return ChangeLookahead(self.make_app(), None, None, block_size, prefetch, lambda p4, change_id: False)
+
+    def __find_all(self, lookahead, start_change=10):
+        change_ids = []
+        change = lookahead.find_next(self.p4, start_change)
+        while change:
+            change_ids.append(change.change)
+            change = lookahead.find_next(self.p4, change.change + 1)
+        return change_ids
+
+    def test_changes_are_described_once(self):
+        lookahead = self.__lookahead(block_size=2)
+
+        self.assertEqual(self.__find_all(lookahead), [10, 11, 13, 14])
+        self.assertEqual(self.p4_calls("describe"), 3)
+
+        # nothing new has been submitted so only the most recent change is checked:
+        self.assertEqual(lookahead.find_next(self.p4, 15), None)
+        self.assertEqual(self.p4_calls("describe"), 3)
+
+    def test_changes_outside_window_are_discarded(self):
+        lookahead = self.__lookahead()
+        self.assertEqual(lookahead.find_next(self.p4, 10).change, 10)
+
+        self.assertEqual(lookahead.find_next(self.p4, 5).change, 10)
+        self.assertEqual(self.p4_calls("describe"), 2)
+
+    def test_prefetch_uses_separate_connection(self):
+        lookahead = self.__lookahead(prefetch=True, block_size=2)
+
+        self.assertEqual(self.__find_all(lookahead), [10, 11, 13, 14])
+
+        prefetch_p4s = self.connections[1:]
+        self.assertEqual(len(prefetch_p4s), 1)
+        self.assertTrue(prefetch_p4s[0].calls.get("describe"))
+        self.assertEqual(self.p4_calls("describe"), 3)
+
+    def test_close_disconnects_prefetch_connection(self):
+        lookahead = self.__lookahead(prefetch=True, block_size=2)
+        lookahead.find_next(self.p4, 10)
+        lookahead.find_next(self.p4, 11)
+
+        lookahead.close()
+
+        self.assertEqual([p4.connected() for p4 in self.connections[1:]], [False])
+        # the prefetched changes were discarded but can still be found:
+        self.assertEqual(lookahead.find_next(self.p4, 12).change, 13)
+
+    def test_daemon_closes_prefetch_connection(self):
+        daemon = ShotgunSyncDaemon(self.make_app(use_work_queue=False, describe_block_size=2))
+
+        run_daemon_cycles(daemon)
+
+        self.assertEqual(self.revisions(), ["10", "11", "13", "14"])
+        self.assertFalse([p4 for p4 in self.connections[1:] if p4.connected()])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for spooling changes read from Perforce and writing them to Shotgun separately
+"""
+
+import os
+import unittest
+from datetime import datetime
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+import sgtk
+from sgtk import TankError
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.change_spool import ChangeSpool
+
+class TestChangeSpool(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.app = self.make_app()
+        self.spool = ChangeSpool(self.app, os.path.join(self.temp_dir, "spool"))
+
+    def tearDown(self):
+        ChangeSpool.MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+        SyncTestCase.tearDown(self)
+
+    def test_records_are_read_in_order(self):
+        submitted_at = datetime(2013, 10, 27, 19, 20, 28)
+        self.spool.append({"change":10, "created_at":submitted_at})
+        self.spool.append({"change":11})
+
+        records = [record for _, record in self.spool.read_pending(10)]
+
+        self.assertEqual(records, [{"change":10, "created_at":submitted_at}, {"change":11}])
+
+    def test_partial_records_are_ignored(self):
+        self.spool.append({"change":10})
+        with open(os.path.join(self.spool.location, ChangeSpool.SEGMENT_FILE_PATTERN % 1), "ab") as f:
+            f.write('{"change":1')
+        self.assertEqual([record for _, record in self.spool.read_pending(10)], [{"change":10}])
+
+        # the next record starts on a new line and the partial record is skipped:
+        self.spool.append({"change":11})
+        self.assertEqual([record for _, record in self.spool.read_pending(10)], [{"change":10}, {"change":11}])
+        self.assertEqual(len(self.app.logs["error"]), 1)
+
+    def test_applied_segments_are_removed(self):
+        ChangeSpool.MAX_SEGMENT_SIZE = 1
+        for change_id in range(10, 13):
+            self.spool.append({"change":change_id})
+        self.assertEqual(len(os.listdir(self.spool.location)), 3)
+
+        entries = self.spool.read_pending(2)
+        self.spool.mark_applied(entries[-1][0])
+
+        self.assertEqual([record for _, record in self.spool.read_pending(10)], [{"change":12}])
+        self.assertEqual(sorted(os.listdir(self.spool.location)),
+                         [ChangeSpool.APPLY_STATE_FILE_NAME, ChangeSpool.SEGMENT_FILE_PATTERN % 2,
+                          ChangeSpool.SEGMENT_FILE_PATTERN % 3])
+
+class TestSpoolSync(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        for change_id in range(10, 13):
+            self.server.submit(change_id, [(self.path("assets/hero/model.ma"), "edit")])
+        self.p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+        self.spool = ChangeSpool(self.make_app(), os.path.join(self.temp_dir, "spool"))
+
+    def __writes(self):
+        return len([r for r in self.shotgun.requests if r[0] in ("create", "update", "batch")])
+
+    def test_extract_doesnt_write_to_shotgun(self):
+        writes = self.__writes()
+
+        self.assertEqual(self.p4_sync.spool_changes(self.spool, 10, 11, self.p4), 2)
+        self.assertEqual(self.__writes(), writes)
+        self.assertEqual(self.spool.last_extracted_change, 11)
+
+        # extracting carries on from the last change extracted:
+        self.assertEqual(self.p4_sync.spool_changes(self.spool, end_change=12, p4=self.p4), 1)
+
+    def test_start_change_is_needed_for_empty_spool(self):
+        self.assertRaises(TankError, self.p4_sync.spool_changes, self.spool, None, 12, self.p4)
+
+    def test_spooled_changes_are_applied(self):
+        self.p4_sync.spool_changes(self.spool, 10, 12, self.p4)
+        describes = self.p4_calls("describe")
+
+        self.assertEqual(self.p4_sync.apply_spool(self.spool, 2), 3)
+
+        self.assertEqual(self.revisions(), ["10", "11", "12"])
+        self.assertEqual(len(self.shotgun.all("PublishedFile")), 3)
+        for revision in self.shotgun.all("Revision"):
+            self.assertEqual(len(revision["published_files"]), 1)
+        self.assertEqual(self.p4_calls("describe"), describes)
+        self.assertEqual(self.p4_sync.apply_spool(self.spool, 2), 0)
+
+    def test_applying_again_is_idempotent(self):
+        self.p4_sync.spool_changes(self.spool, 10, 12, self.p4)
+        self.p4_sync.apply_spool(self.spool, 10)
+
+        # as if the apply stage was interrupted before recording its progress:
+        os.remove(os.path.join(self.spool.location, ChangeSpool.APPLY_STATE_FILE_NAME))
+        self.assertEqual(self.p4_sync.apply_spool(self.spool, 10), 3)
+
+        self.assertEqual(self.revisions(), ["10", "11", "12"])
+        self.assertEqual(len(self.shotgun.all("PublishedFile")), 3)
+
+    def test_applying_again_after_interruption_completes_changes(self):
+        rig = self.path("assets/hero/rig.ma")
+        self.server.submit(13, [(rig, "add")])
+        sgtk.framework.publish_data[(rig, 1)] = {"dependency_paths":[self.path("assets/hero/model.ma")]}
+        sgtk.framework.review_data[(rig, 1)] = {"code":"rig review"}
+        self.p4_sync.spool_changes(self.spool, 10, 13, self.p4)
+
+        # interrupt the apply once the publishes have been registered but before the Revisions
+        # and dependencies are written:
+        def _interrupt(method, args):
+            if method == "batch":
+                raise KeyboardInterrupt()
+        self.shotgun.fail = _interrupt
+        self.assertRaises(KeyboardInterrupt, self.p4_sync.apply_spool, self.spool, 10)
+        self.assertEqual((self.revisions(), len(self.shotgun.all("PublishedFile"))), ([], 4))
+
+        self.shotgun.fail = None
+        self.assertEqual(self.p4_sync.apply_spool(self.spool, 10), 4)
+
+        self.assertEqual(self.revisions(), ["10", "11", "12", "13"])
+        self.assertEqual(len(self.shotgun.all("PublishedFile")), 4)
+        self.assertEqual(len(self.shotgun.all("PublishedFileDependency")), 1)
+        self.assertEqual([v["code"] for v in self.shotgun.all("Version")], ["rig review"])
+
+if __name__ == "__main__":
+    unittest.main()
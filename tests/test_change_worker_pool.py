@@ -0,0 +1,123 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for processing changes with an adaptively sized pool of workers
+"""
+
+import time
+import threading
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase, run_daemon_cycles
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.p4_records import P4Change
+from tk_shell_perforcesync.shotgun_scheduler import ShotgunScheduler
+from tk_shell_perforcesync.shotgun_sync_daemon import ShotgunSyncDaemon
+from tk_shell_perforcesync.change_worker_pool import ChangeWorkerPool, ConcurrencyController
+
+class _ParallelShotgun(object):
+    """
+    Shotgun connection that records how many requests are in progress at the same time
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_progress = 0
+        self.max_in_progress = 0
+
+    def find(self, *args, **kwargs):
+        with self.lock:
+            self.in_progress += 1
+            self.max_in_progress = max(self.max_in_progress, self.in_progress)
+        time.sleep(0.05)
+        with self.lock:
+            self.in_progress -= 1
+        return []
+
+class TestConcurrencyController(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.controller = ConcurrencyController(self.make_app(), 1, 4)
+
+    def test_workers_are_added_for_backlog(self):
+        self.assertEqual(self.controller.decide(1, 10, 0), 2)
+        self.assertEqual(self.controller.decide(4, 100, 0), 4)
+
+    def test_workers_are_removed_when_drained(self):
+        self.assertEqual(self.controller.decide(3, 2, 0), 2)
+        self.assertEqual(self.controller.decide(1, 0, 0), 1)
+
+    def test_workers_are_removed_on_errors(self):
+        for error in [False, True, True]:
+            self.controller.record(1.0, error)
+        self.assertEqual(self.controller.decide(3, 100, 0), 2)
+
+        # failed Shotgun requests count as errors too:
+        self.controller.record(1.0, False)
+        self.assertEqual(self.controller.decide(2, 100, 5), 1)
+
+    def test_workers_are_removed_when_slower(self):
+        self.controller.record(1.0, False)
+        self.assertEqual(self.controller.decide(1, 10, 0), 2)
+
+        self.controller.record(2.0, False)
+        self.assertEqual(self.controller.decide(2, 10, 0), 1)
+
+class TestChangeWorkerPool(SyncTestCase):
+
+    def test_workers_share_sync(self):
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+        used = []
+        def process_change(worker_sync, p4, p4_change):
+            used.append((worker_sync, p4_change.change))
+        pool = ChangeWorkerPool(self.make_app(), p4_sync, None, None, process_change)
+        try:
+            pool.resize(3)
+            for change_id in range(10, 16):
+                pool.submit(P4Change(change_id, "submitted", "artist", "artist_ws", 0, ""))
+            results = [pool.get_result(5) for _ in range(6)]
+            pool.resize(1)
+            pool.resize(2)
+            pool.submit(P4Change(16, "submitted", "artist", "artist_ws", 0, ""))
+            results.append(pool.get_result(5))
+        finally:
+            pool.resize(0)
+
+        self.assertEqual(sorted(change_id for change_id, _, _ in results), range(10, 17))
+        self.assertEqual(set(worker_sync for worker_sync, _ in used), set([p4_sync]))
+
+    def test_shotgun_requests_run_in_parallel(self):
+        shotgun = _ParallelShotgun()
+        scheduler = ShotgunScheduler(self.make_app(), shotgun, 0, 1, 5.0)
+        threads = [threading.Thread(target=scheduler.find, args=("Revision", [])) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(shotgun.max_in_progress > 1)
+
+    def test_daemon_syncs_changes_with_workers(self):
+        for change_id in range(10, 20):
+            self.server.submit(change_id, [(self.path("assets/asset_%d/model.ma" % change_id), "add")])
+        daemon = ShotgunSyncDaemon(self.make_app(use_work_queue=False, min_change_workers=2, max_change_workers=3))
+        try:
+            run_daemon_cycles(daemon)
+        finally:
+            daemon._worker_pool.resize(0)
+
+        self.assertEqual(sorted(self.revisions()), [str(c) for c in range(10, 20)])
+        self.assertEqual(self.server.counters["tk_perforcesync_project_65"], "19")
+
+if __name__ == "__main__":
+    unittest.main()
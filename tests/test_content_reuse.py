@@ -0,0 +1,78 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for reusing the publish data of files integrated from another depot path with the
+same content
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+import sgtk
+from tk_shell_perforcesync import ShotgunSync
+
+class TestContentReuse(SyncTestCase):
+
+    BRANCH_ROOT = "//depot/branch"
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.server.add_project(self.BRANCH_ROOT, "/pc/branch", self.PROJECT, self.shotgun)
+        self.model = self.path("assets/hero/model.ma")
+        self.branch_model = "%s/assets/hero/model.ma" % self.BRANCH_ROOT
+        self.server.submit(10, [(self.model, "add", "ABC")])
+        self.p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+
+    def __publishes(self, depot_path):
+        return [p for p in self.shotgun.all("PublishedFile") if p["sg_depot_path"] == depot_path]
+
+    def test_integrated_files_reuse_publish_data(self):
+        sgtk.framework.publish_data[(self.model, 1)] = {"sg_fields":{"published_file_type":"Maya Scene"}}
+        self.server.submit(11, [(self.branch_model, "branch", "ABC", self.model)])
+
+        self.p4_sync.sync_changes(10, 11, self.p4)
+
+        self.assertEqual(sgtk.framework.calls["load_publish_data"], 1)
+        branch_publishes = self.__publishes(self.branch_model)
+        self.assertEqual([(p["version_number"], p["published_file_type"]) for p in branch_publishes],
+                         [(1, "Maya Scene")])
+
+    def test_files_with_different_content_arent_reused(self):
+        self.server.submit(11, [(self.branch_model, "integrate", "DEF", self.model)])
+
+        self.p4_sync.sync_changes(10, 11, self.p4)
+
+        self.assertEqual(sgtk.framework.calls["load_publish_data"], 2)
+
+    def test_resubmitted_files_are_loaded_again(self):
+        self.server.submit(11, [(self.model, "edit", "ABC")])
+        sgtk.framework.publish_data[(self.model, 2)] = {"sg_fields":{"published_file_type":"Maya Scene"}}
+
+        self.p4_sync.sync_changes(10, 11, self.p4)
+
+        self.assertEqual(sgtk.framework.calls["load_publish_data"], 2)
+        self.assertEqual([p.get("published_file_type") for p in self.__publishes(self.model)],
+                         [None, "Maya Scene"])
+
+    def test_review_data_is_always_loaded(self):
+        self.server.submit(11, [(self.branch_model, "branch", "ABC", self.model)])
+        self.server.submit(12, [(self.model, "edit", "ABC")])
+        sgtk.framework.review_data[(self.branch_model, 1)] = {"code":"branch review"}
+        sgtk.framework.review_data[(self.model, 2)] = {"code":"hero review"}
+
+        self.p4_sync.sync_changes(10, 12, self.p4)
+
+        self.assertEqual(sgtk.framework.calls["load_publish_review_data"], 3)
+        self.assertEqual(sorted(v["code"] for v in self.shotgun.all("Version")), ["branch review", "hero review"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for sharing the projects each change belongs to between daemons
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase, run_daemon_cycles
+from P4 import P4Exception
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.p4_records import P4Change
+from tk_shell_perforcesync.shotgun_sync_daemon import ShotgunSyncDaemon
+
+class TestMembershipIndex(SyncTestCase):
+
+    OTHER_PROJECT = {"type":"Project", "id":66, "name":"other"}
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.other_tk = self.server.add_project("//depot/other", "/pc/other", self.OTHER_PROJECT, self.shotgun)
+        self.server.submit(10, [(self.path("assets/hero/model.ma"), "add")])
+        self.server.submit(11, [("//depot/unmanaged/notes.txt", "add")])
+
+    def __describe(self, change_id):
+        return P4Change.from_describe(self.p4.run_describe(change_id)[0])
+
+    def __fail_files(self):
+        self.server.failures.append(lambda command, args: "Connection reset by peer" if command == "files" else None)
+
+    def test_classification_is_shared(self):
+        ShotgunSync(self.make_app(use_work_queue=False)).is_change_in_context(self.p4, self.__describe(10))
+        other_sync = ShotgunSync(self.make_app(self.OTHER_PROJECT, self.other_tk, use_work_queue=False))
+
+        self.assertTrue(other_sync.is_change_known_to_be_foreign(self.p4, 10))
+        p4_change = self.__describe(10)
+        calls = self.p4.count
+        self.assertFalse(other_sync.is_change_in_context(self.p4, p4_change))
+        self.assertEqual(self.p4.count, calls)
+
+    def test_changes_outside_all_projects_are_recorded(self):
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+        self.assertFalse(p4_sync.is_change_in_context(self.p4, self.__describe(11)))
+        calls = self.p4.count
+
+        self.assertTrue(p4_sync.is_change_known_to_be_foreign(self.p4, 11))
+        self.assertEqual(self.p4.count, calls)
+
+    def test_perforce_errors_are_not_recorded(self):
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+        self.__fail_files()
+
+        self.assertRaises(P4Exception, p4_sync.is_change_in_context, self.p4, self.__describe(10))
+        self.assertFalse(p4_sync.is_change_known_to_be_foreign(self.p4, 10))
+
+        # nothing was cached either so the change is classified once Perforce is back:
+        del self.server.failures[:]
+        self.assertTrue(p4_sync.is_change_in_context(self.p4, self.__describe(10)))
+
+    def test_daemon_classifies_change_again_after_error(self):
+        daemon = ShotgunSyncDaemon(self.make_app(use_work_queue=False))
+        self.__fail_files()
+        run_daemon_cycles(daemon)
+        self.assertEqual(self.revisions(), [])
+
+        del self.server.failures[:]
+        run_daemon_cycles(daemon)
+        self.assertEqual(self.revisions(), ["10"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for backfilling historical changes from a Perforce checkpoint or journal
+"""
+
+import os
+import gzip
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+from sgtk import TankError
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.p4_journal import read_journal, JournalDepot, OfflineP4
+
+def _quote(value):
+    return "@%s@" % str(value).replace("@", "@@")
+
+def _record(operation, table, *fields):
+    return " ".join([_quote(operation), "9", _quote(table)]
+                    + [_quote(f) if isinstance(f, basestring) else str(f) for f in fields]) + " \n"
+
+def _change(change_id, desc, status=1):
+    return _record("pv", "db.change", change_id, change_id, "artist_ws", "artist", 1382901628, status, desc)
+
+def _rev(depot_path, revision, change_id, action=1):
+    return _record("pv", "db.rev", depot_path, revision, "text", action, change_id, 1382901628, 1382901628,
+                   "D41D8CD98F00B204E9800998ECF8427E", 10)
+
+class TestJournal(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.config_path = self.path("tank/config/tank_configs.yml")
+        self.hero = self.path("assets/hero/model.ma")
+
+    def __write(self, name, records):
+        path = os.path.join(self.temp_dir, name)
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(path, "wb") as f:
+            f.write("".join(records))
+        return path
+
+    def __checkpoint(self):
+        return self.__write("checkpoint.1", [_change(1, "config"),
+                                             _rev(self.config_path, 1, 1, action=0),
+                                             _change(10, "model\nwith an @ in it"),
+                                             _rev(self.hero, 1, 10, action=0),
+                                             _change(11, "notes"),
+                                             _rev("//depot/unmanaged/notes.txt", 1, 11, action=0),
+                                             _change(12, "pending", status=0),
+                                             _record("pv", "db.counters", "change", 12)])
+
+    def test_records_are_read(self):
+        records = list(read_journal(self.__write("checkpoint.1.gz", [_change(10, "multi\nline @@ desc"),
+                                                                     _record("dv", "db.counters", "change", 1)])))
+
+        self.assertEqual(records, [("pv", "db.change", ["10", "10", "artist_ws", "artist", "1382901628", "1",
+                                                        "multi\nline @@ desc"]),
+                                   ("dv", "db.counters", ["change", "1"])])
+
+    def test_journals_are_applied_to_checkpoint(self):
+        journal = self.__write("journal.1", [_record("dv", "db.change", 11, 11, "artist_ws", "artist", 0, 1, ""),
+                                             _change(13, "rig"), _record("pv", "db.counters", "change", 13)])
+        depot = JournalDepot(self.make_app(), [self.__checkpoint(), journal])
+        depot.load()
+
+        self.assertEqual(depot.get_change_range(), (1, 13))
+        self.assertEqual(depot.get_counter("change"), "13")
+        self.assertEqual(depot.find_config_roots("tank/config/tank_configs.yml"), [self.DEPOT_ROOT])
+        p4 = OfflineP4(depot, self.DEPOT_ROOT, "/pc/proj", "tank/config/tank_configs.yml")
+        self.assertEqual(p4.run_describe(11), [])
+        self.assertEqual(p4.run_describe(10)[0]["desc"], "model\nwith an @ in it")
+        self.assertEqual(p4.run_fstat("-e", "10"), [{"depotFile":self.hero, "headRev":"1",
+                                                    "headModTime":"1382901628"}])
+
+    def test_loaded_records_are_reused(self):
+        app = self.make_app()
+        checkpoint = self.__checkpoint()
+        JournalDepot(app, [checkpoint]).load()
+
+        JournalDepot(app, [checkpoint]).load()
+
+        self.assertEqual(len([msg for msg in app.logs["info"] if msg.startswith("Using previously loaded")]), 1)
+        self.assertRaises(TankError, JournalDepot(app, [checkpoint + ".missing"]).load)
+
+    def test_changes_are_backfilled_without_perforce(self):
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+
+        p4_sync.backfill_changes_from_journal([self.__checkpoint()])
+
+        self.assertEqual(self.revisions(), ["1", "10"])
+        self.assertEqual([e["name"] for e in self.shotgun.all("PublishedFile")], ["model.ma"])
+        self.assertEqual(self.p4_calls(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
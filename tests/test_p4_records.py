@@ -0,0 +1,62 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for the compact change and file revision records
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+from tk_shell_perforcesync.p4_records import P4Change, P4FileTable, P4FileRevision
+
+class TestP4Records(SyncTestCase):
+
+    def test_change_from_describe(self):
+        self.server.submit(10, [(self.path("assets/hero/model.ma"), "add"), (self.path("assets/hero/rig.ma"), "edit")])
+
+        p4_change = P4Change.from_describe(self.p4.run_describe(10)[0])
+
+        self.assertEqual((p4_change.change, p4_change.user, p4_change.client), (10, "artist", "artist_ws"))
+        self.assertTrue(p4_change.is_submitted)
+        self.assertEqual(list(p4_change.files), [self.path("assets/hero/model.ma"), self.path("assets/hero/rig.ma")])
+        self.assertEqual(list(p4_change.files.revisions), [1, 1])
+        self.assertEqual(p4_change.files.actions, ["add", "edit"])
+
+    def test_file_table_is_compact(self):
+        files = P4FileTable(["//depot/a.ma", "//depot/b.ma"], ["3", None], ["edit", "edit"], ["text", "text"],
+                            ["ABC", "DEF"], ["10", "unknown"])
+
+        self.assertEqual(len(files), 2)
+        self.assertEqual(list(files.revisions), [3, 0])
+        self.assertEqual(list(files.file_sizes), [10, -1])
+        # repeated strings are shared:
+        self.assertTrue(files.actions[0] is files.actions[1])
+        self.assertFalse(hasattr(files, "__dict__"))
+
+    def test_common_directory(self):
+        def common_directory(path):
+            return P4Change(1, "submitted", "artist", "artist_ws", 0, "", path).common_directory
+
+        self.assertEqual(common_directory("//depot/proj/assets/..."), "//depot/proj/assets")
+        self.assertEqual(common_directory("//depot/proj/assets/hero*"), "//depot/proj/assets")
+        self.assertEqual(common_directory("//depot/proj/assets/hero/model.ma"), "//depot/proj/assets/hero")
+        self.assertEqual(common_directory(""), "")
+
+    def test_file_revision_from_fstat(self):
+        file_revision = P4FileRevision.from_fstat({"depotFile":"//depot/a.ma", "headRev":"2", "headModTime":"100"})
+
+        self.assertEqual(file_revision.path_revision, ("//depot/a.ma", 2))
+        self.assertEqual(file_revision.head_mod_time, 100)
+        self.assertEqual(P4FileRevision.from_fstat({"depotFile":"//depot/a.ma"}), None)
+
+if __name__ == "__main__":
+    unittest.main()
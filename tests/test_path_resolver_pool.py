@@ -0,0 +1,65 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for matching depot paths against templates in a pool of worker processes
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+import sgtk
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.path_resolver_pool import PathResolverPool
+
+@unittest.skipUnless(PathResolverPool.is_supported(), "path resolver processes need fork")
+class TestPathResolverPool(SyncTestCase):
+
+    OTHER_PROJECT = {"type":"Project", "id":66, "name":"other"}
+
+    def tearDown(self):
+        PathResolverPool.CHUNK_SIZE = 250
+        SyncTestCase.tearDown(self)
+
+    def test_results_are_in_order(self):
+        self.server.add_project("//depot/other", "/pc/other", self.OTHER_PROJECT, self.shotgun)
+        PathResolverPool.CHUNK_SIZE = 2
+        items = [("/pc/proj", "/pc/proj", "assets/hero/model.ma"),
+                 ("/pc/proj", "/pc/proj", "assets/hero/notes.txt"),
+                 ("/pc/proj", "/pc/proj", "assets/villain/rig.ma"),
+                 ("/pc/other", "/pc/proj", "assets/prop/model.ma"),
+                 ("/pc/proj", "/pc/proj", "model.ma")]
+
+        results = PathResolverPool(self.make_app(), 2).resolve(items)
+
+        self.assertEqual([valid for valid, _ in results], [True, False, True, True, True])
+        # contexts are built by the tk instance for the app's project:
+        expected_contexts = [self.tk.context_from_path("/mnt/projects/proj/%s" % path) for _, _, path in items]
+        self.assertEqual([sgtk.context.deserialize(context) if context else None for _, context in results],
+                         [context if valid else None for context, (valid, _) in zip(expected_contexts, results)])
+
+    def test_sync_uses_pool_for_large_changes(self):
+        self.server.submit(10, [(self.path("assets/asset_%d/model.ma" % i), "add") for i in range(4)]
+                               + [(self.path("assets/hero/notes.txt"), "add")])
+        self.server.submit(11, [(self.path("assets/hero/model.ma"), "add")])
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False, path_resolver_processes=2,
+                                            path_resolver_min_files=2))
+
+        p4_sync.sync_changes(10, 11, self.p4)
+
+        self.assertEqual(self.revisions(), ["10", "11"])
+        publishes = self.shotgun.all("PublishedFile")
+        self.assertEqual(sorted(p["name"] for p in publishes), ["model.ma"] * 5)
+        # the main process only matched templates for the change below the minimum size:
+        self.assertEqual(self.tk.calls.get("template_from_path"), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for the local published file index tailed from the event log
+"""
+
+import time
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+import sgtk
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.cache import LruCache
+from tk_shell_perforcesync.schema_cache import SchemaCache
+from tk_shell_perforcesync.publish_index import PublishIndex
+from tk_shell_perforcesync.publish_resolver import PublishResolver
+
+class TestPublishIndex(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.app = self.make_app(use_work_queue=False)
+        self.hero = self.path("assets/hero/model.ma")
+
+    def __publish(self, depot_path, revision):
+        sg_entity = self.shotgun.create("PublishedFile", {"name":depot_path.rsplit("/", 1)[-1],
+                                                          "version_number":revision, "project":self.PROJECT,
+                                                          "path":{"url":sgtk.framework.util.url_from_depot_path(
+                                                              depot_path, revision)}})
+        self.__event("New", sg_entity)
+        return sg_entity
+
+    def __retire(self, sg_entity):
+        self.shotgun.delete("PublishedFile", sg_entity["id"])
+        self.__event("Retirement", None, sg_entity["id"])
+
+    def __event(self, event, sg_entity, entity_id=None):
+        entity = {"type":"PublishedFile", "id":sg_entity["id"]} if sg_entity else None
+        self.shotgun.create("EventLogEntry", {"event_type":"Shotgun_PublishedFile_%s" % event,
+                                              "entity":entity, "project":self.PROJECT,
+                                              "meta":{"entity_id":entity_id or sg_entity["id"]}})
+
+    def test_index_is_bootstrapped(self):
+        sg_entity = self.__publish(self.hero, 1)
+        index = PublishIndex(self.app)
+
+        self.assertTrue(index.update())
+
+        self.assertEqual(index.lookup([(self.hero, 1), (self.hero, 2)]),
+                         {(self.hero, 1):{"type":"PublishedFile", "id":sg_entity["id"]}})
+
+    def test_events_are_applied(self):
+        first = self.__publish(self.hero, 1)
+        index = PublishIndex(self.app)
+        index.update()
+
+        second = self.__publish(self.hero, 2)
+        self.__retire(first)
+        self.assertTrue(index.update())
+
+        self.assertEqual(index.lookup([(self.hero, 1), (self.hero, 2)]),
+                         {(self.hero, 2):{"type":"PublishedFile", "id":second["id"]}})
+
+    def test_tailing_resumes_after_restart(self):
+        self.__publish(self.hero, 1)
+        PublishIndex(self.app).update()
+        self.__publish(self.hero, 2)
+        finds = self.shotgun.finds("PublishedFile")
+
+        index = PublishIndex(self.app)
+        index.update()
+
+        self.assertEqual(len(index.lookup([(self.hero, 1), (self.hero, 2)])), 2)
+        # just the new publish is read:
+        self.assertEqual(self.shotgun.finds("PublishedFile") - finds, 1)
+
+    def test_quick_resolves_read_events_once(self):
+        self.__publish(self.hero, 1)
+        resolver = PublishResolver(self.app, LruCache("published files", 100), SchemaCache(self.app, 60),
+                                   PublishIndex(self.app, 60))
+        self.assertEqual(len(resolver.resolve([(self.hero, 1)])), 1)
+        events = self.shotgun.finds("EventLogEntry")
+
+        resolver.resolve([(self.hero, 2)])
+        resolver.resolve([(self.hero, 3)])
+
+        self.assertLessEqual(self.shotgun.finds("EventLogEntry") - events, 1)
+
+    def test_events_are_read_after_update_interval(self):
+        index = PublishIndex(self.app, 0.05)
+        index.update()
+        sg_entity = self.__publish(self.hero, 1)
+
+        self.assertTrue(index.update())
+        self.assertEqual(index.lookup([(self.hero, 1)]), {})
+
+        time.sleep(0.1)
+        self.assertTrue(index.update())
+        self.assertEqual(index.lookup([(self.hero, 1)]), {(self.hero, 1):{"type":"PublishedFile", "id":sg_entity["id"]}})
+
+    def test_sync_resolves_publishes_from_index(self):
+        self.server.submit(10, [(self.hero, "add")])
+        self.server.submit(11, [(self.path("assets/hero/scene.ma"), "add")])
+        sgtk.framework.publish_data[(self.path("assets/hero/scene.ma"), 1)] = {"dependency_paths":[self.hero]}
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False, use_publish_index=True))
+
+        p4_sync.sync_changes(10, 11, self.p4)
+
+        self.assertEqual(len(self.shotgun.all("PublishedFileDependency")), 1)
+        # only the bootstrap reads published files:
+        self.assertEqual(self.shotgun.finds("PublishedFile"), 1)
+
+if __name__ == "__main__":
+    unittest.main()
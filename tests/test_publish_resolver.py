@@ -0,0 +1,186 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for resolving existing publishes and dependencies in bulk
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+import sgtk
+from sgtk import TankError
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.cache import LruCache
+from tk_shell_perforcesync.schema_cache import SchemaCache
+from tk_shell_perforcesync.publish_resolver import PublishResolver, normalize_depot_path
+
+class TestPublishResolver(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.app = self.make_app(use_work_queue=False)
+        self.resolver = PublishResolver(self.app, LruCache("published files", 100), SchemaCache(self.app, 60))
+
+    def __publish(self, depot_path, revision, depot_path_field=True):
+        data = {"name":depot_path.rsplit("/", 1)[-1], "version_number":revision, "project":self.PROJECT,
+                "path":{"url":sgtk.framework.util.url_from_depot_path(depot_path, revision)}}
+        if depot_path_field:
+            data["sg_depot_path"] = depot_path
+        return self.shotgun.create("PublishedFile", data)
+
+    def test_publishes_are_resolved_in_a_single_query(self):
+        a = self.__publish(self.path("assets/hero/a.ma"), 1)
+        b = self.__publish(self.path("assets/hero/b.ma"), 2)
+        finds = self.shotgun.finds("PublishedFile")
+
+        resolved = self.resolver.resolve([(self.path("assets/hero/a.ma"), 1), (self.path("assets/hero/b.ma"), 2)])
+
+        self.assertEqual(sorted(e["id"] for e in resolved.values()), [a["id"], b["id"]])
+        self.assertEqual(self.shotgun.finds("PublishedFile") - finds, 1)
+
+    def test_unpublished_revisions_are_not_resolved(self):
+        self.__publish(self.path("assets/hero/a.ma"), 1)
+        finds = self.shotgun.finds("PublishedFile")
+
+        self.assertEqual(self.resolver.resolve([(self.path("assets/hero/a.ma"), 2)]), {})
+        # Shotgun is checked once for publishes that haven't been backfilled with the depot
+        # path, there aren't any so they are never looked for by name:
+        self.assertEqual(self.shotgun.finds("PublishedFile") - finds, 2)
+        self.assertEqual(self.resolver.resolve([(self.path("assets/hero/a.ma"), 3)]), {})
+        self.assertEqual(self.shotgun.finds("PublishedFile") - finds, 3)
+
+    def test_resolved_publishes_are_cached(self):
+        self.__publish(self.path("assets/hero/a.ma"), 1)
+        key = (self.path("assets/hero/a.ma"), 1)
+        self.resolver.resolve([key])
+        finds = self.shotgun.finds("PublishedFile")
+
+        self.assertTrue(key in self.resolver.resolve([key]))
+        self.assertEqual(self.shotgun.finds("PublishedFile"), finds)
+
+    def test_queries_are_chunked(self):
+        keys = [(self.path("assets/hero/f%d.ma" % i), 1) for i in range(PublishResolver.QUERY_CHUNK_SIZE + 1)]
+        for depot_path, revision in keys:
+            self.__publish(depot_path, revision)
+        finds = self.shotgun.finds("PublishedFile")
+
+        self.assertEqual(len(self.resolver.resolve(keys)), len(keys))
+        self.assertEqual(self.shotgun.finds("PublishedFile") - finds, 2)
+
+class TestDepotPathField(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.app = self.make_app(use_work_queue=False)
+
+    def __resolver(self):
+        return PublishResolver(self.app, LruCache("published files", 100), SchemaCache(self.app, 60))
+
+    def __publish(self, depot_path, revision):
+        return self.shotgun.create("PublishedFile", {"name":depot_path.rsplit("/", 1)[-1], "version_number":revision,
+                                                     "project":self.PROJECT,
+                                                     "path":{"url":sgtk.framework.util.url_from_depot_path(depot_path, 
+                                                                                                          revision)}})
+
+    def test_depot_paths_are_normalized(self):
+        self.assertEqual(normalize_depot_path(" //depot/a.ma#3 "), "//depot/a.ma")
+        self.assertEqual(normalize_depot_path("//depot/a.ma@10"), "//depot/a.ma")
+        self.assertEqual(normalize_depot_path(None), "")
+
+    def test_publishes_are_registered_with_depot_path(self):
+        self.server.submit(10, [(self.path("assets/hero/model.ma"), "add")])
+
+        ShotgunSync(self.app).sync_changes(10, 10, self.p4)
+
+        self.assertEqual([e.get("sg_depot_path") for e in self.shotgun.all("PublishedFile")],
+                         [self.path("assets/hero/model.ma")])
+
+    def test_publishes_are_found_by_name_without_field(self):
+        del self.shotgun.schema["PublishedFile"]["sg_depot_path"]
+        publish = self.__publish(self.path("assets/hero/a.ma"), 1)
+        resolver = self.__resolver()
+        finds = self.shotgun.finds("PublishedFile")
+
+        resolved = resolver.resolve([(self.path("assets/hero/a.ma"), 1), (self.path("assets/hero/a.ma"), 2)])
+
+        self.assertEqual(resolved.values(), [{"type":"PublishedFile", "id":publish["id"]}])
+        self.assertEqual(self.shotgun.finds("PublishedFile") - finds, 1)
+        self.assertRaises(TankError, resolver.backfill_depot_paths)
+
+    def test_depot_paths_are_backfilled(self):
+        for revision in [1, 2]:
+            self.__publish(self.path("assets/hero/a.ma"), revision)
+        resolver = self.__resolver()
+
+        self.assertEqual(resolver.backfill_depot_paths(), 2)
+
+        self.assertEqual([e["sg_depot_path"] for e in self.shotgun.all("PublishedFile")],
+                         [self.path("assets/hero/a.ma")] * 2)
+        self.assertEqual(resolver.backfill_depot_paths(), 0)
+        # backfilled publishes are found by depot path alone:
+        finds = self.shotgun.finds("PublishedFile")
+        self.assertEqual(len(resolver.resolve([(self.path("assets/hero/a.ma"), 2)])), 1)
+        self.assertEqual(self.shotgun.finds("PublishedFile") - finds, 1)
+
+    def test_publishes_are_found_by_name_until_backfilled(self):
+        publish = self.__publish(self.path("assets/hero/a.ma"), 1)
+        resolver = self.__resolver()
+        self.assertEqual(resolver.resolve([(self.path("assets/hero/a.ma"), 1)]).values(),
+                         [{"type":"PublishedFile", "id":publish["id"]}])
+        resolver.backfill_depot_paths()
+
+        # the backfill is recorded so new resolvers don't look for publishes by name either:
+        for resolver in [resolver, self.__resolver()]:
+            finds = self.shotgun.finds("PublishedFile")
+            self.assertEqual(resolver.resolve([(self.path("assets/hero/a.ma"), 2)]), {})
+            self.assertEqual(self.shotgun.finds("PublishedFile") - finds, 1)
+
+class TestDependencies(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.libs = [self.path("assets/lib/lib_%s.ma" % n) for n in "ab"]
+        self.server.submit(10, [(lib, "add") for lib in self.libs])
+        self.scenes = [self.path("assets/hero/scene_%d.ma" % i) for i in range(2)]
+        self.server.submit(11, [(scene, "add") for scene in self.scenes])
+        for scene in self.scenes:
+            sgtk.framework.publish_data[(scene, 1)] = {"dependency_paths":self.libs}
+
+    def __dependencies(self):
+        return sorted((e["published_file"]["id"], e["dependent_published_file"]["id"])
+                      for e in self.shotgun.all("PublishedFileDependency"))
+
+    def test_dependencies_are_resolved_in_bulk(self):
+        ShotgunSync(self.make_app(use_work_queue=False)).sync_changes(10, 11, self.p4)
+
+        publishes = dict((e["name"], e["id"]) for e in self.shotgun.all("PublishedFile"))
+        expected = sorted((publishes["scene_%d.ma" % i], publishes["lib_%s.ma" % n]) for i in range(2) for n in "ab")
+        self.assertEqual(self.__dependencies(), expected)
+        # the dependency revisions are found with a single fstat (on top of the one per change for
+        # the change's own files) and created in a single batch:
+        self.assertEqual(self.p4.calls.get("fstat"), 3)
+        self.assertEqual(self.shotgun.calls.get("batch"), 1)
+
+    def test_publishes_registered_by_previous_changes_are_reused(self):
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+        p4_sync.sync_changes(10, 10, self.p4)
+        finds = self.shotgun.finds("PublishedFile")
+
+        p4_sync.sync_changes(11, 11, self.p4)
+
+        self.assertEqual(len(self.__dependencies()), 4)
+        # only the scenes themselves are looked for (by depot path alone as all publishes have
+        # the depot path set) - the libraries are already cached:
+        self.assertEqual(self.shotgun.finds("PublishedFile") - finds, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for syncing a range of changes, skipping changes that have already been synced
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+from tk_shell_perforcesync import ShotgunSync
+
+class TestRangeSync(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        for change_id in range(10, 15):
+            self.server.submit(change_id, [(self.path("assets/hero/model.ma"), "edit")])
+
+    def test_synced_changes_are_skipped(self):
+        for change_id in [10, 12]:
+            self.shotgun.create("Revision", {"code":str(change_id), "project":self.PROJECT})
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+        finds = self.shotgun.finds("Revision")
+
+        p4_sync.sync_changes(10, 14, self.p4)
+
+        self.assertEqual(sorted(self.revisions()), ["10", "11", "12", "13", "14"])
+        # synced changes aren't described:
+        self.assertEqual(self.p4_calls("describe"), 3)
+        # one query for the whole range and then the existence and duplicate checks per change:
+        self.assertEqual(self.shotgun.finds("Revision") - finds, 1 + 3 * 2)
+
+    def test_existing_revisions_are_found_in_chunks(self):
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+        finds = self.shotgun.finds("Revision")
+
+        p4_sync.sync_changes(100, 100 + ShotgunSync.REVISION_PREFETCH_CHUNK_SIZE, self.p4)
+
+        self.assertEqual(self.shotgun.finds("Revision") - finds, 2)
+
+    def test_other_projects_are_ignored(self):
+        self.shotgun.create("Revision", {"code":"10", "project":{"type":"Project", "id":66}})
+
+        ShotgunSync(self.make_app(use_work_queue=False)).sync_changes(10, 10, self.p4)
+
+        self.assertEqual(self.revisions(), ["10", "10"])
+
+if __name__ == "__main__":
+    unittest.main()
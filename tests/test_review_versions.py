@@ -0,0 +1,76 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for the creation of review Versions from the review data stored for published files
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+import sgtk
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.shotgun_sync import _canonical_hash
+
+class TestCanonicalHash(unittest.TestCase):
+
+    def test_dictionary_order_is_ignored(self):
+        a = {"code":"shot_010", "sg_status":"rev", "entity":{"type":"Shot", "id":1}}
+        b = dict(reversed(a.items()))
+        self.assertEqual(_canonical_hash(a), _canonical_hash(b))
+
+    def test_str_and_unicode_are_equal(self):
+        self.assertEqual(_canonical_hash({"code":"shot_010"}), _canonical_hash({u"code":u"shot_010"}))
+
+    def test_different_data_is_different(self):
+        self.assertNotEqual(_canonical_hash({"code":"shot_010"}), _canonical_hash({"code":"shot_020"}))
+        self.assertNotEqual(_canonical_hash({"ids":[1, 2]}), _canonical_hash({"ids":(1, 2)}))
+        self.assertNotEqual(_canonical_hash({"id":1}), _canonical_hash({"id":"1"}))
+
+class TestReviewVersions(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.app = self.make_app(use_work_queue=False)
+        self.files = [self.path("assets/hero/model_%d.ma" % i) for i in range(3)]
+        self.server.submit(10, [(f, "add") for f in self.files])
+
+    def test_versions_are_consolidated_and_batched(self):
+        shared_review = {"code":"hero review", "sg_uploaded_movie":"/tmp/hero.mov"}
+        sgtk.framework.review_data[(self.files[0], 1)] = shared_review
+        sgtk.framework.review_data[(self.files[1], 1)] = dict(reversed(shared_review.items()))
+        sgtk.framework.review_data[(self.files[2], 1)] = {"code":"other review"}
+
+        ShotgunSync(self.app).sync_changes(10, 10, self.p4)
+
+        versions = self.shotgun.all("Version")
+        self.assertEqual(sorted(v["code"] for v in versions), ["hero review", "other review"])
+        hero = [v for v in versions if v["code"] == "hero review"][0]
+        self.assertEqual(len(hero["published_files"]), 2)
+        self.assertFalse("sg_uploaded_movie" in hero)
+        self.assertEqual(hero["description"], "change 10")
+        # all Versions for the change are created in a single batch and the movie uploaded once:
+        self.assertEqual(self.shotgun.calls.get("batch"), 1)
+        self.assertEqual(self.shotgun.calls.get("upload"), 1)
+
+    def test_versions_are_created_in_chunks(self):
+        files = [self.path("assets/hero/anim_%d.ma" % i) for i in range(ShotgunSync.VERSION_BATCH_SIZE + 5)]
+        self.server.submit(11, [(f, "add") for f in files])
+        for i, depot_path in enumerate(files):
+            sgtk.framework.review_data[(depot_path, 1)] = {"code":"review %d" % i}
+
+        ShotgunSync(self.app).sync_changes(11, 11, self.p4)
+
+        self.assertEqual(len(self.shotgun.all("Version")), len(files))
+        self.assertEqual(self.shotgun.calls.get("batch"), 2)
+
+if __name__ == "__main__":
+    unittest.main()
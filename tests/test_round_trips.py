@@ -0,0 +1,189 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for the number of Perforce commands and Shotgun requests used to sync changes.  Each
+budget is an upper bound made up of a fixed cost plus a cost per change and per file so a
+round trip that is added for every change or file fails a test.
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase, run_daemon_cycles
+import sgtk
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.shotgun_sync_daemon import ShotgunSyncDaemon
+
+class RoundTripTestCase(SyncTestCase):
+
+    def count(self, function, *args):
+        """
+        Call a function and return the number of Perforce commands and Shotgun requests
+        it made.
+        """
+        p4_count = self.p4_calls()
+        shotgun_count = self.shotgun.count
+        function(*args)
+        return self.p4_calls() - p4_count, self.shotgun.count - shotgun_count
+
+    def assertWithinBudget(self, counts, p4_budget, shotgun_budget):
+        """
+        Check that the (Perforce commands, Shotgun requests) counts are within budget.
+        """
+        p4_count, shotgun_count = counts
+        self.assertLessEqual(p4_count, p4_budget, "%d Perforce commands, budget is %d" % (p4_count, p4_budget))
+        self.assertLessEqual(shotgun_count, shotgun_budget,
+                             "%d Shotgun requests, budget is %d" % (shotgun_count, shotgun_budget))
+
+    def submit_assets(self, first_change, num_changes, files_per_change=1):
+        for change_id in range(first_change, first_change + num_changes):
+            self.server.submit(change_id, [(self.path("assets/asset_%d/file_%d.ma" % (change_id, i)), "add")
+                                           for i in range(files_per_change)])
+
+class TestSyncRoundTrips(RoundTripTestCase):
+
+    # finding the changes and the project roots:
+    P4_BASE = 4
+    # a describe, a files listing and an fstat for each change, whatever the number of files:
+    P4_PER_CHANGE = 3
+    # finding the changes in the range that have already been synced and checking once for
+    # publishes without a depot path:
+    SHOTGUN_BASE = 2
+    # finding, creating, verifying and linking the Revision and finding the existing publishes:
+    SHOTGUN_PER_CHANGE = 5
+    # registering the publish:
+    SHOTGUN_PER_FILE = 1
+
+    def setUp(self):
+        RoundTripTestCase.setUp(self)
+        self.p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+
+    def __sync(self, start_change, end_change):
+        return self.count(self.p4_sync.sync_changes, start_change, end_change, self.p4)
+
+    def __p4_budget(self, changes):
+        return self.P4_BASE + self.P4_PER_CHANGE*changes
+
+    def __shotgun_budget(self, changes, files):
+        return self.SHOTGUN_BASE + self.SHOTGUN_PER_CHANGE*changes + self.SHOTGUN_PER_FILE*files
+
+    def test_single_change(self):
+        self.submit_assets(10, 1)
+
+        self.assertWithinBudget(self.__sync(10, 10), self.__p4_budget(1), self.__shotgun_budget(1, 1))
+
+    def test_change_with_many_files(self):
+        self.submit_assets(10, 1, files_per_change=20)
+
+        self.assertWithinBudget(self.__sync(10, 10), self.__p4_budget(1), self.__shotgun_budget(1, 20))
+
+    def test_many_changes(self):
+        self.submit_assets(10, 5, files_per_change=4)
+
+        self.assertWithinBudget(self.__sync(10, 14), self.__p4_budget(5), self.__shotgun_budget(5, 5*4))
+
+    def test_new_revision_of_synced_file(self):
+        self.server.submit(10, [(self.path("assets/hero/model.ma"), "add")])
+        self.server.submit(11, [(self.path("assets/hero/model.ma"), "edit")])
+        self.p4_sync.sync_changes(10, 10, self.p4)
+
+        # the project roots are cached and the file is already known to be in the project
+        # so only the change and its file revisions are read from Perforce:
+        self.assertWithinBudget(self.__sync(11, 11), 2, self.__shotgun_budget(1, 1))
+
+    def test_existing_publishes(self):
+        self.submit_assets(10, 1, files_per_change=3)
+        for i in range(3):
+            depot_path = self.path("assets/asset_10/file_%d.ma" % i)
+            url = sgtk.framework.util.url_from_depot_path(depot_path, 1)
+            self.shotgun.create("PublishedFile", {"name":"file_%d.ma" % i, "version_number":1, "path":{"url":url},
+                                                  "project":self.PROJECT, "sg_depot_path":depot_path})
+
+        # the existing publishes are found by the query made for every change and none of
+        # them are registered again:
+        self.assertWithinBudget(self.__sync(10, 10), self.__p4_budget(1), self.__shotgun_budget(1, 0))
+        self.assertEqual(len(self.shotgun.all("PublishedFile")), 3)
+
+    def test_dependencies(self):
+        model = self.path("assets/hero/model.ma")
+        self.server.submit(10, [(model, "add")])
+        self.p4_sync.sync_changes(10, 10, self.p4)
+        rigs = [self.path("assets/hero/rig_%d.ma" % i) for i in range(3)]
+        self.server.submit(11, [(rig, "add") for rig in rigs])
+        for rig in rigs:
+            sgtk.framework.publish_data[(rig, 1)] = {"dependency_paths":[model]}
+
+        # on top of a change to files already known to be in the project, the dependency
+        # revisions are found with one Perforce command and all of the dependencies are created
+        # in a single batch - the dependency publish was registered by this sync so it's
+        # resolved from the cache:
+        self.assertWithinBudget(self.__sync(11, 11), 2 + 1, self.__shotgun_budget(1, 3) + 1)
+        self.assertEqual(len(self.shotgun.all("PublishedFileDependency")), 3)
+
+    def test_review_data(self):
+        models = [self.path("assets/asset_%d/model.ma" % i) for i in range(3)]
+        self.server.submit(10, [(model, "add") for model in models])
+        for i, model in enumerate(models):
+            sgtk.framework.review_data[(model, 1)] = {"code":"review %d" % i}
+
+        # the Versions for all of the files are created in a single batch:
+        self.assertWithinBudget(self.__sync(10, 10), self.__p4_budget(1), self.__shotgun_budget(1, 3) + 1)
+        self.assertEqual(len(self.shotgun.all("Version")), 3)
+
+    def test_change_outside_project(self):
+        self.server.submit(10, [("//depot/unmanaged/notes.txt", "add")])
+
+        # the change is classified from its file paths so nothing is written to Shotgun:
+        self.assertWithinBudget(self.__sync(10, 10), 3, self.SHOTGUN_BASE)
+
+class TestDaemonRoundTrips(RoundTripTestCase):
+
+    # reading the counters and finding the changes and the project roots:
+    P4_BASE = 12
+    # a claim, a files listing, an fstat and a share of the block describes and the
+    # counter writes:
+    P4_PER_CHANGE = 4
+    # registering the publish:
+    SHOTGUN_PER_FILE = 1
+
+    def __run(self, cycles, **settings):
+        daemon = ShotgunSyncDaemon(self.make_app(use_work_queue=False, **settings))
+        return self.count(run_daemon_cycles, daemon, cycles)
+
+    def __p4_budget(self, changes):
+        return self.P4_BASE + self.P4_PER_CHANGE*changes
+
+    def test_idle_cycles(self):
+        # the first cycle also reads the project counter, each cycle after that without new
+        # changes only checks for new changes and nothing is read from Shotgun:
+        self.assertWithinBudget(self.__run(3), 3 + 2, 0)
+        self.assertLessEqual(self.p4_calls("changes"), 2 + 2)
+
+    def test_cycle_with_changes(self):
+        self.submit_assets(10, 5, files_per_change=4)
+
+        # claimed Revisions are created with a single request, so each change costs creating
+        # and linking its Revision and finding its existing publishes, on top of checking once
+        # for publishes without a depot path:
+        self.assertWithinBudget(self.__run(1), self.__p4_budget(5), 1 + 3*5 + self.SHOTGUN_PER_FILE*5*4)
+        self.assertFalse(self.shotgun.calls.get("batch"))
+
+    def test_cycle_with_buffered_changes(self):
+        self.submit_assets(10, 5, files_per_change=4)
+
+        # all of the Revisions are created in one batch, so each change only costs finding
+        # its existing publishes, on top of checking once for publishes without a depot path:
+        self.assertWithinBudget(self.__run(1, write_buffer_size=100), self.__p4_budget(5),
+                                2 + 1*5 + self.SHOTGUN_PER_FILE*5*4)
+        self.assertEqual(self.shotgun.calls["batch"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
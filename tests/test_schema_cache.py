@@ -0,0 +1,102 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for caching the Shotgun schema and refreshing it when it's found to be out of date
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.change_spool import ChangeSpool
+from tk_shell_perforcesync.p4_records import P4Change
+from tk_shell_perforcesync.schema_cache import SchemaCache
+
+class TestSchemaCache(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        for change_id in [10, 11]:
+            self.server.submit(change_id, [(self.path("assets/hero/model_%d.ma" % change_id), "add")])
+
+    def __rename_published_files_field(self):
+        """
+        Rename the published files field on the site after the schema has been cached.
+        """
+        revision_schema = self.shotgun.schema["Revision"]
+        revision_schema["sg_published_files"] = revision_schema.pop("published_files")
+
+    def __linked_files(self, field):
+        return [len(e.get(field) or []) for e in self.shotgun.all("Revision")]
+
+    def test_schema_is_not_read_when_syncing(self):
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+        num_reads = self.shotgun.calls.get("schema_field_read", 0)
+
+        p4_sync.sync_changes(10, 11, self.p4)
+
+        self.assertEqual(self.revisions(), ["10", "11"])
+        self.assertEqual(self.shotgun.calls.get("schema_field_read", 0), num_reads)
+
+    def test_schema_is_persisted_to_disk(self):
+        ShotgunSync(self.make_app(use_work_queue=False))
+        num_reads = self.shotgun.calls["schema_field_read"]
+        SchemaCache._SchemaCache__schemas.clear()
+
+        ShotgunSync(self.make_app(use_work_queue=False))
+
+        self.assertEqual(self.shotgun.calls["schema_field_read"], num_reads)
+
+    def test_expired_schema_is_read_again(self):
+        ShotgunSync(self.make_app(use_work_queue=False))
+        num_reads = self.shotgun.calls["schema_field_read"]
+        SchemaCache._SchemaCache__schemas.clear()
+
+        ShotgunSync(self.make_app(use_work_queue=False, schema_cache_ttl=-1))
+
+        self.assertTrue(self.shotgun.calls["schema_field_read"] > num_reads)
+
+    def test_schema_is_refreshed_on_update_error(self):
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False))
+        self.__rename_published_files_field()
+
+        p4_sync.sync_changes(10, 11, self.p4)
+
+        self.assertEqual(self.__linked_files("sg_published_files"), [1, 1])
+        self.assertFalse(self.shotgun.all("Revision")[0].get("published_files"))
+
+    def test_schema_is_refreshed_on_buffered_write_error(self):
+        p4_sync = ShotgunSync(self.make_app(use_work_queue=False, write_buffer_size=100))
+        self.__rename_published_files_field()
+        for change_id in [10, 11]:
+            p4_sync.queue_change(self.p4, self.__describe(change_id))
+
+        self.assertEqual(p4_sync.flush_writes(), [10, 11])
+        self.assertEqual(self.__linked_files("sg_published_files"), [1, 1])
+
+    def test_schema_is_refreshed_on_spool_apply_error(self):
+        app = self.make_app(use_work_queue=False)
+        spool = ChangeSpool(app)
+        p4_sync = ShotgunSync(app)
+        p4_sync.spool_changes(spool, 10, 11, self.p4)
+        self.__rename_published_files_field()
+
+        p4_sync.apply_spool(spool, 10)
+
+        self.assertEqual(self.revisions(), ["10", "11"])
+        self.assertEqual(self.__linked_files("sg_published_files"), [1, 1])
+
+    def __describe(self, change_id):
+        return P4Change.from_describe(self.p4.run_describe(change_id)[0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for rate limiting the Shotgun requests made by the sync
+"""
+
+import time
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.shotgun_scheduler import ShotgunScheduler, get_shotgun_scheduler
+
+class _SlowShotgun(object):
+    """
+    Shotgun connection whose requests take a fixed time or fail
+    """
+
+    def __init__(self):
+        self.latency = 0
+        self.error = None
+        self.base_url = "https://test.shotgunstudio.com"
+
+    def find(self, *args, **kwargs):
+        time.sleep(self.latency)
+        if self.error:
+            raise Exception(self.error)
+        return []
+
+class TestShotgunScheduler(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.slow_shotgun = _SlowShotgun()
+        self.scheduler = ShotgunScheduler(self.make_app(), self.slow_shotgun, 100, 10, 0.05)
+
+    def test_rate_is_halved_when_overloaded(self):
+        self.slow_shotgun.error = "503 Service Temporarily Unavailable"
+        self.assertRaises(Exception, self.scheduler.find, "Revision", [])
+        self.assertEqual(self.scheduler.rate, 50)
+
+        for _ in range(5):
+            self.assertRaises(Exception, self.scheduler.find, "Revision", [])
+        self.assertEqual(self.scheduler.rate, 10)
+        self.assertEqual(self.scheduler.error_count, 6)
+
+    def test_rate_is_reduced_when_slow(self):
+        self.slow_shotgun.latency = 0.1
+        self.scheduler.find("Revision", [])
+        self.assertEqual(self.scheduler.rate, 80)
+
+    def test_rate_recovers_when_fast(self):
+        self.slow_shotgun.error = "429 Too Many Requests"
+        self.assertRaises(Exception, self.scheduler.find, "Revision", [])
+
+        self.slow_shotgun.error = None
+        self.scheduler.find("Revision", [])
+        self.assertEqual(self.scheduler.rate, 55)
+
+    def test_other_errors_dont_change_rate(self):
+        self.slow_shotgun.error = "Invalid field"
+        self.assertRaises(Exception, self.scheduler.find, "Revision", [])
+        self.assertEqual((self.scheduler.rate, self.scheduler.error_count), (100, 1))
+
+    def test_unlimited_rate(self):
+        scheduler = ShotgunScheduler(self.make_app(), self.slow_shotgun, 0, 1, 0.05)
+        self.slow_shotgun.latency = 0.1
+        scheduler.find("Revision", [])
+
+        self.assertEqual((scheduler.rate, scheduler.request_count), (0, 1))
+        # attributes that don't make requests are passed straight through:
+        self.assertEqual(scheduler.base_url, self.slow_shotgun.base_url)
+
+    def test_sync_requests_are_scheduled(self):
+        app = self.make_app(use_work_queue=False)
+        self.server.submit(10, [(self.path("assets/hero/model.ma"), "add")])
+
+        ShotgunSync(app).sync_changes(10, 10, self.p4)
+
+        self.assertEqual(self.revisions(), ["10"])
+        # including registering the publish, which uses Toolkit's connection:
+        self.assertEqual(len(self.shotgun.all("PublishedFile")), 1)
+        self.assertEqual(get_shotgun_scheduler(app).request_count, self.shotgun.count)
+
+    def test_calls_are_rate_limited(self):
+        scheduler = ShotgunScheduler(self.make_app(), self.slow_shotgun, 100, 10, 0.05)
+
+        self.assertEqual(scheduler.call(lambda x: time.sleep(0.1) or x, 5), 5)
+        self.assertEqual((scheduler.rate, scheduler.request_count), (80, 1))
+
+    def test_publish_registrations_are_rate_limited(self):
+        app = self.make_app(use_work_queue=False, shotgun_max_request_rate=50)
+        self.server.submit(10, [(self.path("assets/asset_%d/model.ma" % i), "add") for i in range(10)])
+        requests = len(self.shotgun.requests)
+
+        start_time = time.time()
+        ShotgunSync(app).sync_changes(10, 10, self.p4)
+        elapsed = time.time() - start_time
+
+        self.assertEqual(len(self.shotgun.all("PublishedFile")), 10)
+        # the bucket starts with a single token so all but the first request, including the
+        # registrations, wait for one:
+        self.assertEqual(get_shotgun_scheduler(app).request_count, len(self.shotgun.requests) - requests)
+        self.assertGreaterEqual(elapsed, (len(self.shotgun.requests) - requests - 1) / 50.0 - 0.05)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for the resident sync worker and its client
+"""
+
+import os
+import sys
+import json
+import unittest
+from StringIO import StringIO
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+from tk_shell_perforcesync.sync_worker import SyncWorker, get_worker_socket_path
+from tk_shell_perforcesync import sync_worker_client
+from tk_shell_perforcesync.sync_worker_client import SyncWorkerClient
+
+class TestSyncWorker(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.app = self.make_app(use_work_queue=False)
+        for change_id in [10, 11]:
+            self.server.submit(change_id, [(self.path("assets/hero/model.ma"), "edit")])
+
+    def __request(self, worker, request):
+        return worker._handle_request(json.dumps(request))
+
+    def test_changes_are_synced(self):
+        worker = SyncWorker(self.app)
+
+        self.assertEqual(self.__request(worker, {"command":"sync_changes", "start":10, "end":11}), {"status":"ok"})
+        self.assertEqual(self.revisions(), ["10", "11"])
+
+    def test_connection_and_caches_are_reused(self):
+        worker = SyncWorker(self.app)
+        connections = len(self.connections)
+        self.__request(worker, {"command":"sync_changes", "start":10})
+        schema_reads = self.shotgun.calls["schema_field_read"]
+
+        self.__request(worker, {"command":"sync_changes", "start":11})
+
+        self.assertEqual(self.revisions(), ["10", "11"])
+        self.assertEqual(len(self.connections), connections + 1)
+        self.assertEqual(self.shotgun.calls["schema_field_read"], schema_reads)
+        # the project configuration is only read for the first request:
+        self.assertEqual(self.p4_calls("print"), 1)
+
+    def test_invalid_requests_are_rejected(self):
+        worker = SyncWorker(self.app)
+
+        self.assertEqual(worker._handle_request("{")["status"], "error")
+        self.assertEqual(self.__request(worker, {"command":"delete_everything"})["status"], "error")
+        self.assertEqual(self.__request(worker, {"command":"sync_changes", "start":"ten"})["status"], "error")
+        self.assertEqual(self.revisions(), [])
+
+class TestSyncWorkerClient(SyncTestCase):
+
+    def test_no_worker_running(self):
+        socket_path = get_worker_socket_path(self.make_app())
+        self.assertFalse(SyncWorkerClient(socket_path).is_available())
+
+        # a socket file left behind by a worker that has stopped:
+        open(socket_path, "w").close()
+        self.assertFalse(SyncWorkerClient(socket_path).is_available())
+
+    def test_client_exits_with_fallback_code(self):
+        socket_path = os.path.join(self.temp_dir, "missing.sock")
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.assertEqual(sync_worker_client.main(["--socket", socket_path, "-s", "10"]), 2)
+        finally:
+            sys.stderr = stderr
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for recording failed work and retrying it out-of-band
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase
+from tk_shell_perforcesync import ShotgunSync
+from tk_shell_perforcesync.work_queue import WorkQueue
+from tk_shell_perforcesync.retry_worker import RetryWorker
+
+class TestWorkQueue(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.queue = WorkQueue(self.make_app(), 3, 0, 0)
+
+    def test_items_are_only_queued_once(self):
+        self.queue.add(WorkQueue.KIND_CHANGE, 10, WorkQueue.STAGE_CONTENTS, "first")
+        self.queue.add(WorkQueue.KIND_CHANGE, 10, WorkQueue.STAGE_CONTENTS, "second")
+        self.queue.add(WorkQueue.KIND_FILE, 10, WorkQueue.STAGE_PUBLISH, "error", "//depot/a.ma", 1)
+
+        items = self.queue.due()
+        self.assertEqual([(i["kind"], i["last_error"]) for i in items], [("change", "first"), ("file", "error")])
+
+    def test_items_are_dead_after_max_attempts(self):
+        self.queue.add(WorkQueue.KIND_CHANGE, 10, WorkQueue.STAGE_CONTENTS, "error")
+        for _ in range(3):
+            self.queue.failed(self.queue.due()[0], "error")
+
+        self.assertEqual(self.queue.due(), [])
+        self.assertEqual(len(self.queue.items(WorkQueue.STATE_DEAD)), 1)
+
+        self.assertEqual(self.queue.replay(), 1)
+        self.assertEqual(self.queue.due()[0]["attempts"], 0)
+
+    def test_retries_back_off(self):
+        queue = WorkQueue(self.make_app(), 3, 60, 3600)
+        queue.add(WorkQueue.KIND_CHANGE, 10, WorkQueue.STAGE_CONTENTS, "error")
+        self.assertEqual(queue.due(), [])
+
+        item = queue.items()[0]
+        queue.failed(item, "error")
+        self.assertTrue(queue.items()[0]["next_attempt"] - item["next_attempt"] >= 60)
+
+    def test_succeeded_items_are_removed(self):
+        self.queue.add(WorkQueue.KIND_CHANGE, 10, WorkQueue.STAGE_CONTENTS, "error")
+        self.queue.succeeded(self.queue.due()[0]["id"])
+        self.assertEqual(self.queue.items(), [])
+
+class TestRetryWorker(SyncTestCase):
+
+    def setUp(self):
+        SyncTestCase.setUp(self)
+        self.app = self.make_app(retry_base_delay=0)
+        self.server.submit(10, [(self.path("assets/hero/model.ma"), "add")])
+
+    def __fail_requests(self, method, entity_type):
+        def fail(called_method, args):
+            if called_method == method and args[0] == entity_type:
+                raise Exception("Service unavailable")
+        self.shotgun.fail = fail
+
+    def test_failed_change_is_retried(self):
+        self.__fail_requests("update", "Revision")
+        ShotgunSync(self.app).sync_changes(10, 10, self.p4)
+        self.assertFalse(self.shotgun.all("Revision")[0].get("published_files"))
+
+        self.shotgun.fail = None
+        worker = RetryWorker(self.app)
+        self.assertEqual(worker.process_due_items(self.p4), 1)
+
+        self.assertEqual(len(self.shotgun.all("Revision")[0]["published_files"]), 1)
+        self.assertEqual(worker._work_queue.items(), [])
+
+    def test_failed_publish_is_retried(self):
+        self.__fail_requests("create", "PublishedFile")
+        ShotgunSync(self.app).sync_changes(10, 10, self.p4)
+        self.assertEqual(self.shotgun.all("PublishedFile"), [])
+
+        self.shotgun.fail = None
+        worker = RetryWorker(self.app)
+        worker.process_due_items(self.p4)
+
+        self.assertEqual(len(self.shotgun.all("PublishedFile")), 1)
+        self.assertEqual(len(self.shotgun.all("Revision")[0]["published_files"]), 1)
+        self.assertEqual(worker._work_queue.items(), [])
+
+    def test_item_fails_again(self):
+        self.__fail_requests("update", "Revision")
+        ShotgunSync(self.app).sync_changes(10, 10, self.p4)
+
+        worker = RetryWorker(self.app)
+        worker.process_due_items(self.p4)
+
+        self.assertEqual([i["attempts"] for i in worker._work_queue.items()], [1])
+
+    def test_changes_outside_the_project_are_not_synced(self):
+        self.server.submit(11, [("//depot/unmanaged/notes.txt", "add")])
+        worker = RetryWorker(self.app)
+        worker._work_queue.add(WorkQueue.KIND_CHANGE, 11, WorkQueue.STAGE_CONTENTS, "Connection reset by peer")
+
+        worker.process_due_items(self.p4)
+
+        self.assertEqual(self.revisions(), [])
+        self.assertEqual(worker._work_queue.items(), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for grouping the Shotgun writes for consecutive changes
+"""
+
+import unittest
+
+# the helpers set up the path to the fake Toolkit and Perforce modules:
+from helpers import SyncTestCase, run_daemon_cycles
+from tk_shell_perforcesync.write_buffer import ShotgunWriteBuffer
+from tk_shell_perforcesync.shotgun_sync_daemon import ShotgunSyncDaemon
+
+class TestWriteBuffer(SyncTestCase):
+
+    def __create(self, code, fail=False):
+        request = {"request_type":"create", "entity_type":"Revision", "data":{"code":code}}
+        if fail:
+            request["fail"] = True
+        return request
+
+    def test_buffer_is_due(self):
+        write_buffer = ShotgunWriteBuffer(self.make_app(), self.shotgun, 2, 3600)
+        self.assertFalse(write_buffer.is_due())
+        write_buffer.add(10, [self.__create("10")])
+        self.assertFalse(write_buffer.is_due())
+        write_buffer.add(11, [self.__create("11")])
+        self.assertTrue(write_buffer.is_due())
+
+        old_buffer = ShotgunWriteBuffer(self.make_app(), self.shotgun, 100, 0)
+        old_buffer.add(10, [self.__create("10")])
+        self.assertTrue(old_buffer.is_due())
+
+    def test_changes_are_written_in_one_batch(self):
+        write_buffer = ShotgunWriteBuffer(self.make_app(), self.shotgun, 100, 3600)
+        write_buffer.add(10, [self.__create("10")])
+        write_buffer.add(11, [self.__create("11"), self.__create("11b")])
+
+        self.assertEqual(write_buffer.flush(), ([10, 11], []))
+
+        self.assertEqual(self.shotgun.calls["batch"], 1)
+        self.assertEqual([[e["code"] for e in write_buffer.created_entities[c]] for c in [10, 11]],
+                         [["10"], ["11", "11b"]])
+        self.assertEqual((len(write_buffer), write_buffer.change_ids), (0, []))
+
+    def test_failed_change_doesnt_stop_others(self):
+        write_buffer = ShotgunWriteBuffer(self.make_app(), self.shotgun, 100, 3600)
+        write_buffer.add(10, [self.__create("10")])
+        failing_requests = [self.__create("11", fail=True)]
+        write_buffer.add(11, failing_requests)
+        write_buffer.add(12, [self.__create("12")])
+
+        written, failed = write_buffer.flush()
+
+        self.assertEqual((written, [change_id for change_id, _ in failed]), ([10, 12], [11]))
+        self.assertEqual(write_buffer.failed_requests, {11:failing_requests})
+        self.assertEqual(self.revisions(), ["10", "12"])
+
+    def test_discarded_changes_are_not_written(self):
+        write_buffer = ShotgunWriteBuffer(self.make_app(), self.shotgun, 100, 3600)
+        write_buffer.add(10, [self.__create("10")])
+        write_buffer.add(11, [self.__create("11")])
+
+        write_buffer.discard([10])
+
+        self.assertEqual(write_buffer.flush(), ([11], []))
+        self.assertEqual(self.revisions(), ["11"])
+
+    def test_daemon_writes_consecutive_changes_together(self):
+        for change_id in range(10, 13):
+            self.server.submit(change_id, [(self.path("assets/hero/model.ma"), "edit")])
+        daemon = ShotgunSyncDaemon(self.make_app(use_work_queue=False, write_buffer_size=100))
+
+        run_daemon_cycles(daemon)
+
+        self.assertEqual(self.revisions(), ["10", "11", "12"])
+        revision_batches = [args for method, args in self.shotgun.requests
+                            if method == "batch" and any(r["entity_type"] == "Revision" for r in args[0])]
+        self.assertEqual(len(revision_batches), 1)
+        self.assertEqual(self.server.counters["tk_perforcesync_project_65"], "12")
+
+if __name__ == "__main__":
+    unittest.main()